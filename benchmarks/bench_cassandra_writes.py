@@ -0,0 +1,76 @@
+import json
+import time
+import uuid
+import argparse
+
+from core.connection_wrappers.cassandra_wrapper import CassandraContext
+
+'''
+Compares the per-row write path (SimpleStatement with an inlined JSON literal, one synchronous round trip per row)
+with the prepared exec_write_many path, against a local stand-in cluster, e.g.
+
+    docker run -d -p 9042:9042 cassandra:3.11
+    PYTHONPATH=. python benchmarks/bench_cassandra_writes.py --seeds 127.0.0.1 --rows 5000
+
+The benchmark creates (and drops) the keyspace bench_db_0001 with replication factor 1.
+'''
+
+KEYSPACE = "bench_db_0001"
+TABLE = f"{KEYSPACE}.incident_data"
+
+
+def make_rows(n):
+    return [{
+        "user_id": "bench_user",
+        "mc_dw_id": str(uuid.uuid4()),
+        "title": f"Freshness anomaly on table_{i}",
+        "status": "OPEN",
+        "priority": "P2"
+    } for i in range(n)]
+
+
+def setup(cassandra_ctx):
+    session = cassandra_ctx.get_session()
+    session.execute(f"CREATE KEYSPACE IF NOT EXISTS {KEYSPACE} "
+                    "WITH REPLICATION = {'class': 'SimpleStrategy', 'replication_factor': 1}")
+    session.execute(f"CREATE TABLE IF NOT EXISTS {TABLE} (user_id text, mc_dw_id text, title text, status text, "
+                    "priority text, PRIMARY KEY ((user_id, mc_dw_id)))")
+
+
+def bench_per_row(cassandra_ctx, rows):
+    start = time.perf_counter()
+    for row in rows:
+        cassandra_ctx.exec_write("INSERT INTO {} JSON '{}'".format(TABLE, json.dumps(row).replace("'", "''")))
+    return time.perf_counter() - start
+
+
+def bench_write_many(cassandra_ctx, rows, concurrency):
+    start = time.perf_counter()
+    errors = cassandra_ctx.exec_write_many(f"INSERT INTO {TABLE} JSON ?", [(json.dumps(row),) for row in rows],
+                                           concurrency=concurrency)
+    elapsed = time.perf_counter() - start
+    if errors:
+        print(f"{len(errors)} rows failed, first error: {errors[0][1]}")
+    return elapsed
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Benchmark Cassandra write paths")
+    parser.add_argument("--seeds", nargs="+", default=["127.0.0.1"])
+    parser.add_argument("--rows", type=int, default=5000)
+    parser.add_argument("--concurrency", type=int, nargs="+", default=[16, 64, 256])
+    parser.add_argument("--consistency", default="ONE", help="Write consistency for both paths")
+    args = parser.parse_args()
+
+    cassandra_ctx = CassandraContext(args.seeds, write_consistency=args.consistency)
+    try:
+        setup(cassandra_ctx)
+        rows = make_rows(args.rows)
+        elapsed = bench_per_row(cassandra_ctx, rows)
+        print(f"exec_write loop:            {args.rows / elapsed:>10.0f} rows/s")
+        for concurrency in args.concurrency:
+            elapsed = bench_write_many(cassandra_ctx, rows, concurrency)
+            print(f"exec_write_many (c={concurrency:>4}): {args.rows / elapsed:>10.0f} rows/s")
+    finally:
+        cassandra_ctx.get_session().execute(f"DROP KEYSPACE IF EXISTS {KEYSPACE}")
+        cassandra_ctx.close()
@@ -0,0 +1,161 @@
+import time
+import json
+import uuid
+import random
+import argparse
+import threading
+
+from http.server import ThreadingHTTPServer, BaseHTTPRequestHandler
+
+from core.connection_wrappers.elasticsearch_wrapper import ElasticsearchContext
+from monte_carlo_indexer import MonteCarloIndexer
+
+'''
+Measures documents indexed per second through MonteCarloIndexer against a local stub of the Elasticsearch _bulk API.
+Messages are served from memory instead of Kafka. The stub can reject a share of the bulk items with 429, to measure
+the cost of the retries.
+
+Run from the repository root:
+    PYTHONPATH=.:load_elasticsearch/monte_carlo_indexer python benchmarks/bench_es_bulk_loader.py --docs 100000
+'''
+
+
+class StubElasticsearchHandler(BaseHTTPRequestHandler):
+    protocol_version = "HTTP/1.1"
+    reject_rate = 0.0
+    delay = 0.0
+
+    def do_POST(self):
+        body = self.rfile.read(int(self.headers.get("Content-Length", 0)))
+        if not self.path.split("?")[0].endswith("/_bulk"):
+            return self.__reply({"_shards": {"total": 1, "successful": 1, "failed": 0}})
+        if self.delay:
+            time.sleep(self.delay)
+        lines = body.splitlines()
+        items = []
+        for line in lines[::2]:
+            op_type, meta = next(iter(json.loads(line).items()))
+            if random.random() < self.reject_rate:
+                items.append({op_type: {"_index": meta["_index"], "_id": meta.get("_id"), "status": 429,
+                                        "error": {"type": "es_rejected_execution_exception"}}})
+            else:
+                items.append({op_type: {"_index": meta["_index"], "_id": meta.get("_id"), "_version": 1,
+                                        "result": "created", "status": 201}})
+        self.__reply({"took": 1, "errors": any(item[next(iter(item))]["status"] >= 300 for item in items),
+                      "items": items})
+
+    def do_GET(self):
+        index = self.path.lstrip("/").split("/")[0]
+        self.__reply({index: {"settings": {"index": {"refresh_interval": "1s"}}}})
+
+    def do_PUT(self):
+        self.rfile.read(int(self.headers.get("Content-Length", 0)))
+        self.__reply({"acknowledged": True})
+
+    def __reply(self, response):
+        body = json.dumps(response).encode("utf-8")
+        self.send_response(200)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, *args):
+        pass
+
+
+def start_stub_server(reject_rate, delay):
+    StubElasticsearchHandler.reject_rate = reject_rate
+    StubElasticsearchHandler.delay = delay
+    server = ThreadingHTTPServer(("127.0.0.1", 0), StubElasticsearchHandler)
+    server.daemon_threads = True
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    return server
+
+
+class StubMessage:
+    def __init__(self, partition, offset, value):
+        self.__partition = partition
+        self.__offset = offset
+        self.__value = value
+
+    def topic(self):
+        return "bench"
+
+    def partition(self):
+        return self.__partition
+
+    def offset(self):
+        return self.__offset
+
+    def value(self):
+        return self.__value
+
+    def headers(self):
+        return [("doc_type", b"mc_incident")]
+
+
+class InMemoryConsumer:
+    '''
+    Serves the messages num_messages at a time, then stops the indexer once they are all consumed.
+    '''
+
+    def __init__(self, messages, num_messages=500):
+        self.__messages = messages
+        self.__num_messages = num_messages
+        self.__position = 0
+        self.on_exhausted = None
+        self.committed = {}
+
+    def set_rebalance_callbacks(self, on_assign=None, on_revoke=None):
+        pass
+
+    def consume_filtered(self, header_filter, raw=False, on_skip=None):
+        batch = self.__messages[self.__position:self.__position + self.__num_messages]
+        self.__position += len(batch)
+        if not batch and self.on_exhausted:
+            self.on_exhausted()
+        return batch
+
+    def commit_offsets(self, offsets, is_asynchronous_commit=False):
+        self.committed.update(offsets)
+
+
+def synthetic_messages(n_docs, partitions):
+    messages = []
+    for offset in range(n_docs):
+        doc = {"doc_type": "mc_incident", "user_id": "bench_user", "__key": "mc_incident:bench_user",
+               "meta": {"producer_process_type": "monte_carlo_crawler", "producer_process_id": "bench",
+                        "timestamp": time.time() * 1000},
+               "payload": {"node": {"uuid": str(uuid.uuid4()), "title": "Freshness anomaly", "status": "OPEN",
+                                    "priority": "P2", "created_time": "2023-01-01T00:00:00Z"}}}
+        messages.append(StubMessage(offset % partitions, offset // partitions, json.dumps(doc).encode("utf-8")))
+    return messages
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Benchmark bulk indexing from Kafka to Elasticsearch")
+    parser.add_argument("--docs", type=int, default=100000)
+    parser.add_argument("--partitions", type=int, default=6)
+    parser.add_argument("--batch_size", type=int, nargs="+", default=[100, 1000, 5000])
+    parser.add_argument("--reject_rate", type=float, default=0, help="Share of bulk items rejected with 429")
+    parser.add_argument("--delay_ms", type=float, default=0, help="Artificial latency of a bulk request")
+    parser.add_argument("--backfill", action="store_true")
+    args = parser.parse_args()
+
+    server = start_stub_server(args.reject_rate, args.delay_ms / 1000)
+    es_ctx = ElasticsearchContext([f"127.0.0.1:{server.server_address[1]}"])
+    messages = synthetic_messages(args.docs, args.partitions)
+    for batch_size in args.batch_size:
+        consumer = InMemoryConsumer(messages)
+        indexer = MonteCarloIndexer(es_ctx=es_ctx, consumer_ctx=consumer, index="bench", doc_type="mc_incident",
+                                    batch_size=batch_size, chunk_size=batch_size, max_retries=10,
+                                    backfill=args.backfill, report_interval=3600)
+        consumer.on_exhausted = indexer.stop
+        start = time.perf_counter()
+        indexer.execute()
+        elapsed = time.perf_counter() - start
+        stats = indexer.stats()
+        print(f"batch_size={batch_size:<6} {elapsed:6.2f}s  {stats['indexed']} indexed  "
+              f"{stats['bulk_requests']} flushes  {stats['indexed'] / elapsed:.0f} docs/s")
+    server.shutdown()
@@ -0,0 +1,127 @@
+import gc
+import copy
+import time
+import types
+import random
+import argparse
+import subprocess
+
+from mappers import GenericFieldMapper
+
+'''
+Compares GenericFieldMapper.field_mapper (one call per document, passed the config as callers do or the compiled
+plan) with field_mapper_batch (one call per batch). With --baseline, also times field_mapper as it is at that git
+revision, e.g. the interpreting mapper before configs were compiled. Its output is not compared, as that mapper wrote
+the return values of the validators back into the documents.
+
+Run from the repository root:
+    PYTHONPATH=.:core/processors python benchmarks/bench_field_mapper_batch.py --batch_sizes 25 500 5000 \
+        --baseline 7786b49
+'''
+
+CONF = {
+    "transformations": [{
+        "path": "node.status",
+        "transformation": "change_case",
+        "params": {"target_case": "lower"}
+    }, {
+        "path": "node.createdTime",
+        "transformation": "date_standardization",
+        "params": {"target_format": "%Y-%m-%dT%H:%M:%S.%fZ"}
+    }, {
+        "path": "node.tables[].mcon",
+        "transformation": "change_case",
+        "params": {"target_case": "upper"}
+    }],
+    "validations": [{
+        "path": "node.uuid",
+        "validation": "not_null",
+        "params": {"on_failure": "return_error"}
+    }],
+    "annotations": [{
+        "path": "node.priority",
+        "annotation": "standard",
+        "params": {"mode": "dynamic", "annotation": "HIGH_PRIORITY", "operator": "equals", "threshold": "P1"}
+    }, {
+        "path": "node.severity",
+        "annotation": "standard",
+        "params": {"mode": "dynamic", "annotation": "SEVERE", "operator": "gte", "threshold": 3}
+    }]
+}
+
+
+def make_incident(i):
+    return {
+        "node": {
+            "uuid": f"uuid-{i}",
+            "status": random.choice(["OPEN", "ACKNOWLEDGED", "RESOLVED"]),
+            "createdTime": f"2023-0{i % 9 + 1}-1{i % 10}T10:1{i % 10}:00.000000+00:00",
+            "priority": random.choice(["P1", "P2", "P3"]),
+            "severity": random.randint(1, 5),
+            "tables": [{"mcon": f"mcon++{i}++table_{j}"} for j in range(3)]
+        },
+        "mc_dw_id": "dw-1"
+    }
+
+
+def load_baseline_mapper(revision):
+    source = subprocess.check_output(["git", "show", f"{revision}:core/processors/mappers.py"])
+    module = types.ModuleType("baseline_mappers")
+    exec(compile(source, f"{revision}:core/processors/mappers.py", "exec"), module.__dict__)
+    return module.GenericFieldMapper()
+
+
+def best_of(run, docs, rounds, repeats=3):
+    '''
+    :return: (output, seconds) of the fastest of repeats runs of run(batches), on fresh copies of the documents
+    '''
+    best = None
+    for _ in range(repeats):
+        batches = [copy.deepcopy(docs) for _ in range(rounds)]
+        gc.collect()
+        start = time.perf_counter()
+        output = run(batches)
+        seconds = time.perf_counter() - start
+        if best is None or seconds < best[1]:
+            best = (output, seconds)
+    return best
+
+
+def time_per_doc(mapper, conf, docs, rounds):
+    return best_of(lambda batches: [[mapper.field_mapper(doc, conf) for doc in batch] for batch in batches], docs,
+                   rounds)
+
+
+def bench(batch_size, rounds, baseline_mapper=None):
+    mapper = GenericFieldMapper()
+    plan = mapper.compile(CONF)
+    docs = [make_incident(i) for i in range(batch_size)]
+
+    per_doc_conf, per_doc_conf_time = time_per_doc(mapper, CONF, docs, rounds)
+    per_doc, per_doc_time = time_per_doc(mapper, plan, docs, rounds)
+    assert per_doc_conf == per_doc, "Mapping with the config differs from mapping with its plan"
+
+    batched, batch_time = best_of(lambda batches: [mapper.field_mapper_batch(batch, plan) for batch in batches], docs,
+                                  rounds)
+
+    assert per_doc == batched, "Batch output differs from per-document output"
+    n_docs = batch_size * rounds
+    line = (f"batch_size={batch_size:>5} per_doc_conf={n_docs / per_doc_conf_time:>9.0f} docs/s "
+            f"per_doc_plan={n_docs / per_doc_time:>9.0f} docs/s batch={n_docs / batch_time:>9.0f} docs/s "
+            f"speedup={per_doc_time / batch_time:.2f}x")
+    if baseline_mapper:
+        _, baseline_time = time_per_doc(baseline_mapper, CONF, docs, rounds)
+        line += (f" baseline={n_docs / baseline_time:>9.0f} docs/s "
+                 f"per_doc_conf_vs_baseline={baseline_time / per_doc_conf_time:.2f}x")
+    print(line)
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Benchmark columnar field mapping")
+    parser.add_argument("--batch_sizes", type=int, nargs="+", default=[25, 500, 5000])
+    parser.add_argument("--docs", type=int, default=20000, help="Approximate number of documents per measurement")
+    parser.add_argument("--baseline", help="Git revision whose field_mapper is timed as the baseline", default=None)
+    args = parser.parse_args()
+    baseline_mapper = load_baseline_mapper(args.baseline) if args.baseline else None
+    for size in args.batch_sizes:
+        bench(batch_size=size, rounds=max(1, args.docs // size), baseline_mapper=baseline_mapper)
@@ -0,0 +1,108 @@
+import copy
+import time
+import argparse
+import tracemalloc
+
+from mappers import GenericFieldMapper
+
+'''
+Measures the memory GenericFieldMapper allocates while mapping large documents (many list items per path), with
+tracemalloc: the peak of the memory traced above what the documents themselves take, and what is still held once
+they are mapped. Also checks that the per-document and batch outputs are identical and that lists the caller still
+holds are never written to. Times include the overhead of tracing, see bench_field_mapper_batch.py for throughput.
+
+Run from the repository root:
+    PYTHONPATH=.:core/processors python benchmarks/bench_field_mapper_memory.py --tables 500 --columns 20
+'''
+
+TRANSFORMATIONS = [{
+    "path": "node.tables[].columns[].name",
+    "transformation": "change_case",
+    "params": {"target_case": "lower"}
+}, {
+    "path": "node.tags[]",
+    "transformation": "change_case",
+    "params": {"target_case": "upper"}
+}]
+
+VALIDATIONS = [{
+    "path": "node.uuid",
+    "validation": "not_null",
+    "params": {"on_failure": "return_error"}
+}, {
+    "path": "node.tables[].columns[].type",
+    "validation": "not_null",
+    "params": {"on_failure": "return_error"}
+}]
+
+ANNOTATIONS = [{
+    "path": "node.status",
+    "annotation": "standard",
+    "params": {"mode": "dynamic", "annotation": "OPEN", "operator": "equals", "threshold": "open"}
+}]
+
+CONFS = {
+    "validations": {"validations": VALIDATIONS},
+    "mixed": {"transformations": TRANSFORMATIONS, "validations": VALIDATIONS, "annotations": ANNOTATIONS}
+}
+
+
+def make_document(i, tables, columns):
+    return {
+        "node": {
+            "uuid": f"uuid-{i}",
+            "status": "open",
+            "tags": [f"tag_{j}" for j in range(tables)],
+            "tables": [{"mcon": f"mcon++{i}++table_{j}",
+                        "columns": [{"name": f"COLUMN_{k}", "type": "varchar"} for k in range(columns)]}
+                       for j in range(tables)]
+        }
+    }
+
+
+def measure(run, docs):
+    '''
+    :return: (seconds, peak bytes, retained bytes) of run(docs), above the memory the documents take
+    '''
+    tracemalloc.start()
+    baseline, _ = tracemalloc.get_traced_memory()
+    tracemalloc.reset_peak()
+    start = time.perf_counter()
+    result = run(docs)
+    seconds = time.perf_counter() - start
+    current, peak = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+    return result, seconds, peak - baseline, current - baseline
+
+
+def bench(name, conf, n_docs, tables, columns):
+    mapper = GenericFieldMapper()
+    plan = mapper.compile(conf)
+    docs = [make_document(i, tables, columns) for i in range(n_docs)]
+
+    per_doc_docs = copy.deepcopy(docs)
+    held_tags = [doc["node"]["tags"] for doc in per_doc_docs]
+    per_doc, per_doc_time, per_doc_peak, per_doc_retained = measure(
+        lambda batch: [mapper.field_mapper(doc, plan) for doc in batch], per_doc_docs)
+
+    batch_docs = copy.deepcopy(docs)
+    batched, batch_time, batch_peak, batch_retained = measure(lambda batch: mapper.field_mapper_batch(batch, plan),
+                                                              batch_docs)
+
+    assert per_doc == batched, "Batch output differs from per-document output"
+    assert held_tags == [doc["node"]["tags"] for doc in docs], "A list held by the caller was written to"
+    values = n_docs * tables * (columns + 1)
+    for mode, seconds, peak, retained in (("per_doc", per_doc_time, per_doc_peak, per_doc_retained),
+                                          ("batch", batch_time, batch_peak, batch_retained)):
+        print(f"conf={name:<11} mode={mode:<7} values={values:>8} peak={peak / 1024:>9.1f} KiB "
+              f"retained={retained / 1024:>9.1f} KiB time={seconds * 1000:>8.1f} ms")
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Benchmark the memory allocated by field mapping")
+    parser.add_argument("--docs", type=int, default=20)
+    parser.add_argument("--tables", type=int, default=500, help="List items per document")
+    parser.add_argument("--columns", type=int, default=20, help="Nested list items per table")
+    args = parser.parse_args()
+    for name, conf in CONFS.items():
+        bench(name, conf, args.docs, args.tables, args.columns)
@@ -0,0 +1,75 @@
+import time
+import json
+import argparse
+import threading
+
+from http.server import ThreadingHTTPServer, BaseHTTPRequestHandler
+
+from core.connection_wrappers.janusgraph_wrapper import JanusGraphContext
+
+'''
+Compares writing vertices one query per request (execute) with packed batches (execute_many) against a local stub of
+the Gremlin Server HTTP endpoint, which answers every query of a request with an empty result after --latency_ms.
+
+Run from the repository root:
+    PYTHONPATH=. python benchmarks/bench_janusgraph_batches.py --queries 2000 --batch_size 100
+'''
+
+
+class StubGremlinHandler(BaseHTTPRequestHandler):
+    protocol_version = "HTTP/1.1"
+    # Headers and body are written separately, Nagle would hold the body back until the client acknowledges them
+    disable_nagle_algorithm = True
+    delay = 0.0
+    requests = 0
+
+    def do_POST(self):
+        query = json.loads(self.rfile.read(int(self.headers.get("Content-Length", 0))))
+        StubGremlinHandler.requests += 1
+        if self.delay:
+            time.sleep(self.delay)
+        # One result per packed query, one for a single query
+        n_results = max(1, query["gremlin"].count("__iterate(") - 1)
+        body = json.dumps({"result": {"data": [[] for _ in range(n_results)]}, "status": {"code": 200}})
+        body = body.encode("utf-8")
+        self.send_response(200)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, *args):
+        pass
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Benchmark single versus packed Gremlin requests")
+    parser.add_argument("--queries", type=int, default=2000)
+    parser.add_argument("--batch_size", type=int, default=100)
+    parser.add_argument("--latency_ms", type=float, default=2, help="Artificial latency of a request")
+    args = parser.parse_args()
+
+    StubGremlinHandler.delay = args.latency_ms / 1000
+    server = ThreadingHTTPServer(("127.0.0.1", 0), StubGremlinHandler)
+    server.daemon_threads = True
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    jg_ctx = JanusGraphContext(["127.0.0.1"], port=server.server_address[1])
+
+    queries = [{"gremlin": "g.addV('dataset').property('qualified_name', name)", "bindings": {"name": f"db.t{i}"}}
+               for i in range(args.queries)]
+
+    StubGremlinHandler.requests = 0
+    start = time.perf_counter()
+    for query in queries:
+        jg_ctx.execute(query)
+    elapsed = time.perf_counter() - start
+    print(f"execute       {elapsed:6.2f}s  {StubGremlinHandler.requests} requests  {args.queries / elapsed:.0f} queries/s")
+
+    StubGremlinHandler.requests = 0
+    start = time.perf_counter()
+    jg_ctx.execute_many(queries, batch_size=args.batch_size)
+    elapsed = time.perf_counter() - start
+    print(f"execute_many  {elapsed:6.2f}s  {StubGremlinHandler.requests} requests  {args.queries / elapsed:.0f} queries/s")
+
+    jg_ctx.close()
+    server.shutdown()
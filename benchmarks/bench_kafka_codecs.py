@@ -0,0 +1,51 @@
+import time
+import argparse
+
+from core.connection_wrappers.kafka_codecs import CODECS
+
+'''
+Encodes and decodes a typical mc_incident message with every available Kafka codec, and reports the time per message
+and the encoded size.
+
+Run from the repository root:
+    PYTHONPATH=. python benchmarks/bench_kafka_codecs.py --messages 20000
+'''
+
+MESSAGE = {
+    "doc_type": "mc_incident",
+    "user_id": "bench_user",
+    "__key": "mc_incident:bench_user",
+    "meta": {"producer_process_type": "monte_carlo_crawler", "producer_process_id": "bench_connector",
+             "timestamp": 1672531200000.0},
+    "payload": {
+        "node": {"id": "1234", "uuid": "0b7c8a3e-5b5e-4e0c-9f6a-3c1f0f3d2a11", "title": "Freshness anomaly",
+                 "tables": ["analytics:prod.orders", "analytics:prod.customers"],
+                 "created_time": "2023-01-01T00:00:00.000000+00:00", "type": "ANOMALIES",
+                 "sub_types": ["freshness_anomaly"], "priority": "P2", "status": "OPEN", "project": "analytics",
+                 "dataset": "prod", "incident_type": "ANOMALIES"},
+        "mc_dw_id": "dw_1",
+        "user_id": "bench_user",
+        "warehouse_info": {"uuid": "7d9e1d4e-8e0f-4a8e-b2c5-2f1b8a9c0d33", "id": "dw_1",
+                           "created_on": "2022-06-01T00:00:00Z", "connection_type": "snowflake", "name": "warehouse"},
+        "timestamp": "2023-01-01T00:05:00.000000"
+    }
+}
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Benchmark Kafka message codecs")
+    parser.add_argument("--messages", type=int, default=20000)
+    args = parser.parse_args()
+
+    for name, codec in CODECS.items():
+        start = time.perf_counter()
+        for _ in range(args.messages):
+            data = codec.encode(MESSAGE)
+        encode_time = time.perf_counter() - start
+        start = time.perf_counter()
+        for _ in range(args.messages):
+            decoded = codec.decode(data)
+        decode_time = time.perf_counter() - start
+        assert decoded == MESSAGE, name
+        print(f"{name:<24} {len(data):5d} bytes  encode {encode_time / args.messages * 1e6:6.2f}us  "
+              f"decode {decode_time / args.messages * 1e6:6.2f}us")
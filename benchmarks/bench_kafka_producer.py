@@ -0,0 +1,56 @@
+import time
+import argparse
+
+from core.connection_wrappers.kafka_wrapper import KafkaProducerContext, PRODUCER_PROFILES
+
+'''
+Produces the same mc_incident-like messages with every producer profile and reports messages/s (until flush returns)
+and the p50/p99 delivery latency reported by librdkafka, against a local broker, e.g.
+
+    docker run -d -p 9092:9092 bitnami/kafka
+    PYTHONPATH=. python benchmarks/bench_kafka_producer.py --seeds 127.0.0.1:9092 --messages 100000
+
+zstd requires brokers >= 2.1 and idempotence requires brokers >= 0.11.
+'''
+
+
+def percentile(values, fraction):
+    if not values:
+        return 0.0
+    values = sorted(values)
+    return values[min(len(values) - 1, int(len(values) * fraction))]
+
+
+def make_message(i):
+    return {
+        "doc_type": "mc_incident",
+        "user_id": "bench_user",
+        "meta": {"producer_process_type": "bench", "producer_process_id": "bench", "timestamp": time.time() * 1000},
+        "payload": {"node": {"uuid": f"incident-{i}", "title": "Freshness anomaly on analytics.prod.orders",
+                             "status": "OPEN", "priority": "P2", "tables": ["analytics:prod.orders"]}}
+    }
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Benchmark Kafka producer profiles")
+    parser.add_argument("--seeds", nargs="+", required=True)
+    parser.add_argument("--topic", default="bench_producer_profiles")
+    parser.add_argument("--messages", type=int, default=100000)
+    parser.add_argument("--profiles", nargs="+", default=sorted(PRODUCER_PROFILES))
+    args = parser.parse_args()
+
+    messages = [make_message(i) for i in range(args.messages)]
+    for profile in args.profiles:
+        latencies = []
+        producer_ctx = KafkaProducerContext(args.seeds, profile=profile,
+                                            on_delivery=lambda err, msg: latencies.append(msg.latency() or 0.0))
+        start = time.perf_counter()
+        for i, message in enumerate(messages):
+            producer_ctx.produce(topic=args.topic, msg_payload=message, msg_key=f"bench:{i % 64}")
+        producer_ctx.flush()
+        elapsed = time.perf_counter() - start
+        stats = producer_ctx.stats()
+        producer_ctx.close()
+        print(f"{profile:<12} {args.messages / elapsed:9.0f} msg/s  p50 {percentile(latencies, 0.5) * 1000:7.1f}ms  "
+              f"p99 {percentile(latencies, 0.99) * 1000:7.1f}ms  failed={stats['failed']} "
+              f"buffer_full_waits={stats['buffer_full_waits']}")
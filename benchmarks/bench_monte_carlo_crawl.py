@@ -0,0 +1,82 @@
+import time
+import uuid
+import argparse
+
+from plugins.fetch_from_monte_carlo import MonteCarloConnector, WAREHOUSES_QUERY, INCIDENTS_QUERY
+from plugins.recorded_client import RecordedMonteCarloClient, request_key
+
+'''
+Crawls recorded Monte Carlo GraphQL responses offline, once per worker count, and reports the crawl time.
+Responses are either synthetic (--warehouses x --pages pages of --page_size incidents) or a file saved by
+RecordingMonteCarloClient (--recording). Incidents are counted instead of being produced to kafka.
+
+Run from the repository root:
+    PYTHONPATH=.:load_kafka/monte_carlo_producer python benchmarks/bench_monte_carlo_crawl.py --workers 1 4 16
+'''
+
+
+class CountingProducer:
+    def __init__(self):
+        self.produced = 0
+
+    def produce(self, topic, msg_payload, msg_key=None, on_delivery=None):
+        self.produced += 1
+
+    def flush(self):
+        pass
+
+    def stats(self):
+        return {"produced": self.produced, "delivered": self.produced, "failed": 0, "buffer_full_waits": 0}
+
+
+class StaticConfig:
+    '''
+    Answers the connector's config lookup, the API keys are not needed with a recorded client.
+    '''
+    def exec_read(self, query, params=(), prepared=False):
+        # connector_type, auth_conf, service_conf, schedule_conf, lupdt
+        return [("monte_carlo_crawler", b"{}", b"{}", None, None)]
+
+
+def synthetic_responses(n_warehouses, n_pages, page_size):
+    warehouses = [{"uuid": str(uuid.uuid4()), "id": f"dw_{i}", "created_on": "2023-01-01T00:00:00Z",
+                   "connection_type": "snowflake", "name": f"warehouse_{i}"} for i in range(n_warehouses)]
+    responses = {request_key(WAREHOUSES_QUERY): {"get_user": {"account": {"warehouses": warehouses}}}}
+    for warehouse in warehouses:
+        after = None
+        for page in range(n_pages):
+            cursor = f"{warehouse['uuid']}:{page}"
+            edges = [{"node": {"uuid": str(uuid.uuid4()), "title": "Freshness anomaly", "status": "OPEN",
+                               "priority": "P2", "created_time": "2023-01-01T00:00:00Z"}} for _ in range(page_size)]
+            responses[request_key(INCIDENTS_QUERY, {"dwId": warehouse["uuid"], "after": after,
+                                                    "startTime": None})] = {
+                "get_incidents": {"edges": edges,
+                                  "page_info": {"end_cursor": cursor, "has_next_page": page < n_pages - 1}}}
+            after = cursor
+    return responses
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Benchmark the Monte Carlo crawl against recorded responses")
+    parser.add_argument("--recording", help="File saved by RecordingMonteCarloClient", required=False)
+    parser.add_argument("--warehouses", type=int, default=24)
+    parser.add_argument("--pages", type=int, default=5)
+    parser.add_argument("--page_size", type=int, default=100)
+    parser.add_argument("--latency_ms", type=float, default=150, help="Simulated API round trip")
+    parser.add_argument("--rate_limit", type=float, default=50)
+    parser.add_argument("--workers", type=int, nargs="+", default=[1, 4, 16])
+    args = parser.parse_args()
+
+    responses = args.recording or synthetic_responses(args.warehouses, args.pages, args.page_size)
+    for workers in args.workers:
+        client = RecordedMonteCarloClient(responses, latency=args.latency_ms / 1000)
+        producer = CountingProducer()
+        connector = MonteCarloConnector(user_id="bench_user", connector_id="bench_connector",
+                                        cassandra_ctx=StaticConfig(), producer_ctx=producer,
+                                        config_table="bench", topic="bench", workers=workers,
+                                        rate_limit=args.rate_limit, mc_client=client)
+        start = time.perf_counter()
+        connector.execute()
+        elapsed = time.perf_counter() - start
+        print(f"workers={workers:<3} {elapsed:6.2f}s  {client.calls} requests  {producer.produced} incidents  "
+              f"{producer.produced / elapsed:.0f} incidents/s")
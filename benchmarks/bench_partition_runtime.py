@@ -0,0 +1,165 @@
+import json
+import time
+import hashlib
+import argparse
+import threading
+from concurrent.futures import Future
+
+from core.connection_wrappers.kafka_codecs import decode_message
+from core.connection_wrappers.kafka_wrapper import KafkaRecord, OffsetTracker
+from core.connection_wrappers.kafka_runtime import PartitionWorkerRuntime
+
+'''
+Runs PartitionWorkerRuntime in thread mode (with a synchronous handler, with one returning Futures and with one
+decoding the records itself) and in process mode over records served from memory, and checks what the runtime
+guarantees: every record is acknowledged exactly once, the records of a partition in offset order, records of other
+doc types are skipped, and the committed offsets reach the end of every partition. Reports records/s for a CPU bound
+handler.
+
+Run from the repository root:
+    PYTHONPATH=. python benchmarks/bench_partition_runtime.py --records 20000 --partitions 8
+'''
+
+
+class InMemoryMessage:
+    '''
+    Stands in for a confluent_kafka Message, for records consumed with decode=False.
+    '''
+
+    def __init__(self, value):
+        self.__value = json.dumps(value).encode("utf-8")
+
+    def value(self):
+        return self.__value
+
+    def headers(self):
+        return []
+
+
+class InMemoryRecordConsumer:
+    '''
+    Stands in for KafkaConsumerContext: serves records from memory through the record API the runtime uses, and
+    records the acknowledgements and commits. Calls on_exhausted once every record was served.
+    '''
+
+    def __init__(self, records, batch_size=100):
+        self.__records = records
+        self.__batch_size = batch_size
+        self.__position = 0
+        self.__paused = set()
+        self.__tracker = OffsetTracker()
+        self.__lock = threading.Lock()
+        self.acks = {}
+        self.committed = {}
+        self.pauses = 0
+        self.on_exhausted = None
+
+    def set_rebalance_callbacks(self, on_assign=None, on_revoke=None):
+        pass
+
+    def consume_records(self, header_filter=None, decode=True):
+        if self.__position >= len(self.__records):
+            if self.on_exhausted:
+                self.on_exhausted()
+            time.sleep(0.01)
+            return []
+        batch = []
+        while self.__position < len(self.__records) and len(batch) < self.__batch_size:
+            record = self.__records[self.__position]
+            if (record.topic, record.partition) in self.__paused:
+                break
+            self.__position += 1
+            self.__tracker.track(record.topic, record.partition, record.offset)
+            if header_filter and record.value["doc_type"] != header_filter["doc_type"]:
+                self.__tracker.ack(record.topic, record.partition, record.offset)
+                continue
+            batch.append(record if decode else record._replace(value=InMemoryMessage(record.value)))
+        if not batch:
+            time.sleep(0.001)
+        return batch
+
+    def ack(self, record):
+        with self.__lock:
+            self.acks.setdefault(record.partition, []).append(record.offset)
+        self.__tracker.ack(record.topic, record.partition, record.offset)
+
+    def commit_processed(self, is_asynchronous_commit=False):
+        self.committed.update(self.__tracker.committable())
+
+    def pause(self, partitions):
+        self.pauses += 1
+        self.__paused.update(partitions)
+
+    def resume(self, partitions):
+        self.__paused.difference_update(partitions)
+
+
+def synthetic_records(n_records, n_partitions, skip_every=10):
+    records = []
+    for i in range(n_records):
+        partition = i % n_partitions
+        doc_type = "other" if i % skip_every == 0 else "mc_incident"
+        records.append(KafkaRecord("bench", partition, i // n_partitions, None,
+                                   {"doc_type": doc_type, "payload": {"uuid": f"incident-{i}"}}))
+    return records
+
+
+def handle(record):
+    # CPU bound work, module-level so that spawned worker processes can import it
+    digest = record.value["payload"]["uuid"].encode("utf-8")
+    for _ in range(200):
+        digest = hashlib.sha256(digest).digest()
+    return None
+
+
+def handle_undecoded(record):
+    return handle(record._replace(value=decode_message(record.value)))
+
+
+def handle_async(record):
+    future = Future()
+    threading.Timer(0.001, future.set_result, args=(handle(record),)).start()
+    return future
+
+
+def bench(mode, handler, records, n_partitions, workers):
+    consumer = InMemoryRecordConsumer(records)
+    runtime = PartitionWorkerRuntime(consumer, handler, mode=mode, workers=workers, max_queued=50,
+                                     header_filter={"doc_type": "mc_incident"}, decode=handler is not handle_undecoded)
+    consumer.on_exhausted = lambda: runtime.stop() if not consumer_has_pending(consumer, records) else None
+    start = time.perf_counter()
+    runtime.run()
+    elapsed = time.perf_counter() - start
+
+    expected = {}
+    for record in records:
+        if record.value["doc_type"] == "mc_incident":
+            expected.setdefault(record.partition, []).append(record.offset)
+    for partition, offsets in expected.items():
+        acks = consumer.acks.get(partition, [])
+        assert sorted(acks) == offsets, f"Partition {partition}: records not acknowledged exactly once"
+        if handler is not handle_async:
+            assert acks == offsets, f"Partition {partition}: records not acknowledged in offset order"
+    last_offsets = {("bench", record.partition): record.offset + 1 for record in records}
+    assert consumer.committed == last_offsets, f"Committed {consumer.committed}, expected {last_offsets}"
+    handled = sum(len(offsets) for offsets in expected.values())
+    print(f"mode={mode:<7} handler={handler.__name__:<16} partitions={n_partitions} records={handled} "
+          f"pauses={consumer.pauses} {handled / elapsed:>9.0f} records/s")
+
+
+def consumer_has_pending(consumer, records):
+    handled = sum(len(offsets) for offsets in consumer.acks.values())
+    return handled < sum(1 for record in records if record.value["doc_type"] == "mc_incident")
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Check and benchmark the partition worker runtime")
+    parser.add_argument("--records", type=int, default=20000)
+    parser.add_argument("--partitions", type=int, default=8)
+    parser.add_argument("--workers", type=int, default=None, help="Worker processes in process mode, default per core")
+    args = parser.parse_args()
+    records = synthetic_records(args.records, args.partitions)
+    bench("thread", handle, records, args.partitions, args.workers)
+    bench("thread", handle_async, records, args.partitions, args.workers)
+    bench("thread", handle_undecoded, records, args.partitions, args.workers)
+    bench("process", handle, records, args.partitions, args.workers)
@@ -0,0 +1,66 @@
+import time
+import argparse
+import threading
+
+from http.server import ThreadingHTTPServer, BaseHTTPRequestHandler
+
+from webhook_dispatcher import WebhookDispatcher
+
+'''
+Measures webhook deliveries per second through WebhookDispatcher against a local stub HTTP server.
+
+Run from the repository root:
+    PYTHONPATH=.:push_alerts python benchmarks/bench_webhook_dispatcher.py --deliveries 20000 --endpoints 4
+'''
+
+
+class StubHandler(BaseHTTPRequestHandler):
+    protocol_version = "HTTP/1.1"
+    delay = 0.0
+
+    def do_POST(self):
+        self.rfile.read(int(self.headers.get("Content-Length", 0)))
+        if self.delay:
+            time.sleep(self.delay)
+        self.send_response(204)
+        self.send_header("Content-Length", "0")
+        self.end_headers()
+
+    def log_message(self, *args):
+        pass
+
+
+def start_stub_server(delay):
+    StubHandler.delay = delay
+    server = ThreadingHTTPServer(("127.0.0.1", 0), StubHandler)
+    server.daemon_threads = True
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    return server
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Benchmark webhook deliveries")
+    parser.add_argument("--deliveries", type=int, default=20000)
+    parser.add_argument("--endpoints", type=int, default=4, help="Distinct webhook paths on the stub server")
+    parser.add_argument("--max_concurrency", type=int, default=64)
+    parser.add_argument("--per_endpoint_concurrency", type=int, default=16)
+    parser.add_argument("--delay_ms", type=float, default=0, help="Artificial latency of the stub endpoint")
+    args = parser.parse_args()
+
+    server = start_stub_server(args.delay_ms / 1000)
+    base_url = f"http://127.0.0.1:{server.server_address[1]}"
+    dispatcher = WebhookDispatcher(max_concurrency=args.max_concurrency,
+                                   per_endpoint_concurrency=args.per_endpoint_concurrency)
+    payload = {"incident": {"uuid": "bench", "title": "Freshness anomaly", "priority": "P1"}}
+    headers = {"Content-Type": "application/json"}
+
+    start = time.perf_counter()
+    futures = [dispatcher.submit(f"{base_url}/hook/{i % args.endpoints}", headers, payload)
+               for i in range(args.deliveries)]
+    statuses = [future.result() for future in futures]
+    elapsed = time.perf_counter() - start
+
+    dispatcher.close()
+    server.shutdown()
+    failed = sum(1 for status in statuses if status != 204)
+    print(f"{args.deliveries / elapsed:.0f} deliveries/s ({failed} failed)")
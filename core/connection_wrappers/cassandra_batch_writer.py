@@ -0,0 +1,192 @@
+#!/usr/bin/env python
+
+import time
+import logging
+import threading
+
+from cassandra.query import BatchStatement, BatchType
+
+from core.exceptions.exceptions import CassandraConnectionException
+from core.connection_wrappers.kafka_codecs import JsonCodec
+
+
+class CassandraBatchWriter(object):
+    """
+    Writer stage that groups JSON rows by partition key and sends them as size-bounded UNLOGGED batches, one partition
+    per batch. A single-partition UNLOGGED batch is applied as one mutation by the replicas of that partition, and the
+    batch carries the partition's routing key so a token-aware load balancing policy sends it straight to a replica.
+
+    A partition is flushed when it reaches batch_size rows or max_batch_bytes of JSON, or when its oldest row has
+    waited flush_interval seconds. close() flushes what is left and waits for every batch in flight.
+    """
+
+    def __init__(self, cassandra_ctx, keyspace, table, partition_keys, batch_size=50, max_batch_bytes=40960,
+                 flush_interval=0.5):
+        self.__cassandra_ctx = cassandra_ctx
+        self.__full_table_name = f"{keyspace}.{table}"
+        self.__keyspace = keyspace
+        self.__partition_keys = partition_keys
+        self.__batch_size = batch_size
+        self.__max_batch_bytes = max_batch_bytes
+        self.__flush_interval = flush_interval
+
+        # Never executed, only used to let the driver serialize partition key values into a routing key
+        self.__routing_statement = cassandra_ctx.prepare(
+            "SELECT * FROM {} WHERE {}".format(self.__full_table_name,
+                                               " AND ".join(f"{key} = ?" for key in partition_keys)))
+
+        self.__lock = threading.Lock()
+        self.__idle = threading.Condition(self.__lock)
+        # Batches sent whose write has not completed yet
+        self.__inflight_batches = 0
+        # partition key values -> {"rows": [...], "bytes": int, "since": float}
+        self.__buffers = {}
+        self.__metrics = {"batches": 0, "rows": 0, "max_rows_per_batch": 0, "flush_time": 0.0, "max_flush_time": 0.0,
+                          "failed_batches": 0}
+        self.__stopped = threading.Event()
+        self.__flusher = threading.Thread(target=self.__flush_periodically, daemon=True)
+        self.__flusher.start()
+
+    """
+    API
+    """
+
+    def add(self, row, timestamp=None, callback=None, errback=None):
+        """
+        Buffers a row. callback() is called once the batch containing the row is written, errback(exception) if it
+        fails.
+        :param row: dict, the row as a JSON document, with a field per column. The partition key values are read from
+                    the row itself, so the batch is routed to the partition the row is written to
+        :param timestamp: int, (optional) write timestamp in microseconds
+        """
+        partition = tuple(row.get(key) for key in self.__partition_keys)
+        row_json = JsonCodec.encode(row).decode('utf-8')
+        to_flush = None
+        with self.__lock:
+            buffer = self.__buffers.get(partition)
+            if buffer is None:
+                buffer = self.__buffers[partition] = {"rows": [], "bytes": 0, "since": time.time()}
+            buffer["rows"].append((row_json, timestamp, callback, errback))
+            buffer["bytes"] += len(row_json)
+            if len(buffer["rows"]) >= self.__batch_size or buffer["bytes"] >= self.__max_batch_bytes:
+                to_flush = self.__buffers.pop(partition)
+        if to_flush:
+            self.__flush(partition, to_flush["rows"])
+
+    def flush(self):
+        with self.__lock:
+            buffers, self.__buffers = self.__buffers, {}
+        for partition, buffer in buffers.items():
+            self.__flush(partition, buffer["rows"])
+
+    def stats(self):
+        """
+        :return: dict with batch count, rows per batch and time spent per flush (seconds)
+        """
+        with self.__lock:
+            stats = dict(self.__metrics)
+        batches = stats["batches"]
+        stats["avg_rows_per_batch"] = stats["rows"] / batches if batches else 0.0
+        stats["avg_flush_time"] = stats["flush_time"] / batches if batches else 0.0
+        return stats
+
+    def close(self, timeout=60):
+        """
+        Flushes the buffered rows and waits up to timeout seconds for the batches in flight, so that the session can be
+        closed right after. Raises CassandraConnectionException if any of them failed or did not complete in time.
+        """
+        self.__stopped.set()
+        self.__flusher.join()
+        with self.__lock:
+            failed_before = self.__metrics["failed_batches"]
+        self.flush()
+        with self.__idle:
+            drained = self.__idle.wait_for(lambda: not self.__inflight_batches, timeout)
+            inflight_batches = self.__inflight_batches
+            failed_batches = self.__metrics["failed_batches"] - failed_before
+        if not drained:
+            raise CassandraConnectionException(f"{inflight_batches} batch writes to {self.__full_table_name} still in "
+                                               f"flight after {timeout}s")
+        if failed_batches:
+            raise CassandraConnectionException(f"{failed_batches} batch writes to {self.__full_table_name} failed "
+                                               f"while closing")
+
+    """
+    ABSTRACTION
+    """
+
+    def __flush_periodically(self):
+        while not self.__stopped.wait(self.__flush_interval / 2):
+            expired = []
+            now = time.time()
+            with self.__lock:
+                for partition in list(self.__buffers):
+                    if now - self.__buffers[partition]["since"] >= self.__flush_interval:
+                        expired.append((partition, self.__buffers.pop(partition)))
+            for partition, buffer in expired:
+                self.__flush(partition, buffer["rows"])
+
+    def __flush(self, partition, rows):
+        start = time.time()
+        with self.__lock:
+            self.__inflight_batches += 1
+        try:
+            batch = BatchStatement(batch_type=BatchType.UNLOGGED)
+            for row_json, timestamp, callback, errback in rows:
+                if timestamp:
+                    statement = self.__cassandra_ctx.prepare(
+                        f"INSERT INTO {self.__full_table_name} JSON ? USING TIMESTAMP ?")
+                    batch.add(statement, (row_json, timestamp))
+                else:
+                    statement = self.__cassandra_ctx.prepare(f"INSERT INTO {self.__full_table_name} JSON ?")
+                    batch.add(statement, (row_json,))
+            batch.consistency_level = statement.consistency_level
+            self.__set_routing(batch, partition)
+            future = self.__cassandra_ctx.get_session().execute_async(batch)
+        except Exception as e:
+            self.__on_failure(CassandraConnectionException('Failed to execute batch write: {}'.format(str(e))), rows)
+            return
+        future.add_callbacks(callback=self.__on_success, callback_args=(rows, start),
+                             errback=self.__on_failure, errback_args=(rows,))
+
+    def __set_routing(self, batch, partition):
+        if None in partition:
+            return
+        try:
+            batch.routing_key = self.__routing_statement.bind(partition).routing_key
+            batch.keyspace = self.__keyspace
+        except Exception as e:
+            # Without a routing key the batch is still written, through the child load balancing policy
+            logging.warning(f"Could not compute routing key for partition {partition}: {e}")
+
+    def __on_success(self, result, rows, start):
+        flush_time = time.time() - start
+        with self.__lock:
+            self.__metrics["batches"] += 1
+            self.__metrics["rows"] += len(rows)
+            self.__metrics["max_rows_per_batch"] = max(self.__metrics["max_rows_per_batch"], len(rows))
+            self.__metrics["flush_time"] += flush_time
+            self.__metrics["max_flush_time"] = max(self.__metrics["max_flush_time"], flush_time)
+        try:
+            for row_json, timestamp, callback, errback in rows:
+                if callback:
+                    callback()
+        finally:
+            self.__settled()
+
+    def __on_failure(self, exception, rows):
+        logging.error(f"Batch write of {len(rows)} rows to {self.__full_table_name} failed: {exception}")
+        with self.__lock:
+            self.__metrics["failed_batches"] += 1
+        try:
+            for row_json, timestamp, callback, errback in rows:
+                if errback:
+                    errback(exception)
+        finally:
+            self.__settled()
+
+    def __settled(self):
+        # Once the callbacks of the rows have run, so that close() returns after them
+        with self.__idle:
+            self.__inflight_batches -= 1
+            self.__idle.notify_all()
@@ -2,34 +2,50 @@
 
 import logging
 import re
+import threading
 from cassandra import ConsistencyLevel, InvalidRequest, ReadTimeout, WriteTimeout
 from cassandra.cluster import Cluster
 from cassandra.auth import PlainTextAuthProvider
 from cassandra.query import SimpleStatement
-from cassandra.policies import RoundRobinPolicy
+from cassandra.policies import DCAwareRoundRobinPolicy, TokenAwarePolicy
+from cassandra.concurrent import execute_concurrent, execute_concurrent_with_args
 from core.exceptions.exceptions import CassandraContextNotInitializedException, CassandraConnectionException
 from core.exceptions.exceptions import CassandraInvalidRequestException
 from core.exceptions.exceptions import CassandraReadTimeoutException, CassandraWriteTimeoutException
 from core.exceptions.exceptions import CassandraInvalidReadCallException, CassandraInvalidWriteCallException
 
+SANITIZE_PATTERN = re.compile(r'\\+')
+
 
 class CassandraContext(object):
     """
     This class is not to be used in a Request-Response pattern (Open connection, Execute query, Close connection).
     Open one connection per application (container). Close the connection when application terminates.
+
+    Options:
+        auth: dict with 'username' and 'password'
+        read_consistency: ConsistencyLevel (or its name) used by exec_read. Default ONE
+        write_consistency: ConsistencyLevel (or its name) used by the write APIs. Default ALL
+        local_dc: the local datacenter for load balancing. Requests are routed token-aware to a replica of the
+                  partition (when the statement has a routing key), round-robin over the local datacenter otherwise
     """
 
     def __init__(self, seeds, **options):
         try:
+            self.__read_consistency = self.__consistency_level(options.pop("read_consistency", ConsistencyLevel.ONE))
+            self.__write_consistency = self.__consistency_level(options.pop("write_consistency", ConsistencyLevel.ALL))
+            self.__prepared = {}
+            self.__prepared_lock = threading.Lock()
+            load_balancing_policy = TokenAwarePolicy(DCAwareRoundRobinPolicy(local_dc=options.pop("local_dc", '')))
             auth = options.pop("auth", None)
             self.username = auth.get('username') if auth else None
             self.password = auth.get('password') if auth else None
             if auth:
                 auth_provider = PlainTextAuthProvider(username=self.username,
                                                       password=self.password)
-                self.__cluster = Cluster(seeds, auth_provider=auth_provider, load_balancing_policy=RoundRobinPolicy())
+                self.__cluster = Cluster(seeds, auth_provider=auth_provider, load_balancing_policy=load_balancing_policy)
             else:
-                self.__cluster = Cluster(seeds)
+                self.__cluster = Cluster(seeds, load_balancing_policy=load_balancing_policy)
             self.__session = self.__cluster.connect()
         except Exception as e:
             raise CassandraConnectionException('Failed to open Cassandra connection: {}'.format(str(e)))
@@ -50,12 +66,20 @@ class CassandraContext(object):
         """
         return self.__session
 
-    def exec_read(self, query, params=()):
+    def exec_read(self, query, params=(), prepared=False):
+        """
+        :param prepared: bind params to a cached prepared statement (with ? bind markers) instead of sending the query
+                         text (with %s placeholders)
+        """
         # upper is only to check
         if query[:6].upper() == 'SELECT':
             try:
-                q = SimpleStatement(query, consistency_level=ConsistencyLevel.ONE)
+                if prepared:
+                    return self.__session.execute(self.__bind(self.prepare(query), params, self.__read_consistency))
+                q = SimpleStatement(query, consistency_level=self.__read_consistency)
                 return self.__session.execute(q, params)
+            except CassandraInvalidRequestException as ire:
+                raise ire
             except InvalidRequest as ire:
                 raise CassandraInvalidRequestException('Invalid read request: {}'.format(str(ire)))
             except ReadTimeout as rte:
@@ -68,19 +92,18 @@ class CassandraContext(object):
         else:
             raise CassandraInvalidReadCallException('Please invoke exec_write method for INSERT/UPDATE/DELETE instead of exec_read.')
 
-    def exec_write(self, query, params=(), sanitize_query=True):
+    def exec_write(self, query, params=(), sanitize_query=True, prepared=False):
+        """
+        :param prepared: bind params to a cached prepared statement instead of sending the query text. Bound values are
+                         never sanitized, as they are not embedded in the query string.
+        """
         # upper is only to check
         if query[:6].upper() in {'INSERT', 'UPDATE', 'DELETE'}:
             try:
-                # Added due to kprofile, litigation documents where \\ was causing issue
-                # whilst using INSERT INTO {} JSON '{}'; syntax
-                if sanitize_query:
-                    s_query = self.__sanitize_query_string(query=query)
-                else:
-                    s_query = query
-
-                q = SimpleStatement(s_query, consistency_level=ConsistencyLevel.ALL)
-                return self.__session.execute(q, params)
+                return self.__session.execute(self.__write_statement(query, params, sanitize_query, prepared),
+                                              None if prepared else params)
+            except CassandraInvalidRequestException as ire:
+                raise ire
             except InvalidRequest as ire:
                 raise CassandraInvalidRequestException('Invalid write request: {}'.format(str(ire)))
             except WriteTimeout as wte:
@@ -93,6 +116,73 @@ class CassandraContext(object):
         else:
             raise CassandraInvalidWriteCallException('Please invoke exec_read method for SELECT instead of exec_write.')
 
+    def exec_write_async(self, query, params=(), sanitize_query=True, prepared=False):
+        """
+        Non-blocking exec_write. Returns the driver's ResponseFuture; the outcome of the write is delivered through the
+        future (result() or add_callbacks) so many writes can be in flight at once.
+        """
+        if query[:6].upper() in {'INSERT', 'UPDATE', 'DELETE'}:
+            try:
+                return self.__session.execute_async(self.__write_statement(query, params, sanitize_query, prepared),
+                                                    None if prepared else params)
+            except CassandraInvalidRequestException as ire:
+                raise ire
+            except Exception as e:
+                if not self.__cluster:
+                    raise CassandraContextNotInitializedException('CassandraContext is not initialized')
+                else:
+                    raise CassandraConnectionException('Failed to execute write request: {}'.format(str(e)))
+        else:
+            raise CassandraInvalidWriteCallException('Please invoke exec_read method for SELECT instead of exec_write.')
+
+    def exec_write_many(self, statement, rows, concurrency=50, consistency_level=None):
+        """
+        Writes many rows with one prepared statement, keeping up to `concurrency` requests in flight.
+        :param statement: CQL text with bind markers, e.g. "INSERT INTO ks.t JSON ?"
+        :param rows: iterable of parameter tuples, one per row
+        :param consistency_level: overrides the context's write consistency for this call
+        :return: list of (row_index, exception) for the rows that failed. Empty when every row was written.
+        """
+        if statement[:6].upper() in {'INSERT', 'UPDATE', 'DELETE'}:
+            try:
+                prepared_statement = self.prepare(statement)
+                consistency_level = self.__consistency_level(consistency_level)
+                if consistency_level is None or consistency_level == prepared_statement.consistency_level:
+                    results = execute_concurrent_with_args(self.__session, prepared_statement, rows,
+                                                           concurrency=concurrency, raise_on_first_error=False)
+                else:
+                    statements = ((self.__bind(prepared_statement, row, consistency_level), None) for row in rows)
+                    results = execute_concurrent(self.__session, statements,
+                                                 concurrency=concurrency, raise_on_first_error=False)
+                return [(index, result) for index, (success, result) in enumerate(results) if not success]
+            except CassandraInvalidRequestException as ire:
+                raise ire
+            except Exception as e:
+                if not self.__cluster:
+                    raise CassandraContextNotInitializedException('CassandraContext is not initialized')
+                else:
+                    raise CassandraConnectionException('Failed to execute write request: {}'.format(str(e)))
+        else:
+            raise CassandraInvalidWriteCallException('Please invoke exec_read method for SELECT instead of exec_write.')
+
+    def prepare(self, query):
+        """
+        Returns the prepared statement for a CQL text, preparing it on first use. Prepared statements are cached per
+        context, keyed by the CQL text, and default to the context's write consistency.
+        """
+        prepared_statement = self.__prepared.get(query)
+        if prepared_statement is None:
+            with self.__prepared_lock:
+                prepared_statement = self.__prepared.get(query)
+                if prepared_statement is None:
+                    try:
+                        prepared_statement = self.__session.prepare(query)
+                    except InvalidRequest as ire:
+                        raise CassandraInvalidRequestException('Invalid prepare request: {}'.format(str(ire)))
+                    prepared_statement.consistency_level = self.__write_consistency
+                    self.__prepared[query] = prepared_statement
+        return prepared_statement
+
     def close(self):
         try:
             if self.__cluster:
@@ -102,12 +192,36 @@ class CassandraContext(object):
         finally:
             self.__cluster = None
             self.__session = None
+            self.__prepared = {}
 
     """
     ABSTRACTION
     """
 
+    def __write_statement(self, query, params, sanitize_query, prepared):
+        if prepared:
+            return self.__bind(self.prepare(query), params, self.__write_consistency)
+        # Added due to kprofile, litigation documents where \\ was causing issue
+        # whilst using INSERT INTO {} JSON '{}'; syntax
+        if sanitize_query:
+            s_query = self.__sanitize_query_string(query=query)
+        else:
+            s_query = query
+        return SimpleStatement(s_query, consistency_level=self.__write_consistency)
+
+    @staticmethod
+    def __bind(prepared_statement, params, consistency_level):
+        bound_statement = prepared_statement.bind(params)
+        bound_statement.consistency_level = consistency_level
+        return bound_statement
+
+    @staticmethod
+    def __consistency_level(consistency_level):
+        if isinstance(consistency_level, str):
+            return ConsistencyLevel.name_to_value[consistency_level.upper()]
+        return consistency_level
+
     def __sanitize_query_string(self, query):
         # Replace more than one backslash with one backslash
-        s_query = re.sub(r'\\+', '\\\\', query)
+        s_query = SANITIZE_PATTERN.sub('\\\\', query)
         return s_query
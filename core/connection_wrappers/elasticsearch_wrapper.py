@@ -1,8 +1,10 @@
 #!/usr/bin/env python
 
 import logging
-import time
+from concurrent.futures import ThreadPoolExecutor
 from elasticsearch import Elasticsearch
+from elasticsearch.exceptions import RequestError, NotFoundError
+from elasticsearch.helpers import streaming_bulk
 
 from core.exceptions.exceptions import ElasticsearchContextNotInitializedException, ElasticsearchConnectionException
 
@@ -36,26 +38,187 @@ class ElasticsearchContext(object):
     def get_session(self):
         return self.__es
 
-    def create_index(self, index_name, no_of_shards, no_of_replicas, mapping_dct=None):
-        try:
-            settings = {
-                'settings': {
-                    'number_of_shards': no_of_shards,
-                    'number_of_replicas': no_of_replicas
-                }
-            }
-            if mapping_dct:
-                settings['mappings'] = mapping_dct
-            self.__es.indices.create(index=index_name, body=settings)
-            self.__es.indices.put_mapping(index=index_name, body=settings)
+    def create_index(self, index_name, no_of_shards, no_of_replicas, mapping_dct=None, wait_for_status='yellow',
+                     timeout=30):
+        """
+        Creates the index unless it exists, then waits until the cluster reports wait_for_status for it, at most
+        timeout seconds. "yellow" means the primary shards are allocated: the index accepts reads and writes.
+        :return: "created", "exists" (with a mapping that contains mapping_dct) or "updated" (the fields of
+                 mapping_dct missing from the existing index were added to its mapping)
+        """
+        result = self.__provision_index(index_name, no_of_shards, no_of_replicas, mapping_dct)
+        self.__wait_for_status([index_name], wait_for_status, timeout)
+        return result
+
+    def ensure_indices(self, indices, templates=None, wait_for_status='yellow', timeout=30, max_workers=8):
+        """
+        Idempotent provisioning of many indexes. The templates are put first, so that the indexes created next match
+        them, then the indexes are provisioned concurrently (as in create_index) and waited for together.
+        :param indices: dict {index_name: {"no_of_shards": ..., "no_of_replicas": ..., "mapping_dct": ...}}
+        :param templates: dict {template_name: template body (index_patterns, settings, mappings)}
+        :return: dict {index or template name: "created", "exists" or "updated"}
+        """
+        results = {}
+        with ThreadPoolExecutor(max_workers=max_workers, thread_name_prefix='es-provision') as executor:
+            futures = {name: executor.submit(self.__put_template, name, body)
+                       for name, body in (templates or {}).items()}
+            results.update({name: future.result() for name, future in futures.items()})
+            futures = {name: executor.submit(self.__provision_index, name, spec.get('no_of_shards', 1),
+                                             spec.get('no_of_replicas', 1), spec.get('mapping_dct'))
+                       for name, spec in indices.items()}
+            results.update({name: future.result() for name, future in futures.items()})
+        self.__wait_for_status(list(indices), wait_for_status, timeout)
+        return results
 
-            time.sleep(30)
+    def bulk(self, actions, chunk_size=500, max_chunk_bytes=10 * 1024 * 1024, max_retries=3, initial_backoff=1,
+             max_backoff=30):
+        """
+        Sends actions through the _bulk API, chunk_size actions (or max_chunk_bytes) per request. Items rejected with
+        429 (the write thread pool queue of a node is full) are retried up to max_retries times with exponential
+        backoff, the other item failures are returned instead of raised.
+        :param actions: iterable of bulk actions, e.g. {"_index": ..., "_id": ..., "_source": {...}}
+        :return: (number of succeeded items, list of failed items as returned by Elasticsearch, e.g.
+                 {"index": {"_id": ..., "status": 400, "error": {...}}}). The failed items do not carry the documents
+                 sent, callers that need them must look them up by "_id"
+        """
+        succeeded = 0
+        failed = []
+        try:
+            for ok, item in streaming_bulk(self.__es, actions, chunk_size=chunk_size, max_chunk_bytes=max_chunk_bytes,
+                                           max_retries=max_retries, initial_backoff=initial_backoff,
+                                           max_backoff=max_backoff, raise_on_error=False):
+                if ok:
+                    succeeded += 1
+                else:
+                    failed.append(item)
         except Exception as e:
             if not self.__es:
                 raise ElasticsearchContextNotInitializedException('ElasticsearchContext is not initialized')
             else:
-                raise ElasticsearchConnectionException('Failed to create index: {}'.format(str(e)))
+                raise ElasticsearchConnectionException('Bulk request failed: {}'.format(str(e)))
+        return succeeded, failed
+
+    def get_refresh_interval(self, index_name):
+        """
+        :return: the refresh_interval set on the index, or None if it uses the default
+        """
+        try:
+            settings = self.__es.indices.get_settings(index=index_name, name='index.refresh_interval')
+        except Exception as e:
+            raise ElasticsearchConnectionException('Failed to read index settings: {}'.format(str(e)))
+        # Keyed by the concrete index name, which differs from index_name when it is an alias
+        for index_settings in settings.values():
+            return index_settings.get('settings', {}).get('index', {}).get('refresh_interval')
+        return None
+
+    def set_refresh_interval(self, index_name, interval):
+        """
+        :param interval: e.g. "1s", "-1" to disable refreshes, None to restore the default
+        """
+        try:
+            self.__es.indices.put_settings(index=index_name, body={'index': {'refresh_interval': interval}})
+        except Exception as e:
+            raise ElasticsearchConnectionException('Failed to update index settings: {}'.format(str(e)))
+
+    def refresh(self, index_name):
+        try:
+            self.__es.indices.refresh(index=index_name)
+        except Exception as e:
+            raise ElasticsearchConnectionException('Failed to refresh index: {}'.format(str(e)))
 
     def close(self):
         # Elasticsearch has no corresponding close method
         pass
+
+    """
+    ABSTRACTION
+    """
+
+    def __provision_index(self, index_name, no_of_shards, no_of_replicas, mapping_dct):
+        body = {
+            'settings': {
+                'number_of_shards': no_of_shards,
+                'number_of_replicas': no_of_replicas
+            }
+        }
+        if mapping_dct:
+            body['mappings'] = mapping_dct
+        try:
+            try:
+                self.__es.indices.create(index=index_name, body=body)
+                return 'created'
+            except RequestError as e:
+                if e.error != 'resource_already_exists_exception':
+                    raise
+            if not mapping_dct:
+                return 'exists'
+            # Keyed by the concrete index name, which differs from index_name when it is an alias
+            current = self.__es.indices.get_mapping(index=index_name)
+            if all(_contains(index_mapping.get('mappings', {}), mapping_dct) for index_mapping in current.values()):
+                return 'exists'
+            # Only adds fields, a mapping that conflicts with the existing one is rejected
+            self.__es.indices.put_mapping(index=index_name, body=mapping_dct)
+            return 'updated'
+        except Exception as e:
+            if not self.__es:
+                raise ElasticsearchContextNotInitializedException('ElasticsearchContext is not initialized')
+            else:
+                raise ElasticsearchConnectionException('Failed to create index {}: {}'.format(index_name, str(e)))
+
+    def __put_template(self, template_name, body):
+        try:
+            try:
+                current = self.__es.indices.get_template(name=template_name)
+            except NotFoundError:
+                current = {}
+            if template_name in current and _contains(current[template_name], _nest_settings(body)):
+                return 'exists'
+            self.__es.indices.put_template(name=template_name, body=body)
+            return 'updated' if current else 'created'
+        except Exception as e:
+            if not self.__es:
+                raise ElasticsearchContextNotInitializedException('ElasticsearchContext is not initialized')
+            else:
+                raise ElasticsearchConnectionException('Failed to put template {}: {}'.format(template_name, str(e)))
+
+    def __wait_for_status(self, index_names, wait_for_status, timeout):
+        if not index_names:
+            return
+        try:
+            health = self.__es.cluster.health(index=','.join(index_names), wait_for_status=wait_for_status,
+                                              timeout='{}s'.format(timeout), request_timeout=timeout + 10)
+        except Exception as e:
+            raise ElasticsearchConnectionException('Failed to read cluster health: {}'.format(str(e)))
+        if health.get('timed_out'):
+            raise ElasticsearchConnectionException('Indexes {} did not reach {} status within {}s, status is {}'.format(
+                index_names, wait_for_status, timeout, health.get('status')))
+
+
+def _nest_settings(body):
+    """
+    Elasticsearch returns the settings of a template nested under "index", whether they were set as "number_of_shards",
+    "index.number_of_shards" or {"index": {"number_of_shards": ...}}.
+    """
+    if 'settings' not in body:
+        return body
+    index_settings = {}
+    for key, value in body['settings'].items():
+        if key == 'index':
+            index_settings.update(value)
+        else:
+            index_settings[key[len('index.'):] if key.startswith('index.') else key] = value
+    return dict(body, settings={'index': index_settings})
+
+
+def _contains(current, expected):
+    """
+    Whether the settings or mapping returned by Elasticsearch contain the expected ones. Elasticsearch returns scalar
+    values as strings ("true", "1"), so scalars are compared as strings.
+    """
+    if isinstance(expected, dict):
+        return isinstance(current, dict) and all(key in current and _contains(current[key], value)
+                                                 for key, value in expected.items())
+    if isinstance(expected, list):
+        return isinstance(current, list) and len(current) == len(expected) and \
+            all(_contains(c, e) for c, e in zip(current, expected))
+    return str(current).lower() == str(expected).lower()
@@ -1,23 +1,35 @@
 #!/usr/bin/env python
 
 import json
+import time
 import logging
-import random
-import requests
 import socket
+import threading
+import requests
+from requests.adapters import HTTPAdapter
+from urllib3.exceptions import NewConnectionError, ConnectTimeoutError
 
 from core.exceptions.exceptions import JanusGraphNoHostAvailableException, JanusGraphConnectionException
 from core.exceptions.exceptions import JanusGraphRequestTimeoutException, JanusGraphResponseException
 
+# Iterates a traversal returned by a packed query, so that it runs before the next query of the batch
+_ITERATE = "def __iterate = { it instanceof org.apache.tinkerpop.gremlin.process.traversal.Traversal ? it.toList() : it }"
 
 
 class JanusGraphContext(object):
     """
     This class is not to be used in a Request-Response pattern (Open connection, Execute query, Close connection).
     Open one connection per application (container). Close the connection when application terminates.
+
+    Requests are balanced over the healthy servers, round robin or to the server with the lowest recent latency
+    (balancing="least_latency"), through a pooled HTTP session per server. A server that refuses a connection is
+    marked unhealthy and the request is sent to another one. Unhealthy servers are probed in the background every
+    health_check_interval seconds and re-admitted once they accept connections again.
     """
 
     def __init__(self, seeds, **options):
+        self.__closed = threading.Event()
+        self.__sessions = {}
         try:
             # Creds
             auth = options.pop("auth", None)
@@ -26,16 +38,35 @@ class JanusGraphContext(object):
             self.auth_header = None
             if auth:
                 self.auth_header = requests.auth.HTTPBasicAuth(self.username, self.password)
+            self.__port = options.pop("port", 8182)
+            self.__timeout = options.pop("timeout", 30)
+            self.__connect_timeout = options.pop("connect_timeout", 3)
+            self.__balancing = options.pop("balancing", "round_robin")
+            self.__health_check_interval = options.pop("health_check_interval", 5)
+            pool_size = options.pop("pool_size", 10)
+            if self.__balancing not in {"round_robin", "least_latency"}:
+                raise ValueError('Unknown balancing: {}'.format(self.__balancing))
+
+            self.__lock = threading.Lock()
+            self.__sessions = {server: self.__open_session(pool_size) for server in seeds}
+            # Moving average of the request latency of every server, in seconds
+            self.__latencies = {server: 0.0 for server in seeds}
+            self.__next = 0
+
             # Available servers
-            self.__servers = set(seeds)
+            self.__servers = [server for server in seeds if self.__probe(server)]
 
             # Not Available servers
-            self.__na_servers = set()
+            self.__na_servers = set(seeds) - set(self.__servers)
 
-            self.__servers, self.__na_servers, self.__curr_server = \
-                self.__select_server(servers=self.__servers, na_servers=self.__na_servers)
+            if not self.__servers:
+                raise JanusGraphNoHostAvailableException('No JanusGraph hosts available')
+            if self.__na_servers:
+                logging.warning('JanusGraph hosts not available: {}'.format(sorted(self.__na_servers)))
 
-            self.__url = 'http://{}:8182'.format(self.__curr_server)
+            self.__health_checker = threading.Thread(target=self.__check_health, daemon=True,
+                                                     name='janusgraph-health-check')
+            self.__health_checker.start()
         except JanusGraphNoHostAvailableException as hue:
             raise hue
         except Exception as e:
@@ -56,47 +87,161 @@ class JanusGraphContext(object):
         :param query: Type dict which contains 'gremlin' query string, and 'bindings' dict
         :return:
         """
-        try:
-            if self.auth_header:
-                response = requests.post(self.__url, data=json.dumps(query),
-                                         headers={'content-type': 'application/json'}, auth=self.auth_header)
-            else:
-                response = requests.post(self.__url, data=json.dumps(query), headers={'content-type': 'application/json'})
-            response.raise_for_status()
+        tried = set()
+        while True:
+            server = self.__select_server(exclude=tried)
+            tried.add(server)
+            start = time.time()
+            try:
+                response = self.__sessions[server].post('http://{}:{}'.format(server, self.__port),
+                                                        data=json.dumps(query),
+                                                        timeout=(self.__connect_timeout, self.__timeout))
+            except requests.exceptions.ConnectionError as ce:
+                self.__mark_unavailable(server, ce)
+                # Only a request that was never sent is safe to send to another server
+                if not _is_not_sent(ce) or not self.__has_untried_server(tried):
+                    raise JanusGraphConnectionException('Failed to execute query: {}'.format(str(ce)))
+                continue
+            except requests.exceptions.Timeout as te:
+                raise JanusGraphRequestTimeoutException('JanusGraph request timed out: {}'.format(str(te)))
+            self.__record_latency(server, time.time() - start)
+            try:
+                response.raise_for_status()
+            except requests.exceptions.HTTPError as he:
+                try:
+                    response_content = json.loads(response.content)
+                    details = 'Exception-class: {}. JG-Message: {}'.format(
+                        str(response_content.get('Exception-Class')), str(response_content.get('message')))
+                except ValueError:
+                    details = 'JG-Message: {}'.format(response.text)
+                raise JanusGraphResponseException('Response exception: {}. {}'.format(str(he), details))
             return response
-        except requests.exceptions.HTTPError as he:
-            # TODO: what if above fails and response line did not execute properly and we do not have response initialized there
-            response_content = json.loads(response.content)
-            raise JanusGraphResponseException('Response exception: {}. Exception-class: {}. JG-Message: {}'.format(
-                str(he), str(response_content['Exception-Class']), str(response_content['message'])))
-        except requests.exceptions.ConnectionError as ce:
-            self.__servers.remove(self.__curr_server)
-            self.__na_servers.add(self.__curr_server)
-            self.__servers, self.__na_servers, self.__curr_server = \
-                self.__select_server(servers=self.__servers, na_servers=self.__na_servers)
-            raise JanusGraphConnectionException('Failed to execute query: {}'.format(str(ce)))
-        except requests.exceptions.Timeout as te:
-            raise JanusGraphRequestTimeoutException('JanusGraph request timed out: {}'.format(str(te)))
+
+    def execute_many(self, queries, batch_size=100):
+        """
+        Sends the queries batch_size at a time, each batch as a single script: every query becomes a closure whose
+        parameters are its bindings, called with the bindings renamed apart from the other queries' ("_<i>_<name>").
+        The queries of a batch run in order, in one transaction: if one fails, the whole batch is rolled back and
+        JanusGraphResponseException is raised. Batches of queries with the same scripts produce the same packed
+        script, which the server compiles once.
+        :param queries: list of dicts with a 'gremlin' query string and an optional 'bindings' dict
+        :return: list with the result data of every query
+        """
+        results = []
+        for start in range(0, len(queries), batch_size):
+            batch = queries[start:start + batch_size]
+            response = self.execute(self.pack(batch))
+            results.extend(from_graphson(response.json()['result']['data']) or [])
+        return results
+
+    @staticmethod
+    def pack(queries):
+        """
+        :return: the query executing all the queries, see execute_many
+        """
+        calls = []
+        bindings = {}
+        for index, query in enumerate(queries):
+            names = list(query.get('bindings') or {})
+            arguments = []
+            for name in names:
+                packed_name = '_{}_{}'.format(index, name)
+                bindings[packed_name] = query['bindings'][name]
+                arguments.append(packed_name)
+            calls.append('__iterate({{ {} -> {} }}({}))'.format(', '.join(names), query['gremlin'],
+                                                                  ', '.join(arguments)))
+        return {'gremlin': '{}\n[{}]'.format(_ITERATE, ',\n'.join(calls)), 'bindings': bindings}
+
+    def healthy_servers(self):
+        with self.__lock:
+            return list(self.__servers)
 
     def close(self):
-        self.__servers = None
-        self.__na_servers = None
-        self.__curr_server = None
-        self.__url = None
+        self.__closed.set()
+        for session in self.__sessions.values():
+            session.close()
+        self.__servers = []
+        self.__na_servers = set()
 
     """
     Abstraction
     """
 
-    def __select_server(self, servers, na_servers):
-        sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
-        while servers:
-            server = random.sample(servers, 1)[0]
-            result = sock.connect_ex((server, 8182))
-            if result == 0:
-                return servers, na_servers, server
-            else:
-                servers.remove(server)
-                na_servers.add(server)
-
-        raise JanusGraphNoHostAvailableException('No JanusGraph hosts available')
+    def __open_session(self, pool_size):
+        session = requests.Session()
+        adapter = HTTPAdapter(pool_connections=1, pool_maxsize=pool_size)
+        session.mount('http://', adapter)
+        session.headers.update({'content-type': 'application/json'})
+        if self.auth_header:
+            session.auth = self.auth_header
+        return session
+
+    def __select_server(self, exclude=()):
+        with self.__lock:
+            candidates = [server for server in self.__servers if server not in exclude]
+            if not candidates:
+                raise JanusGraphNoHostAvailableException('No JanusGraph hosts available')
+            if self.__balancing == "least_latency":
+                return min(candidates, key=lambda server: self.__latencies[server])
+            self.__next += 1
+            return candidates[self.__next % len(candidates)]
+
+    def __has_untried_server(self, tried):
+        with self.__lock:
+            return any(server not in tried for server in self.__servers)
+
+    def __record_latency(self, server, latency):
+        with self.__lock:
+            self.__latencies[server] = 0.8 * self.__latencies[server] + 0.2 * latency
+
+    def __mark_unavailable(self, server, error):
+        with self.__lock:
+            if server in self.__servers:
+                self.__servers.remove(server)
+                self.__na_servers.add(server)
+                logging.warning('JanusGraph host {} is not available: {}'.format(server, str(error)))
+
+    def __check_health(self):
+        while not self.__closed.wait(self.__health_check_interval):
+            with self.__lock:
+                na_servers = list(self.__na_servers)
+            for server in na_servers:
+                if self.__probe(server):
+                    with self.__lock:
+                        self.__na_servers.discard(server)
+                        # Starts from the latency of the fastest server, so least_latency does not flood it
+                        self.__latencies[server] = min(self.__latencies.values())
+                        self.__servers.append(server)
+                    logging.info('JanusGraph host {} is available again'.format(server))
+
+    def __probe(self, server):
+        # A new socket per probe, a socket cannot connect twice
+        try:
+            with socket.create_connection((server, self.__port), timeout=self.__connect_timeout):
+                return True
+        except OSError:
+            return False
+
+
+def _is_not_sent(connection_error):
+    if isinstance(connection_error, requests.exceptions.ConnectTimeout):
+        return True
+    reason = getattr(connection_error.args[0], 'reason', None) if connection_error.args else None
+    return isinstance(reason, (NewConnectionError, ConnectTimeoutError))
+
+
+def from_graphson(value):
+    """
+    Strips the types of a GraphSON 2/3 value (e.g. {"@type": "g:Int64", "@value": 4136}), so results read the same
+    whichever GraphSON version the server serializes with.
+    """
+    if isinstance(value, list):
+        return [from_graphson(item) for item in value]
+    if not isinstance(value, dict):
+        return value
+    if '@type' not in value:
+        return {key: from_graphson(item) for key, item in value.items()}
+    typed_value = value.get('@value')
+    if value['@type'] == 'g:Map':
+        return {from_graphson(typed_value[i]): from_graphson(typed_value[i + 1]) for i in range(0, len(typed_value), 2)}
+    return from_graphson(typed_value)
@@ -0,0 +1,185 @@
+#!/usr/bin/env python
+
+import json
+import logging
+
+try:
+    import orjson
+except ImportError:
+    orjson = None
+
+try:
+    import msgpack
+except ImportError:
+    msgpack = None
+
+from core.exceptions.exceptions import KafkaInvalidRequestException, KafkaConsumerException
+
+'''
+Serialization of Kafka message values. The producer records the codec of every message in the CODEC_HEADER header,
+and consumers decode each message with the codec it names, so producers can switch codecs without coordinating with
+their consumers and topics holding a mix of codecs keep working. Messages without the header are JSON.
+
+A codec name identifies a wire format, not a library: "json" is written and read with orjson when it is installed and
+with the stdlib json module otherwise. Producers fall back to "json" when the library of the requested codec is not
+installed. Consumers cannot fall back, so a message whose codec is not available raises.
+
+Codecs:
+* json
+* msgpack (requires msgpack)
+* mc_incident.v1+<json|msgpack>: compact positional encoding of the mc_incident envelope (see SchemaCodec), serialized
+  with msgpack when available
+'''
+
+CODEC_HEADER = "codec"
+DEFAULT_CODEC = "json"
+
+
+class JsonCodec(object):
+    name = "json"
+
+    @staticmethod
+    def encode(obj):
+        if orjson is not None:
+            try:
+                return orjson.dumps(obj, option=orjson.OPT_NON_STR_KEYS)
+            except TypeError:
+                # e.g. integers beyond 64 bits, which the stdlib serializes
+                pass
+        return json.dumps(obj).encode('utf-8')
+
+    @staticmethod
+    def decode(data):
+        if orjson is not None:
+            return orjson.loads(data)
+        return json.loads(data)
+
+
+class MsgpackCodec(object):
+    name = "msgpack"
+
+    @staticmethod
+    def encode(obj):
+        return msgpack.packb(obj, use_bin_type=True)
+
+    @staticmethod
+    def decode(data):
+        return msgpack.unpackb(data, raw=False)
+
+
+class SchemaCodec(object):
+    """
+    Encodes documents of a known shape positionally: the keys of the schema are not written, only a bitmask of the
+    fields present followed by their values in schema order. Fields that are not in the schema (or a nested field
+    whose value is not a document) are kept in a trailing dict, so every document round-trips, only less compactly.
+
+    A schema is a tuple of field names, or of (field name, nested schema) for nested documents.
+    """
+
+    def __init__(self, schema_name, schema, inner_codec):
+        self.name = f"{schema_name}+{inner_codec.name}"
+        self.__schema = schema
+        self.__inner_codec = inner_codec
+
+    def encode(self, obj):
+        return self.__inner_codec.encode(self.__pack(obj, self.__schema))
+
+    def decode(self, data):
+        return self.__unpack(self.__inner_codec.decode(data), self.__schema)
+
+    def __pack(self, dct, schema):
+        mask = 0
+        packed = [0]
+        extras = dict(dct)
+        for index, field in enumerate(schema):
+            name, nested_schema = field if isinstance(field, tuple) else (field, None)
+            if name not in extras:
+                continue
+            if nested_schema is not None and not isinstance(extras[name], dict):
+                continue
+            value = extras.pop(name)
+            mask |= 1 << index
+            packed.append(self.__pack(value, nested_schema) if nested_schema is not None else value)
+        packed[0] = mask
+        packed.append(extras or None)
+        return packed
+
+    def __unpack(self, packed, schema):
+        mask = packed[0]
+        position = 1
+        dct = {}
+        for index, field in enumerate(schema):
+            if not mask & (1 << index):
+                continue
+            name, nested_schema = field if isinstance(field, tuple) else (field, None)
+            value = packed[position]
+            dct[name] = self.__unpack(value, nested_schema) if nested_schema is not None else value
+            position += 1
+        if packed[position]:
+            dct.update(packed[position])
+        return dct
+
+
+MC_INCIDENT_SCHEMA = (
+    "doc_type",
+    "user_id",
+    "__key",
+    ("meta", ("producer_process_type", "producer_process_id", "timestamp")),
+    ("payload", (
+        ("node", ("id", "uuid", "title", "tables", "created_time", "type", "sub_types", "priority", "status", "project",
+                  "dataset", "incident_type")),
+        "mc_dw_id",
+        "user_id",
+        ("warehouse_info", ("uuid", "id", "created_on", "connection_type", "name")),
+        "timestamp"
+    ))
+)
+
+CODECS = {
+    "json": JsonCodec(),
+    "mc_incident.v1+json": SchemaCodec("mc_incident.v1", MC_INCIDENT_SCHEMA, JsonCodec())
+}
+if msgpack is not None:
+    CODECS["msgpack"] = MsgpackCodec()
+    CODECS["mc_incident.v1+msgpack"] = SchemaCodec("mc_incident.v1", MC_INCIDENT_SCHEMA, MsgpackCodec())
+
+# Short names a producer can ask for, best available wire format first
+PREFERENCES = {
+    "msgpack": ("msgpack",),
+    "mc_incident": ("mc_incident.v1+msgpack", "mc_incident.v1+json")
+}
+
+
+def get_codec(name):
+    """
+    Producer side lookup of a codec name, or of a short name from PREFERENCES. A short name falls back to json when
+    none of its codecs is available.
+    """
+    if name in PREFERENCES:
+        for candidate in PREFERENCES[name]:
+            if candidate in CODECS:
+                return CODECS[candidate]
+        logging.warning(f"Codec {name} is not available, falling back to {DEFAULT_CODEC}")
+        return CODECS[DEFAULT_CODEC]
+    if name in CODECS:
+        return CODECS[name]
+    raise KafkaInvalidRequestException(f"Codec not available: {name}")
+
+
+def codec_headers(codec):
+    return [(CODEC_HEADER, codec.name.encode('utf-8'))]
+
+
+def decode_message(message):
+    """
+    Decodes the value of a confluent_kafka Message with the codec named in its header (json if it has none).
+    """
+    codec_name = DEFAULT_CODEC
+    for key, value in message.headers() or ():
+        if key == CODEC_HEADER:
+            codec_name = value.decode('utf-8')
+            break
+    codec = CODECS.get(codec_name)
+    if codec is None:
+        raise KafkaConsumerException(f"Cannot decode message with codec {codec_name}: codec not available")
+    return codec.decode(message.value())
@@ -0,0 +1,277 @@
+#!/usr/bin/env python
+
+import os
+import time
+import queue
+import logging
+import threading
+import multiprocessing
+from functools import partial
+from concurrent.futures import Future
+
+from core.exceptions.exceptions import KafkaConsumerException
+
+
+class PartitionWorkerRuntime(object):
+    """
+    Runs a record handler over a KafkaConsumerContext with partition-level parallelism, inside a single consumer group
+    member:
+
+    * mode="thread": every assigned partition gets its own worker thread. Suited to I/O bound handlers.
+    * mode="process": a pool of `workers` processes (default: one per core), every partition is pinned to one of them
+      (partition % workers). Suited to CPU bound handlers. The handler (and the optional initializer, run once in each
+      process, e.g. to open its own connections) must be importable module-level functions, and receive the records
+      pickled. Processes are spawned, not forked, as forking a process that runs librdkafka threads is unsafe.
+
+    Records of a partition are handled one at a time, in offset order. A record is acknowledged once its handler
+    returns and offsets are committed by the consumer context (see KafkaConsumerContext.consume_records). In thread
+    mode a handler that hands the record over to an asynchronous stage (e.g. a batching writer) can return a Future
+    instead: the handler is then called for the next record right away, and the record is acknowledged once the Future
+    completes. If the handler raises (or its Future fails), on_error(record, exception) is called and the record is
+    acknowledged. Without on_error the runtime stops without acknowledging it, so it is consumed again after a restart.
+
+    With header_filter, only the records whose headers match it are handled, the others are acknowledged as they are
+    consumed (see KafkaConsumerContext.consume_records). With decode=False (thread mode only) the value of the records
+    is the undecoded confluent_kafka Message, for handlers that decode elsewhere. on_poll(), if given, is called on the
+    consuming thread after every consume, for the periodic work of the service.
+
+    A partition with max_queued records in flight is paused until half of them are done, so a slow partition neither
+    grows memory nor holds back the others. When partitions are revoked the runtime waits (up to drain_timeout) for
+    their in-flight records before the consumer context commits them.
+    """
+
+    def __init__(self, consumer_ctx, handler, mode="thread", workers=None, max_queued=1000, drain_timeout=30,
+                 on_error=None, initializer=None, header_filter=None, on_poll=None, decode=True):
+        if mode not in {"thread", "process"}:
+            raise ValueError(f"Unknown runtime mode: {mode}")
+        if mode == "process" and not decode:
+            raise ValueError("Undecoded records cannot be sent to worker processes")
+        self.__consumer_ctx = consumer_ctx
+        self.__handler = handler
+        self.__mode = mode
+        self.__workers = workers or os.cpu_count() or 1
+        self.__max_queued = max_queued
+        self.__drain_timeout = drain_timeout
+        self.__on_error = on_error
+        self.__initializer = initializer
+        self.__header_filter = header_filter
+        self.__on_poll = on_poll
+        self.__decode = decode
+
+        self.__lock = threading.Condition()
+        # (topic, partition) -> number of dispatched records not done yet
+        self.__inflight = {}
+        self.__paused = set()
+        self.__stopped = threading.Event()
+        self.__failure = None
+        # thread mode: (topic, partition) -> (queue, thread)
+        self.__partition_workers = {}
+        # process mode
+        self.__processes = []
+        self.__process_queues = []
+        self.__results = None
+        self.__collector = None
+
+        consumer_ctx.set_rebalance_callbacks(on_assign=self.__on_assign, on_revoke=self.__on_revoke)
+
+    """
+    API
+    """
+
+    def run(self):
+        if self.__mode == "process":
+            self.__start_processes()
+        try:
+            while not self.__stopped.is_set() and self.__failure is None:
+                for record in self.__consumer_ctx.consume_records(header_filter=self.__header_filter,
+                                                                   decode=self.__decode):
+                    self.__dispatch(record)
+                self.__resume_drained_partitions()
+                self.__check_processes()
+                if self.__on_poll:
+                    self.__on_poll()
+            if self.__failure is not None:
+                raise KafkaConsumerException(f"Record handler failed, stopping the runtime: {self.__failure}")
+        finally:
+            self.close()
+
+    def stop(self):
+        """
+        Makes run() return after the current consume. Safe to call from a signal handler or another thread.
+        """
+        self.__stopped.set()
+
+    def close(self):
+        """
+        Waits for the in-flight records, stops the workers and commits what was processed.
+        """
+        self.__stopped.set()
+        self.__wait_for(list(self.__inflight), self.__drain_timeout)
+        for work_queue, thread in self.__partition_workers.values():
+            work_queue.put(None)
+        for work_queue, thread in self.__partition_workers.values():
+            thread.join()
+        self.__partition_workers = {}
+        if self.__processes:
+            for work_queue in self.__process_queues:
+                work_queue.put(None)
+            for process in self.__processes:
+                process.join()
+            self.__results.put(None)
+            self.__collector.join()
+            self.__processes = []
+        self.__consumer_ctx.commit_processed(is_asynchronous_commit=False)
+
+    """
+    ABSTRACTION
+    """
+
+    def __dispatch(self, record):
+        partition = (record.topic, record.partition)
+        with self.__lock:
+            self.__inflight[partition] = self.__inflight.get(partition, 0) + 1
+            pause = self.__inflight[partition] >= self.__max_queued and partition not in self.__paused
+            if pause:
+                self.__paused.add(partition)
+        if pause:
+            self.__consumer_ctx.pause([partition])
+
+        if self.__mode == "process":
+            self.__process_queues[record.partition % self.__workers].put(record)
+        else:
+            worker = self.__partition_workers.get(partition)
+            if worker is None:
+                work_queue = queue.Queue()
+                thread = threading.Thread(target=self.__partition_worker, args=(work_queue,), daemon=True,
+                                          name=f"partition-{record.topic}-{record.partition}")
+                thread.start()
+                worker = self.__partition_workers[partition] = (work_queue, thread)
+            worker[0].put(record)
+
+    def __partition_worker(self, work_queue):
+        while True:
+            record = work_queue.get()
+            if record is None:
+                return
+            if self.__failure is not None:
+                # Stopping: leave the remaining records unacknowledged, they are consumed again after a restart
+                self.__done(record, acknowledge=False)
+                continue
+            try:
+                result = self.__handler(record)
+            except Exception as e:
+                self.__handle_failure(record, e)
+                continue
+            if isinstance(result, Future):
+                result.add_done_callback(partial(self.__on_handled, record))
+            else:
+                self.__done(record, acknowledge=True)
+
+    def __on_handled(self, record, future):
+        if future.exception() is not None:
+            self.__handle_failure(record, future.exception())
+        else:
+            self.__done(record, acknowledge=True)
+
+    def __handle_failure(self, record, exception):
+        if self.__on_error is None:
+            logging.error(f"Failed to handle {record.topic}[{record.partition}]@{record.offset}: {exception}")
+            self.__failure = exception
+            self.__done(record, acknowledge=False)
+            return
+        try:
+            self.__on_error(record, exception)
+            self.__done(record, acknowledge=True)
+        except Exception as e:
+            logging.error(f"on_error failed for {record.topic}[{record.partition}]@{record.offset}: {e}")
+            self.__failure = e
+            self.__done(record, acknowledge=False)
+
+    def __done(self, record, acknowledge):
+        if acknowledge:
+            self.__consumer_ctx.ack(record)
+        partition = (record.topic, record.partition)
+        with self.__lock:
+            # A partition is forgotten when revoked, even if the drain timed out
+            if partition in self.__inflight:
+                self.__inflight[partition] -= 1
+            self.__lock.notify_all()
+
+    def __resume_drained_partitions(self):
+        with self.__lock:
+            drained = [partition for partition in self.__paused
+                       if self.__inflight.get(partition, 0) <= self.__max_queued // 2]
+            self.__paused.difference_update(drained)
+        if drained:
+            self.__consumer_ctx.resume(drained)
+
+    def __wait_for(self, partitions, timeout):
+        deadline = time.time() + timeout
+        with self.__lock:
+            while any(self.__inflight.get(partition, 0) for partition in partitions):
+                remaining = deadline - time.time()
+                if remaining <= 0 or (self.__failure is not None and self.__stopped.is_set()):
+                    logging.warning(f"Gave up waiting for in-flight records of {partitions}")
+                    return
+                self.__lock.wait(min(remaining, 1))
+
+    def __on_assign(self, partitions):
+        logging.info(f"Assigned partitions: {partitions}")
+
+    def __on_revoke(self, partitions):
+        logging.info(f"Revoked partitions, draining: {partitions}")
+        self.__wait_for(partitions, self.__drain_timeout)
+        with self.__lock:
+            for partition in partitions:
+                self.__inflight.pop(partition, None)
+                self.__paused.discard(partition)
+        for partition in partitions:
+            worker = self.__partition_workers.pop(partition, None)
+            if worker:
+                worker[0].put(None)
+
+    def __start_processes(self):
+        context = multiprocessing.get_context("spawn")
+        self.__results = context.Queue()
+        for _ in range(self.__workers):
+            work_queue = context.Queue()
+            process = context.Process(target=_process_worker,
+                                      args=(work_queue, self.__results, self.__handler, self.__initializer),
+                                      daemon=True)
+            process.start()
+            self.__process_queues.append(work_queue)
+            self.__processes.append(process)
+        self.__collector = threading.Thread(target=self.__collect_results, daemon=True)
+        self.__collector.start()
+
+    def __check_processes(self):
+        for process in self.__processes:
+            if not process.is_alive():
+                self.__failure = KafkaConsumerException(f"Worker process {process.pid} exited with code "
+                                                        f"{process.exitcode}")
+
+    def __collect_results(self):
+        while True:
+            result = self.__results.get()
+            if result is None:
+                return
+            record, error = result
+            if error is None:
+                self.__done(record, acknowledge=True)
+            else:
+                self.__handle_failure(record, error)
+
+
+def _process_worker(work_queue, results, handler, initializer):
+    if initializer:
+        initializer()
+    while True:
+        record = work_queue.get()
+        if record is None:
+            return
+        try:
+            handler(record)
+            results.put((record, None))
+        except Exception as e:
+            # The exception may not be picklable
+            results.put((record, Exception(f"{type(e).__name__}: {e}")))
@@ -1,16 +1,64 @@
 #!/usr/bin/env python
 
-import json
+import time
 import logging
+import threading
+from functools import partial
+from collections import OrderedDict, deque, namedtuple
 
 from confluent_kafka import Producer
 from confluent_kafka import Consumer
 from confluent_kafka import KafkaError
+from confluent_kafka import TopicPartition
 
 from core.exceptions.exceptions import KafkaProducerContextNotInitializedException
 from core.exceptions.exceptions import KafkaConsumerContextNotInitializedException
 from core.exceptions.exceptions import KafkaConnectionException, KafkaInvalidRequestException
 from core.exceptions.exceptions import KafkaProducerException, KafkaConsumerException
+from core.connection_wrappers.kafka_codecs import DEFAULT_CODEC, get_codec, codec_headers, decode_message
+
+# A consumed message with its position. value is the decoded message, or the confluent_kafka Message itself when
+# consumed with decode=False
+KafkaRecord = namedtuple("KafkaRecord", ["topic", "partition", "offset", "key", "value"])
+
+# Envelope fields copied into message headers by the producer, so consumers can route messages without decoding them
+ROUTING_FIELDS = ("doc_type", "user_id")
+
+
+# librdkafka settings of the producer profiles. Explicit constructor arguments override the profile.
+PRODUCER_PROFILES = {
+    # One request in flight, so retries cannot reorder messages
+    'default': {
+        'batch.num.messages': 100,
+        'linger.ms': 5,
+        'acks': -1,
+        'max.in.flight': 1,
+        'retries': 3,
+        'retry.backoff.ms': 5000
+    },
+    # Idempotence keeps ordering (and removes retry duplicates) with several requests in flight
+    'low_latency': {
+        'enable.idempotence': True,
+        'batch.num.messages': 100,
+        'linger.ms': 0,
+        'acks': -1,
+        'max.in.flight': 5,
+        'retries': 3,
+        'retry.backoff.ms': 100,
+        'compression.codec': 'lz4'
+    },
+    'bulk': {
+        'enable.idempotence': True,
+        'batch.num.messages': 10000,
+        'linger.ms': 50,
+        'queue.buffering.max.messages': 500000,
+        'acks': -1,
+        'max.in.flight': 5,
+        'retries': 3,
+        'retry.backoff.ms': 500,
+        'compression.codec': 'zstd'
+    }
+}
 
 
 class KafkaProducerContext(object):
@@ -18,32 +66,57 @@ class KafkaProducerContext(object):
     REF:
     https://docs.confluent.io/4.1.2/clients/confluent-kafka-python/#producer
     https://github.com/edenhill/librdkafka/blob/master/CONFIGURATION.md
+
+    Message values are serialized with `codec`, or with doc_type_codecs[doc_type] for the doc types listed there
+    (e.g. {"mc_incident": "mc_incident"}). See kafka_codecs for the available codecs. The ROUTING_FIELDS of the message
+    are also written as headers.
+
+    `profile` selects the librdkafka settings from PRODUCER_PROFILES. Delivery is asynchronous: failed deliveries are
+    counted in stats() and kept (the latest max_delivery_errors of them) for delivery_errors(), and on_delivery, if
+    given, is called with (err, msg) for every message. Check them after flush() before treating messages as delivered.
+    A callback passed to produce() is called the same way for that message only, e.g. to track the deliveries of one
+    unit of work among others produced concurrently.
     """
 
     def __init__(self,
                  seeds,
-                 batch_num_messages=100,
-                 linger_ms=5,
-                 acks=-1,
-                 max_in_flight=1,
-                 retries=3,
+                 batch_num_messages=None,
+                 linger_ms=None,
+                 acks=None,
+                 max_in_flight=None,
+                 retries=None,
                  message_max_bytes=16777216,
-                 retry_backoff_ms=5000):
+                 retry_backoff_ms=None,
+                 codec=DEFAULT_CODEC,
+                 doc_type_codecs=None,
+                 profile='default',
+                 buffer_timeout=60,
+                 max_delivery_errors=1000,
+                 on_delivery=None):
 
         try:
-            config = {
-                'bootstrap.servers': ",".join(seeds),
+            config = dict(PRODUCER_PROFILES[profile])
+            overrides = {
                 'batch.num.messages': batch_num_messages,
                 'linger.ms': linger_ms,
                 'acks': acks,
                 'max.in.flight': max_in_flight,
                 'retries': retries,
-                'message.max.bytes': message_max_bytes,
                 'retry.backoff.ms': retry_backoff_ms
             }
+            config.update({key: value for key, value in overrides.items() if value is not None})
+            config['bootstrap.servers'] = ",".join(seeds)
+            config['message.max.bytes'] = message_max_bytes
             self.__producer = Producer(config)
         except Exception as e:
             raise KafkaConnectionException('Failed to open Kafka connection: {}'.format(str(e)))
+        self.__codec = get_codec(codec)
+        self.__doc_type_codecs = {doc_type: get_codec(name) for doc_type, name in (doc_type_codecs or {}).items()}
+        self.__buffer_timeout = buffer_timeout
+        self.__on_delivery = on_delivery
+        self.__stats_lock = threading.Lock()
+        self.__stats = {"produced": 0, "delivered": 0, "failed": 0, "buffer_full_waits": 0}
+        self.__delivery_errors = deque(maxlen=max_delivery_errors)
 
     def __del__(self):
         try:
@@ -55,30 +128,35 @@ class KafkaProducerContext(object):
     API
     """
 
-    def produce(self, topic, msg_payload, msg_key=None):
-
-        def ack(err, msg):
-            """
-            Called once for each message produced to indicate delivery result. Triggered by poll() or flush().
-            """
-            if err is not None:
-                error_message = "Error= " + str(msg.error()) + "|" + \
-                                "Record= " + str(msg.value()) + "|" + \
-                                "Topic= " + str(msg.topic())
-
-                error_message = "ERROR" + ":" + "KafkaProducerException" + ":" + error_message
-                raise KafkaProducerException(error_message)
-
+    def produce(self, topic, msg_payload, msg_key=None, on_delivery=None):
+        """
+        :param on_delivery: (optional) called with (err, msg) once the delivery of this message is settled
+        """
         try:
             if isinstance(msg_payload, dict):
-                message = json.dumps(msg_payload)
+                codec = self.__doc_type_codecs.get(msg_payload.get("doc_type"), self.__codec)
+                message = codec.encode(msg_payload)
+                headers = codec_headers(codec)
+                for field in ROUTING_FIELDS:
+                    if isinstance(msg_payload.get(field), str):
+                        headers.append((field, msg_payload[field].encode('utf-8')))
+                deadline = None
                 while True:
                     try:
-                        self.__producer.produce(topic=topic, value=message.encode('utf-8'), key=msg_key, callback=ack)
+                        self.__producer.produce(topic=topic, value=message, key=msg_key, headers=headers,
+                                                callback=partial(self.__ack, on_delivery=on_delivery))
                         self.__producer.poll(0)
                         break
-                    except BufferError as be:
-                        self.__producer.poll(1)
+                    except BufferError:
+                        # The local queue is full: serve delivery reports until there is room again
+                        deadline = deadline or time.time() + self.__buffer_timeout
+                        if time.time() >= deadline:
+                            raise KafkaProducerException('Producer queue full for {}s'.format(self.__buffer_timeout))
+                        with self.__stats_lock:
+                            self.__stats["buffer_full_waits"] += 1
+                        self.__producer.poll(0.05)
+                with self.__stats_lock:
+                    self.__stats["produced"] += 1
             else:
                 raise KafkaInvalidRequestException('Invalid produce request')
         except KafkaInvalidRequestException as ire:
@@ -91,6 +169,23 @@ class KafkaProducerContext(object):
             else:
                 raise KafkaConnectionException('Failed to produce: {}'.format(str(e)))
 
+    def stats(self):
+        """
+        :return: dict of counters: produced, delivered, failed (deliveries) and buffer_full_waits
+        """
+        with self.__stats_lock:
+            return dict(self.__stats)
+
+    def delivery_errors(self, clear=True):
+        """
+        :return: list of the latest failed deliveries, as dicts with topic, partition, key, error and value
+        """
+        with self.__stats_lock:
+            errors = list(self.__delivery_errors)
+            if clear:
+                self.__delivery_errors.clear()
+            return errors
+
     def flush(self):
         try:
             self.__producer.flush()
@@ -109,12 +204,42 @@ class KafkaProducerContext(object):
         finally:
             self.__producer = None
 
+    """
+    ABSTRACTION
+    """
+
+    def __ack(self, err, msg, on_delivery=None):
+        """
+        Called once for each message produced to indicate delivery result. Triggered by poll() or flush(), so it must
+        not raise: an exception raised here would be lost.
+        """
+        with self.__stats_lock:
+            if err is None:
+                self.__stats["delivered"] += 1
+            else:
+                self.__stats["failed"] += 1
+                self.__delivery_errors.append({"topic": msg.topic(), "partition": msg.partition(), "key": msg.key(),
+                                               "error": str(err), "value": msg.value()})
+        if err is not None:
+            logging.error("ERROR:KafkaProducerException:Error= {}|Topic= {}".format(str(err), msg.topic()))
+        if self.__on_delivery:
+            self.__on_delivery(err, msg)
+        if on_delivery:
+            on_delivery(err, msg)
+
 
 class KafkaConsumerContext(object):
     """
     REF:
     https://docs.confluent.io/4.1.2/clients/confluent-kafka-python/#consumer
     https://github.com/edenhill/librdkafka/blob/master/CONFIGURATION.md
+
+    Records returned by consume_records() are tracked until they are acknowledged with ack(record), which may happen
+    out of order and on any thread. The highest contiguous acknowledged offset of every partition is committed
+    asynchronously from consume_records() every commit_interval seconds, as soon as commit_every records were
+    acknowledged since the last commit, or as soon as a consume returns nothing, so an idle consumer does not hold back
+    the commit of work acknowledged since. Messages that consume_records() skips count as acknowledged records. Call
+    commit_processed() before closing to commit synchronously.
     """
 
     def __init__(self,
@@ -125,7 +250,9 @@ class KafkaConsumerContext(object):
                  timeout=1,
                  auto_offset_reset='smallest',
                  is_enable_auto_commit=False,
-                 max_poll_interval_ms=300000):
+                 max_poll_interval_ms=300000,
+                 commit_interval=5,
+                 commit_every=1000):
         try:
             config = {
                 'bootstrap.servers': ",".join(seeds),
@@ -147,6 +274,12 @@ class KafkaConsumerContext(object):
             self.__timeout = timeout
         except Exception as e:
             raise KafkaConnectionException('Failed to open Kafka connection: {}'.format(str(e)))
+        self.__tracker = OffsetTracker()
+        self.__commit_interval = commit_interval
+        self.__commit_every = commit_every
+        self.__acks_lock = threading.Lock()
+        self.__acks_since_commit = 0
+        self.__last_commit = time.time()
 
     def __del__(self):
         try:
@@ -177,9 +310,7 @@ class KafkaConsumerContext(object):
                     if message.error().code() != KafkaError._PARTITION_EOF:
                         raise KafkaConsumerException('Kafka Consumer exception: {}'.format(str(message.error())))
                 else:
-                    decoded_message = message.value().decode('utf-8')
-                    dct = json.loads(decoded_message)
-                    dcts.append(dct)
+                    dcts.append(decode_message(message))
 
             return dcts
         except Exception as e:
@@ -188,6 +319,208 @@ class KafkaConsumerContext(object):
             else:
                 raise KafkaConnectionException('Kafka consumption exception: {}'.format(str(e)))
 
+    def consume_messages(self):
+        """
+        Same as consume, but returns the raw confluent_kafka Message objects without decoding them, so the caller has
+        access to topic/partition/offset and can decode elsewhere (e.g. on a worker pool) with kafka_codecs.decode_message.
+        """
+        try:
+            valid_messages = []
+
+            messages = self.__consumer.consume(self.__num_messages, self.__timeout)
+            for message in messages:
+                if message is None:
+                    continue
+
+                if message.error():
+                    if message.error().code() != KafkaError._PARTITION_EOF:
+                        raise KafkaConsumerException('Kafka Consumer exception: {}'.format(str(message.error())))
+                else:
+                    valid_messages.append(message)
+
+            return valid_messages
+        except Exception as e:
+            if not self.__consumer:
+                raise KafkaConsumerContextNotInitializedException('KafkaConsumerContext is not initialized')
+            else:
+                raise KafkaConnectionException('Kafka consumption exception: {}'.format(str(e)))
+
+    def consume_records(self, header_filter=None, decode=True, on_decode_error=None):
+        """
+        :param header_filter: (optional) dict {header: value or set of accepted values}, see consume_filtered. Messages
+                              that do not match are acknowledged without being decoded or returned
+        :param decode: False to leave the decoding to the caller (e.g. on a worker pool): the value of the records is
+                       then the confluent_kafka Message, to decode with kafka_codecs.decode_message
+        :param on_decode_error: (optional) called with (message, exception) for every message that cannot be decoded,
+                                e.g. to produce it to a dead letter topic. It must not raise. Such messages are
+                                acknowledged without being returned, so they do not hold back the commits of their
+                                partition, and are logged if on_decode_error is not given
+        :return: list of KafkaRecord. Every record is tracked until ack(record) is called for it
+        """
+        accepted = _accepted_values(header_filter) if header_filter else None
+        records = []
+        skipped = 0
+        for message in self.consume_messages():
+            # Tracked in consumption order, so a skipped message never makes an earlier record committable
+            self.__tracker.track(message.topic(), message.partition(), message.offset())
+            try:
+                is_match, value = _match(message, accepted) if accepted else (True, None)
+                if not decode:
+                    value = message
+                elif is_match and value is None:
+                    value = decode_message(message)
+            except Exception as e:
+                is_match = False
+                if on_decode_error:
+                    on_decode_error(message, e)
+                else:
+                    logging.error('Skipping {}[{}]@{}, it cannot be decoded: {}'.format(
+                        message.topic(), message.partition(), message.offset(), str(e)))
+            if not is_match:
+                self.__tracker.ack(message.topic(), message.partition(), message.offset())
+                skipped += 1
+                continue
+            records.append(KafkaRecord(message.topic(), message.partition(), message.offset(), message.key(), value))
+        if skipped:
+            # Counted like acknowledged records, so a partition that only carries skipped messages is committed too
+            with self.__acks_lock:
+                self.__acks_since_commit += skipped
+        self.__commit_if_due(idle=not records)
+        return records
+
+    def ack(self, record):
+        """
+        Marks a record returned by consume_records as processed. Thread-safe.
+        """
+        self.__tracker.ack(record.topic, record.partition, record.offset)
+        with self.__acks_lock:
+            self.__acks_since_commit += 1
+
+    def commit_processed(self, is_asynchronous_commit=False):
+        """
+        Commits, per partition, the offset after the highest contiguous acknowledged record.
+        """
+        with self.__acks_lock:
+            self.__acks_since_commit = 0
+        self.__last_commit = time.time()
+        self.commit_offsets(self.__tracker.committable(), is_asynchronous_commit=is_asynchronous_commit)
+
+    def set_rebalance_callbacks(self, on_assign=None, on_revoke=None):
+        """
+        Registers callbacks for partition assignment changes. Both are called with a list of (topic, partition), on the
+        thread that consumes, before the consume call that triggered the rebalance returns. on_revoke should wait for
+        the in-flight records of the revoked partitions: once it returns, the acknowledged records are committed
+        synchronously and the revoked partitions are no longer tracked. Must be called before the first consume.
+        """
+        def assigned(consumer, partitions):
+            if on_assign:
+                on_assign([(tp.topic, tp.partition) for tp in partitions])
+
+        def revoked(consumer, partitions):
+            revoked_partitions = [(tp.topic, tp.partition) for tp in partitions]
+            if on_revoke:
+                on_revoke(revoked_partitions)
+            self.commit_processed(is_asynchronous_commit=False)
+            self.__tracker.forget(revoked_partitions)
+
+        try:
+            self.__consumer.subscribe([self.__topic], on_assign=assigned, on_revoke=revoked)
+        except Exception as e:
+            raise KafkaConnectionException('Kafka consumer subscribe exception: {}'.format(str(e)))
+
+    def pending_records(self):
+        """
+        :return: number of records returned by consume_records that are not acknowledged yet
+        """
+        return self.__tracker.pending_count()
+
+    def consume_filtered(self, header_filter, raw=False, on_skip=None):
+        """
+        Consumes only the messages whose headers match header_filter. Messages that do not match are skipped without
+        being decoded. Messages from producers that did not write the headers are decoded and matched on their fields.
+        :param header_filter: dict {header: value or set of accepted values}, e.g. {"doc_type": "mc_incident"}
+        :param raw: return the matching confluent_kafka Message objects undecoded (their value() is the consumed
+                    bytes, not a copy) instead of the decoded dicts
+        :param on_skip: called with every skipped Message, e.g. to acknowledge its offset
+        """
+        accepted = _accepted_values(header_filter)
+        matching = []
+        for message in self.consume_messages():
+            is_match, dct = _match(message, accepted)
+            if not is_match:
+                if on_skip:
+                    on_skip(message)
+            elif raw:
+                matching.append(message)
+            else:
+                matching.append(dct if dct is not None else decode_message(message))
+        return matching
+
+    def commit_offsets(self, offsets, is_asynchronous_commit=False):
+        """
+        :param offsets: dict {(topic, partition): offset} where offset is the offset of the next message to consume,
+                        as returned by OffsetTracker.committable()
+        """
+        if not offsets:
+            return
+        try:
+            partitions = [TopicPartition(topic, partition, offset) for (topic, partition), offset in offsets.items()]
+            self.__consumer.commit(offsets=partitions, asynchronous=is_asynchronous_commit)
+        except Exception as e:
+            if not self.__consumer:
+                raise KafkaConsumerContextNotInitializedException('KafkaConsumerContext is not initialized')
+            else:
+                raise KafkaConnectionException('Kafka consumer commit exception: {}'.format(str(e)))
+
+    def assignment(self):
+        """
+        :return: list of (topic, partition) currently assigned to this consumer
+        """
+        try:
+            return [(tp.topic, tp.partition) for tp in self.__consumer.assignment()]
+        except Exception as e:
+            if not self.__consumer:
+                raise KafkaConsumerContextNotInitializedException('KafkaConsumerContext is not initialized')
+            else:
+                raise KafkaConnectionException('Kafka consumer assignment exception: {}'.format(str(e)))
+
+    def pause(self, partitions):
+        """
+        Stops fetching from the given partitions without leaving the consumer group.
+        :param partitions: iterable of (topic, partition)
+        """
+        try:
+            self.__consumer.pause([TopicPartition(topic, partition) for topic, partition in partitions])
+        except Exception as e:
+            if not self.__consumer:
+                raise KafkaConsumerContextNotInitializedException('KafkaConsumerContext is not initialized')
+            else:
+                raise KafkaConnectionException('Kafka consumer pause exception: {}'.format(str(e)))
+
+    def resume(self, partitions):
+        """
+        :param partitions: iterable of (topic, partition)
+        """
+        try:
+            self.__consumer.resume([TopicPartition(topic, partition) for topic, partition in partitions])
+        except Exception as e:
+            if not self.__consumer:
+                raise KafkaConsumerContextNotInitializedException('KafkaConsumerContext is not initialized')
+            else:
+                raise KafkaConnectionException('Kafka consumer resume exception: {}'.format(str(e)))
+
+    def seek(self, topic, partition, offset):
+        """
+        Rewinds (or forwards) a partition, so the next fetch starts at offset.
+        """
+        try:
+            self.__consumer.seek(TopicPartition(topic, partition, offset))
+        except Exception as e:
+            if not self.__consumer:
+                raise KafkaConsumerContextNotInitializedException('KafkaConsumerContext is not initialized')
+            else:
+                raise KafkaConnectionException('Kafka consumer seek exception: {}'.format(str(e)))
+
     def commit(self, is_asynchronous_commit=False):
         try:
             self.__consumer.commit(asynchronous=is_asynchronous_commit)
@@ -211,4 +544,83 @@ class KafkaConsumerContext(object):
             self.__num_messages = None
             self.__timeout = None
 
+    """
+    ABSTRACTION
+    """
+
+    def __commit_if_due(self, idle=False):
+        with self.__acks_lock:
+            acks_since_commit = self.__acks_since_commit
+        if acks_since_commit and (idle or acks_since_commit >= self.__commit_every or
+                                  time.time() - self.__last_commit >= self.__commit_interval):
+            self.commit_processed(is_asynchronous_commit=True)
+
+
+def _accepted_values(header_filter):
+    return {header: {value.encode('utf-8') for value in ([values] if isinstance(values, str) else values)}
+            for header, values in header_filter.items()}
+
 
+def _match(message, accepted):
+    """
+    Matches a message on its headers, or on its decoded fields if its producer did not write the headers.
+    :return: (is_match, the decoded message if it had to be decoded, else None)
+    """
+    headers = dict(message.headers() or ())
+    if all(header in headers for header in accepted):
+        return all(headers[header] in values for header, values in accepted.items()), None
+    dct = decode_message(message)
+    return all(str(dct.get(header)).encode('utf-8') in values for header, values in accepted.items()), dct
+
+
+class OffsetTracker(object):
+    """
+    Tracks in-flight messages per partition for services that process messages out of order (worker pools,
+    asynchronous writes). An offset only becomes committable once it and every offset before it in its partition
+    have been acknowledged, so a commit never covers unfinished work.
+    """
+
+    def __init__(self):
+        self.__lock = threading.Lock()
+        # (topic, partition) -> OrderedDict(offset -> acknowledged), in consumption order
+        self.__pending = {}
+        self.__committable = {}
+
+    def track(self, topic, partition, offset):
+        with self.__lock:
+            self.__pending.setdefault((topic, partition), OrderedDict())[offset] = False
+
+    def ack(self, topic, partition, offset):
+        with self.__lock:
+            offsets = self.__pending.get((topic, partition))
+            if offsets is None or offset not in offsets:
+                return
+            offsets[offset] = True
+            while offsets:
+                first_offset = next(iter(offsets))
+                if not offsets[first_offset]:
+                    break
+                del offsets[first_offset]
+                self.__committable[(topic, partition)] = first_offset + 1
+
+    def committable(self):
+        """
+        :return: dict {(topic, partition): offset} of the partitions that advanced since the last call
+        """
+        with self.__lock:
+            committable, self.__committable = self.__committable, {}
+            return committable
+
+    def pending_count(self):
+        with self.__lock:
+            return sum(len(offsets) for offsets in self.__pending.values())
+
+    def forget(self, partitions):
+        """
+        Drops the state of partitions that are no longer assigned.
+        :param partitions: iterable of (topic, partition)
+        """
+        with self.__lock:
+            for partition in partitions:
+                self.__pending.pop(partition, None)
+                self.__committable.pop(partition, None)
@@ -1,5 +1,21 @@
 #!/usr/bin/env python
 
+import operator as op
+
+try:
+    import numpy as np
+except ImportError:
+    np = None
+
+COMPARATORS = {
+    "equals": op.eq,
+    "gte": op.ge,
+    "gt": op.gt,
+    "lte": op.le,
+    "lt": op.lt,
+    "not_equals": op.ne
+}
+
 def standard_annotation(value, annotation, operator, threshold, mode="dynamic"):
     if mode.lower() == "static":
         return annotation
@@ -19,3 +35,31 @@ def standard_annotation(value, annotation, operator, threshold, mode="dynamic"):
             return annotation if value != threshold else None
 
 
+def standard_annotation_batch(values, annotation, operator, threshold, mode="dynamic"):
+    '''
+    Columnar standard_annotation. When NumPy is available and the column is homogeneous (all strings for equality
+    checks, all ints or all floats for any comparison) the comparison runs as a single vectorized operation.
+    :param values: list, the values extracted at the annotation path across a batch
+    :return: list, the annotation or None for every value
+    '''
+    if mode.lower() == "static":
+        return [annotation] * len(values)
+    compare = COMPARATORS.get(operator)
+    if mode.lower() != "dynamic" or compare is None:
+        return [None] * len(values)
+
+    matches = _vectorized_compare(values, compare, threshold)
+    if matches is None:
+        matches = [compare(value, threshold) for value in values]
+    return [annotation if match else None for match in matches]
+
+
+def _vectorized_compare(values, compare, threshold):
+    threshold_type = type(threshold)
+    if np is None or not values or threshold_type not in (str, int, float):
+        return None
+    if threshold_type is str and compare not in (op.eq, op.ne):
+        return None
+    if not all(type(value) is threshold_type for value in values):
+        return None
+    return compare(np.array(values), threshold).tolist()
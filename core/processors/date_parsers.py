@@ -0,0 +1,131 @@
+#!/usr/bin/env python
+
+import threading
+from collections import OrderedDict
+from datetime import datetime
+from dateutil.parser import parse
+
+'''
+Format-inferring date parser used by the date_format transform when no source_format is configured.
+
+Timestamps from the same feed share a layout, e.g. Monte Carlo createdTime values all look like
+"2023-01-02T10:11:12.123456+00:00". The layout of a value is its shape with every digit replaced by "9". The first time
+a layout is seen the value is parsed with dateutil and every candidate fast parser (datetime.fromisoformat, then
+strptime with the known formats) is checked against that result. The first candidate that agrees is cached for the
+layout, so later values of the same layout skip dateutil. Layouts that no candidate reproduces are cached as
+dateutil-only.
+'''
+
+DEFAULT_CACHE_SIZE = 256
+
+STRPTIME_FORMATS = (
+    "%Y-%m-%dT%H:%M:%S.%f%z",
+    "%Y-%m-%dT%H:%M:%S%z",
+    "%Y-%m-%dT%H:%M:%S.%fZ",
+    "%Y-%m-%dT%H:%M:%SZ",
+    "%Y-%m-%d %H:%M:%S.%f",
+    "%Y-%m-%d %H:%M:%S",
+    "%Y/%m/%d %H:%M:%S",
+    "%Y/%m/%d",
+    "%m/%d/%Y %H:%M:%S",
+    "%m/%d/%Y",
+    "%d %b %Y %H:%M:%S",
+    "%d %b %Y",
+    "%a, %d %b %Y %H:%M:%S %z",
+    "%a, %d %b %Y %H:%M:%S GMT",
+    "%b %d %Y %H:%M:%S",
+    "%Y%m%dT%H%M%S",
+    "%Y%m%d"
+)
+
+_LAYOUT_TABLE = str.maketrans("0123456789", "9999999999")
+
+
+def _strptime_parser(date_format):
+    def parser(value):
+        return datetime.strptime(value, date_format)
+    return parser
+
+
+CANDIDATE_PARSERS = [datetime.fromisoformat] + [_strptime_parser(date_format) for date_format in STRPTIME_FORMATS]
+
+
+def _same_datetime(first, second):
+    return first == second and first.utcoffset() == second.utcoffset() and first.tzname() == second.tzname()
+
+
+class CachingDateParser(object):
+    '''
+    Thread-safe parser with a bounded LRU of layout -> fast parser. A cached parser that cannot handle a value of its
+    layout (e.g. day 13 in a month-first layout) falls back to dateutil for that value.
+    '''
+
+    def __init__(self, max_size=DEFAULT_CACHE_SIZE):
+        self.__max_size = max_size
+        self.__parsers = OrderedDict()
+        self.__lock = threading.Lock()
+        self.__hits = 0
+        self.__misses = 0
+        self.__fallbacks = 0
+
+    def parse(self, value):
+        layout = value.translate(_LAYOUT_TABLE)
+        with self.__lock:
+            found = layout in self.__parsers
+            if found:
+                parser = self.__parsers[layout]
+                self.__parsers.move_to_end(layout)
+                self.__hits += 1
+            else:
+                self.__misses += 1
+
+        if not found:
+            return self.__learn(layout, value)
+        if parser is not None:
+            try:
+                return parser(value)
+            except ValueError:
+                pass
+        with self.__lock:
+            self.__fallbacks += 1
+        return parse(value)
+
+    def stats(self):
+        '''
+        :return: dict with hit/miss counters, the number of dateutil fallbacks on hits and the cached layout count
+        '''
+        with self.__lock:
+            lookups = self.__hits + self.__misses
+            return {
+                "hits": self.__hits,
+                "misses": self.__misses,
+                "fallbacks": self.__fallbacks,
+                "hit_rate": self.__hits / lookups if lookups else 0.0,
+                "layouts": len(self.__parsers)
+            }
+
+    def clear(self):
+        with self.__lock:
+            self.__parsers.clear()
+            self.__hits = 0
+            self.__misses = 0
+            self.__fallbacks = 0
+
+    def __learn(self, layout, value):
+        datetime_obj = parse(value)
+        fast_parser = None
+        for candidate in CANDIDATE_PARSERS:
+            try:
+                if _same_datetime(candidate(value), datetime_obj):
+                    fast_parser = candidate
+                    break
+            except ValueError:
+                continue
+        with self.__lock:
+            self.__parsers[layout] = fast_parser
+            while len(self.__parsers) > self.__max_size:
+                self.__parsers.popitem(last=False)
+        return datetime_obj
+
+
+DATE_PARSER = CachingDateParser()
@@ -0,0 +1,461 @@
+#!/usr/bin/env python
+
+import copy
+import hashlib
+import json
+import time
+import logging
+import threading
+from collections import OrderedDict
+
+from processor_registry import TRANSFORMATION_REGISTRY, DERIVATION_REGISTRY, ANNOTATION_REGISTRY, VALIDATION_REGISTRY
+from processor_registry import BATCH_TRANSFORMATION_REGISTRY, BATCH_VALIDATION_REGISTRY, BATCH_ANNOTATION_REGISTRY
+from core.exceptions.exceptions import FieldMapperException, ValidationFailedException
+
+'''
+Compiled execution plans for the GenericFieldMapper.
+
+A config is interpreted once into an ExecutionPlan: paths are tokenized, actions are resolved from the registries and
+the rules of each stage are arranged in a path trie so that a subtree shared by several rules is walked once per
+document. Plans are cached by the hash of their config, so every document that uses the same config reuses the plan.
+'''
+
+PLAN_CACHE_SIZE = 128
+
+# (config key, action key, registry, columnar registry, label used in error messages)
+STAGES = (
+    ("transformations", "transformation", TRANSFORMATION_REGISTRY, BATCH_TRANSFORMATION_REGISTRY, "Transformation"),
+    ("derivations", "derivation", DERIVATION_REGISTRY, {}, "Derivation"),
+    ("validations", "validation", VALIDATION_REGISTRY, BATCH_VALIDATION_REGISTRY, "Validation"),
+    ("annotations", "annotation", ANNOTATION_REGISTRY, BATCH_ANNOTATION_REGISTRY, "Annotation")
+)
+
+
+class CompiledRule(object):
+    __slots__ = ("index", "key", "path", "path_tokens", "name", "action", "batch_action", "params")
+
+    def __init__(self, index, path, name, action, params, batch_action=None, stage=None):
+        self.index = index
+        # Identifies the rule in timings and logs, e.g. "transformations[0] change_case node.status"
+        self.key = f"{stage}[{index}] {name} {path}"
+        self.path = path
+        self.path_tokens = tokenize_path(path)
+        self.name = name
+        self.action = action
+        self.batch_action = batch_action
+        self.params = params
+
+    def apply_column(self, values):
+        '''
+        Applies the rule to a column of values gathered across documents. Actions without a columnar implementation
+        are mapped over the column.
+        '''
+        if self.batch_action:
+            return self.batch_action(values, **self.params)
+        return [self.action(value, **self.params) for value in values]
+
+
+class PathNode(object):
+    __slots__ = ("name", "is_list", "children", "child_nodes", "rules")
+
+    def __init__(self, name, is_list):
+        self.name = name
+        self.is_list = is_list
+        self.children = OrderedDict()
+        # The values of children, kept as a tuple for the per-document walks
+        self.child_nodes = ()
+        self.rules = []
+
+
+def tokenize_path(path):
+    '''
+    Splits a dotted path into (key, is_list) tokens. "foo.bar[].baz" -> [("foo", False), ("bar", True), ("baz", False)]
+    :param path: str, the dotted path of a rule
+    :return: tuple
+    '''
+    tokens = []
+    for token in path.split("."):
+        if token.endswith("[]"):
+            tokens.append((token[:-2], True))
+        else:
+            tokens.append((token, False))
+    return tuple(tokens)
+
+
+def _conflicts(tokens, other_tokens):
+    '''
+    Two mutating rules can share a walk only if neither path is a strict prefix of the other and they do not address
+    the same key once as a list and once as a value. Otherwise their relative order matters.
+    '''
+    for (name, is_list), (other_name, other_is_list) in zip(tokens, other_tokens):
+        if name != other_name:
+            return False
+        if is_list != other_is_list:
+            return True
+    return len(tokens) != len(other_tokens)
+
+
+def _insert(root, rule):
+    node = root
+    for name, is_list in rule.path_tokens:
+        key = (name, is_list)
+        if key not in node.children:
+            node.children[key] = PathNode(name, is_list)
+            node.child_nodes = tuple(node.children.values())
+        node = node.children[key]
+    node.rules.append(rule)
+
+
+def _build_walks(rules):
+    '''
+    Packs the ordered rules of a mutating stage into as few tries as possible without reordering dependent rules.
+    :param rules: list, CompiledRule in config order
+    :return: list of PathNode roots
+    '''
+    walks = []
+    root, walk_rules = None, []
+    for rule in rules:
+        if root is None or any(_conflicts(rule.path_tokens, other.path_tokens) for other in walk_rules):
+            root, walk_rules = PathNode(None, False), []
+            walks.append(root)
+        _insert(root, rule)
+        walk_rules.append(rule)
+    return walks
+
+
+def _build_trie(rules):
+    root = PathNode(None, False)
+    for rule in rules:
+        _insert(root, rule)
+    return root
+
+
+def _apply_walk(dct, nodes):
+    '''
+    Applies the rules of a trie to a document, mirroring the semantics of the per-rule path parser.
+    :param dct: dict, the container at the current level
+    :param nodes: iterable, PathNode children of the current level
+    :return: dict
+    '''
+    if not dct and not isinstance(dct, bool):
+        return dct
+    for node in nodes:
+        name = node.name
+        if node.is_list:
+            dct[name] = _apply_items(dct.get(name, ()), node)
+        elif name in dct:
+            if node.child_nodes:
+                dct[name] = _apply_walk(dct[name], node.child_nodes)
+            else:
+                value = dct[name]
+                for rule in node.rules:
+                    value = rule.action(value, **rule.params)
+                dct[name] = value
+    return dct
+
+
+def _apply_items(items, node):
+    '''
+    Applies a list node to the items of a list. Items walked by child nodes are documents updated in place, so their
+    list is kept as it is rather than rebuilt. Only a list whose items are replaced by the rules is copied, which also
+    leaves a list the caller still holds untouched.
+    '''
+    if not node.children:
+        return [_apply_node(item, node) for item in items]
+    if not isinstance(items, list):
+        items = list(items)
+    children = node.child_nodes
+    for item in items:
+        _apply_walk(item, children)
+    return items
+
+
+def _apply_node(value, node):
+    if node.child_nodes:
+        return _apply_walk(value, node.child_nodes)
+    for rule in node.rules:
+        value = rule.action(value, **rule.params)
+    return value
+
+
+def _iter_walk(dct, nodes):
+    '''
+    Read-only, lazy counterpart of _apply_walk. Yields (node, value) for every value addressed by a rule of the trie,
+    in document order, straight from the document: no list is built on the way.
+    '''
+    if not dct and not isinstance(dct, bool):
+        return
+    for node in nodes:
+        if node.is_list:
+            for item in dct.get(node.name, ()):
+                if node.rules:
+                    yield node, item
+                if node.child_nodes:
+                    yield from _iter_walk(item, node.child_nodes)
+        elif node.name in dct:
+            value = dct[node.name]
+            if node.rules:
+                yield node, value
+            if node.child_nodes:
+                yield from _iter_walk(value, node.child_nodes)
+
+
+def _gather_slots(dct, nodes, slots):
+    '''
+    Collects the (container, key) slots addressed by the terminal nodes of a trie, so that the rules of a node can be
+    applied to the whole column of values at once and written back. Lists on the way are treated as in _apply_items:
+    a list of values is copied before its slots are taken, a list of documents is kept.
+    :param slots: dict, PathNode -> list of (container, key)
+    '''
+    if not dct and not isinstance(dct, bool):
+        return
+    for node in nodes:
+        if node.is_list:
+            items = dct.get(node.name, ())
+            if node.children:
+                if not isinstance(items, list):
+                    items = dct[node.name] = list(items)
+                for item in items:
+                    _gather_slots(item, node.children.values(), slots)
+            else:
+                items = dct[node.name] = list(items)
+                node_slots = slots.setdefault(node, [])
+                for index in range(len(items)):
+                    node_slots.append((items, index))
+        elif node.name in dct:
+            if node.children:
+                _gather_slots(dct[node.name], node.children.values(), slots)
+            else:
+                slots.setdefault(node, []).append((dct, node.name))
+
+
+def _add_time(timings, rule, start):
+    if timings is not None:
+        timings[rule.key] = timings.get(rule.key, 0.0) + time.perf_counter() - start
+
+
+def _apply_walk_batch(payloads, root, timings=None):
+    slots = OrderedDict()
+    for payload in payloads:
+        _gather_slots(payload, root.children.values(), slots)
+    for node, node_slots in slots.items():
+        values = [container[key] for container, key in node_slots]
+        for rule in node.rules:
+            start = time.perf_counter()
+            values = rule.apply_column(values)
+            _add_time(timings, rule, start)
+        for (container, key), value in zip(node_slots, values):
+            container[key] = value
+
+
+def _extract(dct, path_tokens, depth=0):
+    '''
+    Extracts the value at a path. A path that ends in a list (or passes through one) yields the list of values. The
+    value is returned as it is in the document, only the lists gathering values from several items are new.
+    '''
+    if not dct and not isinstance(dct, bool):
+        return dct
+    name, is_list = path_tokens[depth]
+    if depth == len(path_tokens) - 1:
+        return dct.get(name, [])
+    if is_list:
+        return [_extract(item, path_tokens, depth + 1) for item in dct.get(name, ())]
+    if name in dct:
+        return _extract(dct[name], path_tokens, depth + 1)
+    return dct
+
+
+class ExecutionPlan(object):
+    '''
+    A compiled, reusable form of a field mapper config. Plans are immutable once built and safe to share across
+    threads. Build them through compile_plan so that identical configs share one plan.
+    '''
+
+    def __init__(self, conf, digest=None):
+        self.digest = digest or config_digest(conf)
+        stages = {}
+        for conf_key, action_key, registry, batch_registry, label in STAGES:
+            stages[conf_key] = self.__compile_rules(conf.get(conf_key, []), conf_key, action_key, registry,
+                                                    batch_registry, label)
+
+        self.transformation_walks = _build_walks(stages["transformations"])
+        self.derivation_walks = _build_walks(stages["derivations"])
+        self.validations = stages["validations"]
+        self.validation_trie = _build_trie(self.validations)
+        self.annotations = stages["annotations"]
+        self.annotation_paths = OrderedDict((rule.path, rule.path_tokens) for rule in self.annotations)
+
+    def __compile_rules(self, rules, conf_key, action_key, registry, batch_registry, label):
+        compiled = []
+        for index, rule in enumerate(rules):
+            name = rule.get(action_key)
+            if name not in registry:
+                logging.error(f"{label} not found: {name}. Please add the {label.lower()} to the registry and restart the service")
+                raise FieldMapperException(f"{label} not found: {name}.")
+            compiled.append(CompiledRule(index=index,
+                                         path=rule["path"],
+                                         name=name,
+                                         action=registry[name],
+                                         batch_action=batch_registry.get(name),
+                                         params=rule.get("params", {}),
+                                         stage=conf_key))
+        return compiled
+
+    def execute(self, payload):
+        '''
+        Runs every stage of the plan on a single document.
+        :param payload: dict, the payload on which the actions are to be performed
+        :return: tuple (payload, error_dct)
+        '''
+        error_dct = {
+            "validations": []
+        }
+        for root in self.transformation_walks:
+            payload = _apply_walk(payload, root.child_nodes)
+        for root in self.derivation_walks:
+            payload = _apply_walk(payload, root.child_nodes)
+
+        if self.validations:
+            failed = self.__validate(payload)
+            for rule in self.validations:
+                if rule.index in failed:
+                    error_dct["validations"].append(f"{rule.name} failed for key: {rule.path}")
+
+        if self.annotations:
+            extracted = {path: _extract(payload, path_tokens) for path, path_tokens in self.annotation_paths.items()}
+            assigned_annotations = set()
+            for rule in self.annotations:
+                annotation_value = rule.action(extracted[rule.path], **rule.params)
+                if annotation_value:
+                    assigned_annotations.add(annotation_value)
+            payload["annotations"] = list(assigned_annotations)
+        else:
+            payload["annotations"] = []
+
+        return payload, error_dct
+
+    def execute_batch(self, payloads, timings=None):
+        '''
+        Runs every stage of the plan on a list of documents in columnar fashion: the values at each path are gathered
+        across the whole batch, each rule is applied once per column and the results are scattered back. The output is
+        identical to calling execute on every document.
+        :param payloads: list, the payloads on which the actions are to be performed
+        :param timings: dict, optional, accumulates the seconds spent in every rule by CompiledRule.key
+        :return: tuple (payloads, error_dcts)
+        '''
+        error_dcts = [{"validations": []} for _ in payloads]
+        for root in self.transformation_walks:
+            _apply_walk_batch(payloads, root, timings)
+        for root in self.derivation_walks:
+            _apply_walk_batch(payloads, root, timings)
+
+        if self.validations:
+            failed = self.__validate_batch(payloads, timings)
+            for rule in self.validations:
+                for position in sorted(failed.get(rule.index, ())):
+                    error_dcts[position]["validations"].append(f"{rule.name} failed for key: {rule.path}")
+
+        assigned_annotations = [set() for _ in payloads]
+        if self.annotations:
+            columns = dict((path, [_extract(payload, path_tokens) for payload in payloads])
+                           for path, path_tokens in self.annotation_paths.items())
+            for rule in self.annotations:
+                start = time.perf_counter()
+                annotation_values = rule.apply_column(columns[rule.path])
+                _add_time(timings, rule, start)
+                for position, annotation_value in enumerate(annotation_values):
+                    if annotation_value:
+                        assigned_annotations[position].add(annotation_value)
+        for payload, annotations in zip(payloads, assigned_annotations):
+            payload["annotations"] = list(annotations)
+
+        return payloads, error_dcts
+
+    def __validate_batch(self, payloads, timings=None):
+        '''
+        :return: dict, rule index -> set of positions of the documents that failed the rule
+        '''
+        columns = OrderedDict()
+        for position, payload in enumerate(payloads):
+            for node, value in _iter_walk(payload, self.validation_trie.child_nodes):
+                positions, values = columns.setdefault(node, ([], []))
+                positions.append(position)
+                values.append(value)
+
+        failed = {}
+        for node, (positions, values) in columns.items():
+            for rule in node.rules:
+                start = time.perf_counter()
+                if rule.batch_action:
+                    flags = rule.batch_action(values, **rule.params)
+                else:
+                    flags = [self.__fails(rule, value) for value in values]
+                _add_time(timings, rule, start)
+                failed_positions = set(position for position, flag in zip(positions, flags) if flag)
+                if failed_positions:
+                    failed.setdefault(rule.index, set()).update(failed_positions)
+        return failed
+
+    @staticmethod
+    def __fails(rule, value):
+        try:
+            result = rule.action(value, **rule.params)
+        except ValidationFailedException:
+            return True
+        return isinstance(result, ValidationFailedException)
+
+    def __validate(self, payload):
+        '''
+        Validations only inspect the document. A rule fails when its validator raises or returns a
+        ValidationFailedException for any of the values at its path.
+        :return: set of failed rule indices
+        '''
+        failed = set()
+        for node, value in _iter_walk(payload, self.validation_trie.child_nodes):
+            for rule in node.rules:
+                if rule.index not in failed and self.__fails(rule, value):
+                    failed.add(rule.index)
+        return failed
+
+
+def config_digest(conf):
+    serialized = json.dumps(conf, sort_keys=True, separators=(",", ":"), default=str)
+    return hashlib.sha1(serialized.encode("utf-8")).hexdigest()
+
+
+_plan_cache = OrderedDict()
+_plan_cache_lock = threading.Lock()
+# id(conf) -> (conf, snapshot of conf, plan), in front of the digest LRU: the same config object is passed for every
+# document, and comparing it with its snapshot is much cheaper than hashing it again. Holding conf keeps its id from
+# being reused, the snapshot catches configs changed in place since they were compiled
+_identity_cache = OrderedDict()
+
+
+def compile_plan(conf):
+    '''
+    Returns the ExecutionPlan for a config, compiling it on first use. Plans are kept in a bounded LRU keyed by the
+    hash of the config, looked up by the identity of the config object first.
+    :param conf: dict, the field mapper config
+    :return: ExecutionPlan
+    '''
+    if isinstance(conf, ExecutionPlan):
+        return conf
+    entry = _identity_cache.get(id(conf))
+    if entry is not None and entry[0] is conf and entry[1] == conf:
+        return entry[2]
+    digest = config_digest(conf)
+    with _plan_cache_lock:
+        plan = _plan_cache.get(digest)
+        if plan is not None:
+            _plan_cache.move_to_end(digest)
+    if plan is None:
+        plan = ExecutionPlan(conf, digest=digest)
+        with _plan_cache_lock:
+            _plan_cache[digest] = plan
+            while len(_plan_cache) > PLAN_CACHE_SIZE:
+                _plan_cache.popitem(last=False)
+    with _plan_cache_lock:
+        _identity_cache[id(conf)] = (conf, copy.deepcopy(conf), plan)
+        while len(_identity_cache) > PLAN_CACHE_SIZE:
+            _identity_cache.popitem(last=False)
+    return plan
@@ -27,3 +27,20 @@ VALIDATION_REGISTRY = {
 ANNOTATION_REGISTRY = {
     "standard": A.standard_annotation
 }
+
+
+# Columnar implementations used by GenericFieldMapper.field_mapper_batch. Each takes the list of values found at a path
+# across a batch of documents and must return the same results as mapping the per-value action over the list.
+# Validations return a list of failure flags instead. Actions without an entry here are mapped value by value.
+BATCH_TRANSFORMATION_REGISTRY = {
+    "change_case": T.change_case_batch,
+    "date_standardization": T.date_format_batch
+}
+
+BATCH_VALIDATION_REGISTRY = {
+    "not_null": V.not_null_batch
+}
+
+BATCH_ANNOTATION_REGISTRY = {
+    "standard": A.standard_annotation_batch
+}
@@ -1,7 +1,8 @@
 #!/usr/bin/env python
 
 from datetime import datetime
-from dateutil.parser import parse
+
+from date_parsers import DATE_PARSER
 
 
 def change_case(value, target_case):
@@ -17,16 +18,50 @@ def change_case(value, target_case):
     if target_case == "lower":
         if value and isinstance(value, str):
             return value.lower()
+
+
+def change_case_batch(values, target_case):
+    '''
+    Columnar change_case over a list of values.
+    :param values: list, values to which the transformation is to be applied
+    :param target_case: str, the target case to which the values are to be transformed
+    :return: list
+    '''
+    if target_case == "upper":
+        return [value.upper() if value and isinstance(value, str) else None for value in values]
+    if target_case == "lower":
+        return [value.lower() if value and isinstance(value, str) else None for value in values]
+    return [None] * len(values)
+
+
 def date_format(value, target_format, source_format=None):
     '''
     Transformation for date format standardization
     :param value: str, value to which the transformation is to be applied
     :param target_format: str, The pythonic datetime format to which the date is to be converted to
-    :param source_format: str, (optional) The current pythonic datetime format
+    :param source_format: str, (optional) The current pythonic datetime format. When absent the layout of the value is
+                          inferred once per layout and cached, see date_parsers.CachingDateParser
     :return: str
     '''
     if not source_format:
-        datetime_obj = parse(value)
+        datetime_obj = DATE_PARSER.parse(value)
     else:
         datetime_obj = datetime.strptime(value, source_format)
-    return datetime_obj.strftime(target_format)
\ No newline at end of file
+    return datetime_obj.strftime(target_format)
+
+
+def date_format_batch(values, target_format, source_format=None):
+    '''
+    Columnar date_format over a list of values. Every distinct value in the column is parsed only once.
+    :param values: list, values to which the transformation is to be applied
+    :param target_format: str, The pythonic datetime format to which the dates are to be converted to
+    :param source_format: str, (optional) The current pythonic datetime format
+    :return: list
+    '''
+    formatted = {}
+    result = []
+    for value in values:
+        if value not in formatted:
+            formatted[value] = date_format(value, target_format, source_format)
+        result.append(formatted[value])
+    return result
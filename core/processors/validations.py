@@ -11,3 +11,17 @@ def not_null(value, on_failure="return_error"):
             raise ValidationFailedException("Validation failed.")
         else:
             return ValidationFailedException("Validation Failed")
+
+
+def not_null_batch(values, on_failure="return_error"):
+    '''
+    Columnar not_null. Returns a failure flag per value instead of raising, so the caller can attribute failures to
+    the documents they came from. Failures in log_error mode are logged and not reported, as in not_null.
+    '''
+    failed = [not value for value in values]
+    if on_failure == "log_error":
+        for flag in failed:
+            if flag:
+                logging.error(ValidationFailedException("Validation failed."))
+        return [False] * len(values)
+    return failed
@@ -0,0 +1,173 @@
+#!/usr/bin/env python
+
+import json
+import time
+import hashlib
+import logging
+import threading
+from concurrent.futures import ThreadPoolExecutor
+
+from core.utils.constants import CONNECTOR_CONFIG_TABLE, CASSANDRA_SOURCE_CONFIG_TABLE
+from core.utils.constants import DOCUMENT_PROCESSING_CONFIG_TABLE, ALERTS_CONFIG_TABLE
+
+'''
+In-memory cache of the configs stored in config_db_0001, shared by the services of a process.
+
+Config kinds:
+    kind                  table                             key
+    connector             connector_user_config             (connector_id, user_id)
+    cassandra_source      cassandra_source_config           (source_id,)
+    document_processing   document_processing_user_config   (user_id, connector_id)
+    alerts                alerts_user_config                (user_id, connector_id, doc_type)
+
+Reads are prepared and parameterized. A config is served from memory for `ttl` seconds after it was loaded. Once it
+is older than refresh_ahead * ttl, the next lookup still returns it but reloads it in the background, so configs in
+use are refreshed before they expire and lookups on hot paths do not wait on Cassandra. Missing configs are cached too
+(as None). A reload only counts as a change, and notifies the subscribers of the kind, when the lupdt of the row moved
+(or, for tables without lupdt, when its content did).
+'''
+
+CONFIG_KINDS = {
+    "connector": {
+        "table": CONNECTOR_CONFIG_TABLE,
+        "key": ("connector_id", "user_id"),
+        "columns": ("connector_type", "auth_conf", "service_conf", "schedule_conf", "lupdt"),
+        "blobs": ("auth_conf", "service_conf", "schedule_conf")
+    },
+    "cassandra_source": {
+        "table": CASSANDRA_SOURCE_CONFIG_TABLE,
+        "key": ("source_id",),
+        "columns": ("keyspace", "table_name", "partition_keys", "clustering_keys", "version_keys", "lupdt"),
+        "blobs": ()
+    },
+    "document_processing": {
+        "table": DOCUMENT_PROCESSING_CONFIG_TABLE,
+        "key": ("user_id", "connector_id"),
+        "columns": ("transformations", "derivations", "validations", "annotations", "lupdt"),
+        "blobs": ("transformations", "derivations", "validations", "annotations")
+    },
+    "alerts": {
+        "table": ALERTS_CONFIG_TABLE,
+        "key": ("user_id", "connector_id", "doc_type"),
+        "columns": ("alerts",),
+        "blobs": ("alerts",)
+    }
+}
+
+
+class ConfigCache(object):
+    """
+    :param tables: dict {kind: table}, overrides the table of a config kind
+    """
+
+    def __init__(self, cassandra_ctx, ttl=60, refresh_ahead=0.8, tables=None):
+        self.__cassandra_ctx = cassandra_ctx
+        self.__ttl = ttl
+        self.__refresh_after = ttl * refresh_ahead
+        self.__tables = {kind: (tables or {}).get(kind, spec["table"]) for kind, spec in CONFIG_KINDS.items()}
+        self.__lock = threading.Lock()
+        # (kind, key) -> {"config", "version", "loaded_at", "refreshing"}
+        self.__entries = {}
+        # (kind, key) -> Lock, so concurrent misses of a config load it once
+        self.__load_locks = {}
+        self.__subscribers = {kind: [] for kind in CONFIG_KINDS}
+        self.__refresher = ThreadPoolExecutor(max_workers=2, thread_name_prefix="config-refresh")
+        self.__metrics = {"hits": 0, "misses": 0, "refreshes": 0, "changes": 0}
+
+    """
+    API
+    """
+
+    def get(self, kind, *key):
+        """
+        :return: the config as a dict of its columns (blob columns decoded from JSON), or None if there is none
+        """
+        cache_key = (kind, key)
+        now = time.time()
+        with self.__lock:
+            entry = self.__entries.get(cache_key)
+            if entry is not None and now - entry["loaded_at"] < self.__ttl:
+                self.__metrics["hits"] += 1
+                if now - entry["loaded_at"] >= self.__refresh_after and not entry["refreshing"]:
+                    entry["refreshing"] = True
+                    self.__refresher.submit(self.__refresh, kind, key)
+                return entry["config"]
+            self.__metrics["misses"] += 1
+            load_lock = self.__load_locks.setdefault(cache_key, threading.Lock())
+
+        with load_lock:
+            with self.__lock:
+                entry = self.__entries.get(cache_key)
+                if entry is not None and time.time() - entry["loaded_at"] < self.__ttl:
+                    return entry["config"]
+            return self.__load(kind, key)
+
+    def subscribe(self, kind, callback):
+        """
+        Registers callback(kind, key, config), called from the refresh thread when a cached config of the kind changes
+        """
+        self.__subscribers[kind].append(callback)
+
+    def invalidate(self, kind, *key):
+        with self.__lock:
+            self.__entries.pop((kind, key), None)
+
+    def stats(self):
+        with self.__lock:
+            return dict(self.__metrics)
+
+    def close(self):
+        self.__refresher.shutdown(wait=False)
+
+    """
+    ABSTRACTION
+    """
+
+    def __refresh(self, kind, key):
+        try:
+            self.__load(kind, key)
+            with self.__lock:
+                self.__metrics["refreshes"] += 1
+        except Exception as e:
+            # Keep serving the cached config until it expires
+            logging.warning(f"Failed to refresh {kind} config {key}: {e}")
+            with self.__lock:
+                entry = self.__entries.get((kind, key))
+                if entry is not None:
+                    entry["refreshing"] = False
+
+    def __load(self, kind, key):
+        config, version = self.__read(kind, key)
+        with self.__lock:
+            previous = self.__entries.get((kind, key))
+            self.__entries[(kind, key)] = {"config": config, "version": version, "loaded_at": time.time(),
+                                           "refreshing": False}
+            changed = previous is not None and previous["version"] != version
+            if changed:
+                self.__metrics["changes"] += 1
+        if changed:
+            for callback in self.__subscribers[kind]:
+                try:
+                    callback(kind, key, config)
+                except Exception as e:
+                    logging.error(f"Config change callback failed for {kind} config {key}: {e}")
+        return config
+
+    def __read(self, kind, key):
+        spec = CONFIG_KINDS[kind]
+        query = "SELECT {} FROM {} WHERE {} LIMIT 1".format(", ".join(spec["columns"]), self.__tables[kind],
+                                                             " AND ".join(f"{column}=?" for column in spec["key"]))
+        rows = self.__cassandra_ctx.exec_read(query, tuple(key), prepared=True)
+        for row in rows:
+            config = {}
+            for column, value in zip(spec["columns"], row):
+                if column in spec["blobs"] and value is not None:
+                    value = json.loads(value)
+                config[column] = value
+            if "lupdt" in config:
+                version = config["lupdt"]
+            else:
+                version = hashlib.blake2b(json.dumps(config, sort_keys=True, default=str).encode('utf-8'),
+                                          digest_size=16).hexdigest()
+            return config, version
+        return None, None
@@ -1,9 +1,13 @@
 CASSANDRA_SEEDS = []
 KAFKA_SEEDS = []
+ELASTICSEARCH_SEEDS = []
+JANUSGRAPH_SEEDS = []
 
 AUTH_VARIABLES = {"username": "CASS_USER", "password": "CASS_PWD"}
 
 CONNECTOR_CONFIG_TABLE = "config_db_0001.connector_user_config"
+CONNECTOR_CHECKPOINT_TABLE = "config_db_0001.connector_checkpoint"
+CONNECTOR_DIGEST_TABLE = "config_db_0001.connector_record_digest"
 CASSANDRA_SOURCE_CONFIG_TABLE = "config_db_0001.cassandra_source_config"
 DOCUMENT_PROCESSING_CONFIG_TABLE = "config_db_0001.document_processing_user_config"
 ALERTS_CONFIG_TABLE = "config_db_0001.alerts_user_config"
@@ -0,0 +1,71 @@
+#!/usr/bin/env python
+
+import time
+import threading
+from collections import OrderedDict
+
+'''
+Bounded LRU of JanusGraph vertex ids by natural key (e.g. "table:<mcon>", "warehouse:<uuid>"), so that upserts of
+vertices seen before can address them by id instead of looking them up through an index.
+
+Every entry also keeps the properties last written to the vertex, so a caller can skip writing them again. With a
+ttl, entries older than ttl seconds are treated as missing, which bounds how long a vertex deleted or merged by
+another writer can be addressed by a stale id. Entries must be invalidated when a write that used them fails.
+'''
+
+
+class VertexIdCache(object):
+
+    def __init__(self, max_entries=100000, ttl=None):
+        self.__max_entries = max_entries
+        self.__ttl = ttl
+        self.__lock = threading.Lock()
+        # key -> (vertex id, properties, cached at)
+        self.__entries = OrderedDict()
+        self.__metrics = {"hits": 0, "misses": 0, "expired": 0, "evictions": 0, "invalidations": 0}
+
+    """
+    API
+    """
+
+    def get(self, key):
+        """
+        :return: (vertex id, properties last written) or None
+        """
+        with self.__lock:
+            entry = self.__entries.get(key)
+            if entry is not None and self.__ttl is not None and time.time() - entry[2] >= self.__ttl:
+                del self.__entries[key]
+                self.__metrics["expired"] += 1
+                entry = None
+            if entry is None:
+                self.__metrics["misses"] += 1
+                return None
+            self.__entries.move_to_end(key)
+            self.__metrics["hits"] += 1
+            return entry[0], entry[1]
+
+    def put(self, key, vertex_id, properties=None):
+        with self.__lock:
+            self.__entries[key] = (vertex_id, properties, time.time())
+            self.__entries.move_to_end(key)
+            if len(self.__entries) > self.__max_entries:
+                self.__entries.popitem(last=False)
+                self.__metrics["evictions"] += 1
+
+    def invalidate(self, *keys):
+        with self.__lock:
+            for key in keys:
+                if self.__entries.pop(key, None) is not None:
+                    self.__metrics["invalidations"] += 1
+
+    def clear(self):
+        with self.__lock:
+            self.__entries.clear()
+
+    def stats(self):
+        with self.__lock:
+            stats = dict(self.__metrics, entries=len(self.__entries))
+        lookups = stats["hits"] + stats["misses"]
+        stats["hit_rate"] = round(stats["hits"] / lookups, 3) if lookups else 0.0
+        return stats
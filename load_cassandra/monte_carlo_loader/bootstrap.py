@@ -15,9 +15,14 @@ CLI Params:
 --group_id
 --target_namespace
 --doc_type
+--workers
+--max-inflight
+--batch-size
+--flush-interval-ms
 '''
 
-def bootstrap(topic, group_id, target_namespace, doc_type):
+def bootstrap(topic, group_id, target_namespace, doc_type, workers=4, max_inflight=500, batch_size=50,
+              flush_interval_ms=500):
     cassandra_auth = {"username": os.environ.get(AUTH_VARIABLES["username"]),
                       "password": os.environ.get(AUTH_VARIABLES["password"])}
     cassandra_ctx = CassandraContext(CASSANDRA_SEEDS, **{"auth": cassandra_auth})
@@ -30,16 +35,20 @@ def bootstrap(topic, group_id, target_namespace, doc_type):
                                       consumer_ctx=consumer_ctx,
                                       target_namespace=target_namespace,
                                       doc_type=doc_type,
-                                      config_table=CASSANDRA_SOURCE_CONFIG_TABLE
-
+                                      config_table=CASSANDRA_SOURCE_CONFIG_TABLE,
+                                      workers=workers,
+                                      max_inflight=max_inflight,
+                                      batch_size=batch_size,
+                                      flush_interval=flush_interval_ms / 1000
         )
+        # Offsets are committed by the consumer context, only for records whose writes were acknowledged
         plugin_obj.execute()
     except Exception as e:
         logging.error(e)
         logging.error(traceback.format_exc())
     finally:
-        consumer_ctx.commit()
         consumer_ctx.close()
+        cassandra_ctx.close()
 
 
 if __name__ == "__main__":
@@ -51,11 +60,23 @@ if __name__ == "__main__":
     parser.add_argument("--group_id", help="The consumer group id for the service", required=True)
     parser.add_argument("--target_namespace", help="The cassandra namespace to which the document is to be written to",
                         required=True)
-    parser.add_argument("--doc_type", help="The document type to be consumed from Kafka",
+    parser.add_argument("--doc_type", help="The document type to be consumed from Kafka", required=True)
+    parser.add_argument("--workers", help="Number of decode/serialize workers, shared by all partitions", type=int,
+                        default=4, required=False)
+    parser.add_argument("--max-inflight",
+                        help="Maximum number of consumed messages of a partition whose writes are not yet acknowledged",
+                        type=int, default=500, required=False)
+    parser.add_argument("--batch-size", help="Maximum number of rows per partition batch", type=int, default=50,
                         required=False)
+    parser.add_argument("--flush-interval-ms", help="Maximum time a row waits in a partition batch before it is written",
+                        type=int, default=500, required=False)
 
     args = parser.parse_args()
     bootstrap(topic=args.topic,
               group_id=args.group_id,
               target_namespace=args.target_namespace,
-              doc_type=args.doc_type)
+              doc_type=args.doc_type,
+              workers=args.workers,
+              max_inflight=args.max_inflight,
+              batch_size=args.batch_size,
+              flush_interval_ms=args.flush_interval_ms)
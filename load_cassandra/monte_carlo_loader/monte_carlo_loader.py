@@ -1,45 +1,155 @@
-import json
+import time
+import logging
+from functools import partial
+from concurrent.futures import Future, ThreadPoolExecutor
+
+from core.connection_wrappers.kafka_codecs import decode_message
+from core.connection_wrappers.kafka_runtime import PartitionWorkerRuntime
+from core.connection_wrappers.cassandra_batch_writer import CassandraBatchWriter
+from core.utils.config_cache import ConfigCache
 
 
 '''
 This is a simple cassandra loader which just pushes through the data to cassandra blindly.
 This can be better optimized by using an abstract class that defines a wireframe structure of cassandra loaders and
 does the important transformations that might be needed.
+
+The loader runs as a staged pipeline on a PartitionWorkerRuntime (thread mode):
+* consume (calling thread): reads records without decoding them, skipping the ones of other doc types from their
+  headers. The runtime hands every record to the worker pool from the worker thread of its partition. A partition
+  with max_inflight unacknowledged records is paused until half of them are written (back-pressure).
+* decode/serialize (pool of `workers` threads shared by all partitions, so a single busy partition still uses all of
+  them): decodes the record, flattens its payload into a row of the target table (see to_row) and hands the row to
+  the writer, which encodes it.
+* write (CassandraBatchWriter): groups rows by partition key into UNLOGGED batches routed to a replica of the
+  partition, flushed on size or after flush_interval. Batches run concurrently. Rows are written with the producer
+  timestamp, so concurrent writes of the same row resolve to the latest version regardless of completion order.
+A record is acknowledged once its write is, and the consumer context commits offsets per partition only up to the
+highest contiguous acknowledged record (see KafkaConsumerContext.consume_records). A failed write stops the loader
+without acknowledging the record.
 '''
 
 class MonteCarloLoaderException(Exception):
     pass
 
 
+def to_row(doc, columns):
+    '''
+    Flattens a message envelope into a row of the target table: the fields of payload["node"] and the other fields of
+    the payload at the top level, plus the user_id of the envelope. Fields the table has no column for are dropped,
+    as INSERT ... JSON rejects unknown columns.
+    :param columns: collection, the column names of the target table
+    '''
+    payload = doc.get("payload") or {}
+    row = {key: value for key, value in payload.items() if key != "node"}
+    row.update(payload.get("node") or {})
+    if row.get("user_id") is None:
+        row["user_id"] = doc.get("user_id")
+    # Monte Carlo returns the mcons of the tables of an incident, the table stores them as table_type
+    if isinstance(row.get("tables"), list):
+        row["tables"] = [{"mcon": table} if isinstance(table, str) else table for table in row["tables"]]
+    return {key: value for key, value in row.items() if key in columns}
+
+
 class MonteCarloLoader:
 
-    def __init__(self, cassandra_ctx, consumer_ctx, target_namespace, doc_type, config_table):
+    def __init__(self, cassandra_ctx, consumer_ctx, target_namespace, doc_type, config_table, workers=4,
+                 max_inflight=500, batch_size=50, flush_interval=0.5, drain_timeout=60, report_interval=5,
+                 config_cache=None):
+        if not doc_type:
+            raise MonteCarloLoaderException("A doc_type is required, records are filtered on their doc_type header")
         self.__cassandra_ctx = cassandra_ctx
-        self.__consumer_ctx = consumer_ctx
         self.__namespace = target_namespace
-        self.__doc_type = doc_type
-        self.__namespace_conf = self.__get_config_from_cassandra(config_table)
+        self.__config_cache = config_cache or ConfigCache(cassandra_ctx, tables={"cassandra_source": config_table})
+        self.__namespace_conf = self.__get_config_from_cassandra(self.__config_cache)
+        self.__config_cache.subscribe("cassandra_source", self.__on_config_change)
+        self.__columns = self.__get_columns()
+        self.__report_interval = report_interval
+        self.__last_report = time.time()
+        self.__writer = CassandraBatchWriter(cassandra_ctx=cassandra_ctx,
+                                             keyspace=self.__namespace_conf["keyspace"],
+                                             table=self.__namespace_conf["table_name"],
+                                             partition_keys=self.__namespace_conf["partition_keys"],
+                                             batch_size=batch_size,
+                                             flush_interval=flush_interval)
+        self.__pool = ThreadPoolExecutor(max_workers=workers, thread_name_prefix="cassandra-loader")
+        self.__runtime = PartitionWorkerRuntime(consumer_ctx,
+                                                handler=self.__push_to_cassandra,
+                                                mode="thread",
+                                                max_queued=max_inflight,
+                                                drain_timeout=drain_timeout,
+                                                header_filter={"doc_type": doc_type},
+                                                on_poll=self.__on_poll,
+                                                decode=False)
 
     def execute(self):
-        while True:
-            dcts = self.__consumer_ctx.consume()
-            if len(dcts) > 0:
-                for dct in dcts:
-                    if dct["doc_type"] == self.__doc_type:
-                        self.__push_to_cassandra(dct)
-
-    def __get_config_from_cassandra(self, config_table):
-        query = f"SELECT JSON keyspace, table_name, partition_keys, clustering_keys, version_keys from {config_table} where source_id = '{self.__namespace}' LIMIT 1"
-        conf_row = self.__cassandra_ctx.exec_read(query)
-        if conf_row:
-            config = json.loads(conf_row[0][0])
+        try:
+            self.__runtime.run()
+        except Exception:
+            # The failure of the runtime is the one to report, the writes still in flight are failed or abandoned
+            try:
+                self.__close()
+            except Exception as e:
+                logging.error(f"Failed to close the Cassandra batch writer: {e}")
+            raise
+        self.__close()
+
+    def stop(self):
+        '''
+        Makes execute() return after the current consume. Safe to call from a signal handler or another thread.
+        '''
+        self.__runtime.stop()
+
+    def __close(self):
+        self.__pool.shutdown()
+        try:
+            self.__writer.close()
+        finally:
+            logging.info(f"Cassandra batch writer stats: {self.__writer.stats()}")
+
+    def __on_poll(self):
+        if time.time() - self.__last_report >= self.__report_interval:
+            logging.info(f"Cassandra batch writer stats: {self.__writer.stats()}")
+            # In-memory lookup, keeps the source config refreshed so that changes are noticed
+            self.__config_cache.get("cassandra_source", self.__namespace)
+            self.__last_report = time.time()
+
+    def __get_config_from_cassandra(self, config_cache):
+        config = config_cache.get("cassandra_source", self.__namespace)
+        if config:
             return config
         else:
             raise MonteCarloLoaderException(
                 "Configuration not found for the service. Please recheck input parameters")
 
-    def __push_to_cassandra(self, doc):
-        keyspace = self.__namespace_conf["keyspace"]
-        table = self.__namespace_conf["table_name"]
-        full_table_name = f"{keyspace}.{table}"
-        insert_query = "INSERT INTO {} JSON {}".format(full_table_name, json.dumps(doc))
+    def __get_columns(self):
+        keyspace, table = self.__namespace_conf["keyspace"], self.__namespace_conf["table_name"]
+        try:
+            return set(self.__cassandra_ctx.get_session().cluster.metadata.keyspaces[keyspace].tables[table].columns)
+        except KeyError:
+            raise MonteCarloLoaderException(f"Target table {keyspace}.{table} does not exist")
+
+    def __on_config_change(self, kind, key, config):
+        if key == (self.__namespace,):
+            # The writer is bound to the keyspace, table and partition keys it was created with
+            logging.warning(f"Source config of {self.__namespace} changed, restart the loader to apply it: {config}")
+
+    def __push_to_cassandra(self, record):
+        '''
+        :return: Future completed once the row is written
+        '''
+        written = Future()
+        self.__pool.submit(self.__load, record, written)
+        return written
+
+    def __load(self, record, written):
+        try:
+            doc = decode_message(record.value)
+            produced_at = doc.get("meta", {}).get("timestamp")
+            # Producer timestamp is in milliseconds, Cassandra write timestamps are in microseconds
+            self.__writer.add(to_row(doc, self.__columns),
+                              timestamp=int(produced_at * 1000) if produced_at else None,
+                              callback=partial(written.set_result, None),
+                              errback=written.set_exception)
+        except Exception as e:
+            written.set_exception(e)
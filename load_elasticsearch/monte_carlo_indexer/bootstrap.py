@@ -0,0 +1,89 @@
+import logging
+import argparse
+import traceback
+
+from core.connection_wrappers.kafka_wrapper import KafkaConsumerContext, KafkaProducerContext
+from core.connection_wrappers.elasticsearch_wrapper import ElasticsearchContext
+
+from core.utils.constants import KAFKA_SEEDS, ELASTICSEARCH_SEEDS
+from monte_carlo_indexer import MonteCarloIndexer
+
+'''
+CLI Params:
+--topic
+--group_id
+--index
+--doc_type
+--id-field
+--batch-size
+--batch-bytes
+--flush-interval-ms
+--backfill
+--dead-letter-topic
+'''
+
+def bootstrap(topic, group_id, index, doc_type, id_field="payload.node.uuid", batch_size=1000,
+              batch_bytes=5 * 1024 * 1024, flush_interval_ms=5000, backfill=False, dead_letter_topic=None):
+    es_ctx = ElasticsearchContext(ELASTICSEARCH_SEEDS)
+    consumer_ctx = KafkaConsumerContext(seeds=KAFKA_SEEDS,
+                                        topic=topic,
+                                        group_id=group_id,
+                                        num_messages=500)
+    producer_ctx = KafkaProducerContext(seeds=KAFKA_SEEDS) if dead_letter_topic else None
+    try:
+        plugin_obj = MonteCarloIndexer(es_ctx=es_ctx,
+                                       consumer_ctx=consumer_ctx,
+                                       index=index,
+                                       doc_type=doc_type,
+                                       id_field=id_field,
+                                       batch_size=batch_size,
+                                       batch_bytes=batch_bytes,
+                                       flush_interval=flush_interval_ms / 1000,
+                                       backfill=backfill,
+                                       producer_ctx=producer_ctx,
+                                       dead_letter_topic=dead_letter_topic)
+        # Offsets are committed by the indexer itself, after the bulk requests that indexed the messages
+        plugin_obj.execute()
+    except Exception as e:
+        logging.error(e)
+        logging.error(traceback.format_exc())
+    finally:
+        consumer_ctx.close()
+        if producer_ctx:
+            producer_ctx.close()
+        es_ctx.close()
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(
+        prog='MonteCarlo Elasticsearch Indexer',
+        description='Index Monte Carlo data to Elasticsearch',
+    )
+    parser.add_argument("--topic", help="The topic to which the crawled records are written", required=True)
+    parser.add_argument("--group_id", help="The consumer group id for the service", required=True)
+    parser.add_argument("--index", help="The Elasticsearch index (or alias) the documents are written to",
+                        required=True)
+    parser.add_argument("--doc_type", help="The document type to be consumed from Kafka", required=True)
+    parser.add_argument("--id-field", help="Dotted path of the document id in the message", default="payload.node.uuid",
+                        required=False)
+    parser.add_argument("--batch-size", help="Maximum number of documents per bulk flush", type=int, default=1000,
+                        required=False)
+    parser.add_argument("--batch-bytes", help="Maximum size of the messages buffered for a bulk flush", type=int,
+                        default=5 * 1024 * 1024, required=False)
+    parser.add_argument("--flush-interval-ms", help="Maximum time between two bulk flushes", type=int, default=5000,
+                        required=False)
+    parser.add_argument("--backfill", help="Disable index refreshes until the indexer stops", action="store_true")
+    parser.add_argument("--dead-letter-topic", help="Topic receiving the documents Elasticsearch refused",
+                        required=False)
+
+    args = parser.parse_args()
+    bootstrap(topic=args.topic,
+              group_id=args.group_id,
+              index=args.index,
+              doc_type=args.doc_type,
+              id_field=args.id_field,
+              batch_size=args.batch_size,
+              batch_bytes=args.batch_bytes,
+              flush_interval_ms=args.flush_interval_ms,
+              backfill=args.backfill,
+              dead_letter_topic=args.dead_letter_topic)
@@ -0,0 +1,219 @@
+import time
+import logging
+
+from core.connection_wrappers.kafka_wrapper import OffsetTracker
+from core.connection_wrappers.kafka_codecs import decode_message
+
+
+'''
+Indexes the documents of a doc type from Kafka into an Elasticsearch index through the _bulk API.
+
+Consumed messages are buffered as index actions and sent in one bulk flush once the buffer holds batch_size documents
+or batch_bytes of message values, or flush_interval seconds after the previous flush. Offsets are committed after
+every flush, only up to the messages whose documents the flush indexed, so a crash never skips a document.
+
+Documents are indexed under the id found at id_field, with the producer timestamp as their external version
+(version_type external_gte): replaying messages after a restart, or receiving an older version of a document late,
+never overwrites a newer version. The version conflicts this causes are counted as indexed.
+
+Items rejected with 429 (the write queue of a node is full) are retried by the bulk helper with backoff. Items that
+are still rejected, or failed with a 5xx, stop the loader without committing them, so they are consumed again after a
+restart. Other item failures (e.g. mapping errors) would fail again on every retry: they are produced to
+dead_letter_topic when one is configured, otherwise the loader stops.
+
+In backfill mode index refreshes are disabled while loading, and the refresh interval is restored (and the index
+refreshed) when the loader closes.
+'''
+
+class MonteCarloIndexerException(Exception):
+    pass
+
+
+class MonteCarloIndexer:
+
+    def __init__(self, es_ctx, consumer_ctx, index, doc_type, id_field="payload.node.uuid", batch_size=1000,
+                 batch_bytes=5 * 1024 * 1024, flush_interval=5, chunk_size=500, max_retries=3, backfill=False,
+                 producer_ctx=None, dead_letter_topic=None, report_interval=30):
+        if dead_letter_topic and producer_ctx is None:
+            raise MonteCarloIndexerException("A producer is needed to write to the dead letter topic")
+        self.__es_ctx = es_ctx
+        self.__consumer_ctx = consumer_ctx
+        self.__index = index
+        self.__doc_type = doc_type
+        self.__id_path = id_field.split(".")
+        self.__batch_size = batch_size
+        self.__batch_bytes = batch_bytes
+        self.__flush_interval = flush_interval
+        self.__chunk_size = chunk_size
+        self.__max_retries = max_retries
+        self.__backfill = backfill
+        self.__producer_ctx = producer_ctx
+        self.__dead_letter_topic = dead_letter_topic
+        self.__report_interval = report_interval
+
+        self.__tracker = OffsetTracker()
+        # [(action, message)] not sent yet
+        self.__buffer = []
+        self.__buffer_bytes = 0
+        self.__last_flush = time.time()
+        self.__stopped = False
+        self.__failure = None
+        self.__closed = False
+        self.__refresh_disabled = False
+        self.__saved_refresh_interval = None
+        self.__started_at = None
+        self.__metrics = {"indexed": 0, "version_conflicts": 0, "dead_lettered": 0, "bulk_requests": 0,
+                          "bulk_seconds": 0.0}
+
+        consumer_ctx.set_rebalance_callbacks(on_revoke=self.__on_revoke)
+
+    def execute(self):
+        self.__started_at = time.time()
+        if self.__backfill:
+            self.__disable_refresh()
+        last_report = time.time()
+        try:
+            while not self.__stopped:
+                for message in self.__consumer_ctx.consume_filtered({"doc_type": self.__doc_type}, raw=True,
+                                                                    on_skip=self.__on_skipped):
+                    self.__add(message)
+                    if len(self.__buffer) >= self.__batch_size or self.__buffer_bytes >= self.__batch_bytes:
+                        self.__flush()
+                if time.time() - self.__last_flush >= self.__flush_interval:
+                    self.__flush()
+                if time.time() - last_report >= self.__report_interval:
+                    logging.info(f"Elasticsearch indexer stats: {self.stats()}")
+                    last_report = time.time()
+        except Exception as e:
+            self.__failure = e
+            raise
+        finally:
+            self.close()
+
+    def stop(self):
+        '''
+        Makes execute() return after the current consume. Safe to call from a signal handler or another thread.
+        '''
+        self.__stopped = True
+
+    def close(self):
+        '''
+        Indexes the buffered documents (unless the loader failed), commits them and restores the refresh interval.
+        '''
+        if self.__closed:
+            return
+        self.__closed = True
+        try:
+            if self.__failure is None:
+                self.__flush(is_asynchronous_commit=False)
+        finally:
+            if self.__refresh_disabled:
+                self.__restore_refresh()
+            logging.info(f"Elasticsearch indexer stats: {self.stats()}")
+
+    def stats(self):
+        stats = dict(self.__metrics)
+        stats["bulk_seconds"] = round(stats["bulk_seconds"], 3)
+        elapsed = time.time() - self.__started_at if self.__started_at else 0
+        stats["docs_per_s"] = round(stats["indexed"] / elapsed, 1) if elapsed else 0.0
+        return stats
+
+    def __add(self, message):
+        self.__tracker.track(message.topic(), message.partition(), message.offset())
+        doc = decode_message(message)
+        doc_id = self.__get_id(doc)
+        action = {
+            "_index": self.__index,
+            # Falls back to the position of the message, which is as stable across replays
+            "_id": doc_id if doc_id is not None else f"{message.topic()}-{message.partition()}-{message.offset()}",
+            "_source": doc
+        }
+        produced_at = doc.get("meta", {}).get("timestamp")
+        if produced_at:
+            action["version"] = int(produced_at)
+            action["version_type"] = "external_gte"
+        self.__buffer.append((action, message))
+        self.__buffer_bytes += len(message.value())
+
+    def __flush(self, is_asynchronous_commit=True):
+        batch, self.__buffer, self.__buffer_bytes = self.__buffer, [], 0
+        self.__last_flush = time.time()
+        if batch:
+            start = time.perf_counter()
+            succeeded, failed = self.__es_ctx.bulk((action for action, _ in batch), chunk_size=self.__chunk_size,
+                                                   max_retries=self.__max_retries)
+            self.__metrics["bulk_seconds"] += time.perf_counter() - start
+            self.__metrics["bulk_requests"] += 1
+            self.__metrics["indexed"] += succeeded
+            if failed:
+                self.__handle_failures(failed, batch)
+            for _, message in batch:
+                self.__tracker.ack(message.topic(), message.partition(), message.offset())
+        self.__consumer_ctx.commit_offsets(self.__tracker.committable(), is_asynchronous_commit=is_asynchronous_commit)
+
+    def __handle_failures(self, failed, batch):
+        # Failed items only carry their _id, the documents are taken from the actions sent
+        sources = {action["_id"]: action["_source"] for action, _ in batch}
+        dead_letters = []
+        for item in failed:
+            op_type, result = next(iter(item.items()))
+            status = result.get("status") or 0
+            if status == 409:
+                self.__metrics["version_conflicts"] += 1
+            elif status == 429 or status >= 500 or status == 0:
+                raise MonteCarloIndexerException(f"Bulk item {result.get('_id')} was not indexed (status {status}), "
+                                                 f"stopping without committing it: {result.get('error')}")
+            else:
+                dead_letters.append(result)
+        if not dead_letters:
+            return
+        if not self.__dead_letter_topic:
+            raise MonteCarloIndexerException(f"{len(dead_letters)} documents could not be indexed, first: "
+                                             f"{dead_letters[0].get('_id')}: {dead_letters[0].get('error')}")
+        for result in dead_letters:
+            self.__producer_ctx.produce(topic=self.__dead_letter_topic,
+                                        msg_payload={"doc_type": self.__doc_type,
+                                                     "index": self.__index,
+                                                     "status": result.get("status"),
+                                                     "error": result.get("error"),
+                                                     "document": sources.get(result.get("_id"))},
+                                        msg_key=result.get("_id"))
+        # The documents are committed as handled once their dead letters are delivered
+        self.__producer_ctx.flush()
+        errors = self.__producer_ctx.delivery_errors()
+        if errors:
+            raise MonteCarloIndexerException(f"Failed to deliver {len(errors)} dead letters: {errors[0]}")
+        self.__metrics["dead_lettered"] += len(dead_letters)
+        logging.warning(f"{len(dead_letters)} documents could not be indexed and were sent to "
+                        f"{self.__dead_letter_topic}, first: {dead_letters[0].get('_id')}: "
+                        f"{dead_letters[0].get('error')}")
+
+    def __get_id(self, doc):
+        value = doc
+        for field in self.__id_path:
+            if not isinstance(value, dict):
+                return None
+            value = value.get(field)
+        return value
+
+    def __on_skipped(self, message):
+        self.__tracker.track(message.topic(), message.partition(), message.offset())
+        self.__tracker.ack(message.topic(), message.partition(), message.offset())
+
+    def __on_revoke(self, partitions):
+        # Index and commit what was consumed from the revoked partitions while they are still assigned
+        if self.__failure is None:
+            self.__flush(is_asynchronous_commit=False)
+        self.__tracker.forget(partitions)
+
+    def __disable_refresh(self):
+        self.__saved_refresh_interval = self.__es_ctx.get_refresh_interval(self.__index)
+        self.__es_ctx.set_refresh_interval(self.__index, "-1")
+        self.__refresh_disabled = True
+        logging.info(f"Disabled refreshes of {self.__index} for the backfill")
+
+    def __restore_refresh(self):
+        self.__es_ctx.set_refresh_interval(self.__index, self.__saved_refresh_interval)
+        self.__es_ctx.refresh(self.__index)
+        self.__refresh_disabled = False
+        logging.info(f"Restored the refresh interval of {self.__index}: {self.__saved_refresh_interval or 'default'}")
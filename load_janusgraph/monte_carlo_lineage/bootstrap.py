@@ -0,0 +1,73 @@
+import logging
+import argparse
+import traceback
+
+from core.connection_wrappers.kafka_wrapper import KafkaConsumerContext
+from core.connection_wrappers.janusgraph_wrapper import JanusGraphContext
+
+from core.utils.constants import KAFKA_SEEDS, JANUSGRAPH_SEEDS
+from core.utils.vertex_id_cache import VertexIdCache
+from monte_carlo_lineage_loader import MonteCarloLineageLoader
+
+'''
+CLI Params:
+--topic
+--group_id
+--doc_type
+--batch-size
+--flush-interval-ms
+--vertex-cache-size
+--vertex-cache-ttl
+'''
+
+def bootstrap(topic, group_id, doc_type="mc_incident", batch_size=500, flush_interval_ms=5000, vertex_cache_size=100000,
+              vertex_cache_ttl=None):
+    jg_ctx = JanusGraphContext(JANUSGRAPH_SEEDS)
+    consumer_ctx = KafkaConsumerContext(seeds=KAFKA_SEEDS,
+                                        topic=topic,
+                                        group_id=group_id,
+                                        num_messages=batch_size)
+    try:
+        plugin_obj = MonteCarloLineageLoader(jg_ctx=jg_ctx,
+                                             consumer_ctx=consumer_ctx,
+                                             doc_type=doc_type,
+                                             batch_size=batch_size,
+                                             flush_interval=flush_interval_ms / 1000,
+                                             vertex_cache=VertexIdCache(max_entries=vertex_cache_size,
+                                                                        ttl=vertex_cache_ttl))
+        # Offsets are committed by the loader itself, once the batches are upserted
+        plugin_obj.execute()
+    except Exception as e:
+        logging.error(e)
+        logging.error(traceback.format_exc())
+    finally:
+        consumer_ctx.close()
+        jg_ctx.close()
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(
+        prog='MonteCarlo Lineage Loader',
+        description='Load the lineage of Monte Carlo incidents to JanusGraph',
+    )
+    parser.add_argument("--topic", help="The topic to which the crawled records are written", required=True)
+    parser.add_argument("--group_id", help="The consumer group id for the service", required=True)
+    parser.add_argument("--doc_type", help="The document type to be consumed from Kafka", default="mc_incident",
+                        required=False)
+    parser.add_argument("--batch-size", help="Maximum number of incidents upserted per request", type=int, default=500,
+                        required=False)
+    parser.add_argument("--flush-interval-ms", help="Maximum time an incident waits for its batch to fill", type=int,
+                        default=5000, required=False)
+    parser.add_argument("--vertex-cache-size", help="Maximum number of table and warehouse vertex ids cached", type=int,
+                        default=100000, required=False)
+    parser.add_argument("--vertex-cache-ttl", help="Seconds a cached vertex id is used before it is looked up again",
+                        type=float, required=False)
+
+    args = parser.parse_args()
+    bootstrap(topic=args.topic,
+              group_id=args.group_id,
+              doc_type=args.doc_type,
+              batch_size=args.batch_size,
+              flush_interval_ms=args.flush_interval_ms,
+              vertex_cache_size=args.vertex_cache_size,
+              vertex_cache_ttl=args.vertex_cache_ttl)
@@ -0,0 +1,249 @@
+import time
+import logging
+
+from core.connection_wrappers.kafka_wrapper import OffsetTracker
+from core.connection_wrappers.kafka_codecs import decode_message
+from core.connection_wrappers.janusgraph_wrapper import from_graphson
+from core.utils.vertex_id_cache import VertexIdCache
+
+
+'''
+Loads the lineage carried by Monte Carlo incidents into JanusGraph:
+
+    (incident {uuid}) -[affects]-> (table {mcon}) -[stored_in]-> (warehouse {uuid})
+
+Incidents are consumed in micro-batches of up to batch_size messages (or whatever arrived within flush_interval). A
+batch is coalesced before anything is sent: the vertices of the batch are merged by natural key, so a table or
+warehouse that appears in many incidents is upserted once with its latest properties, and duplicate edges are dropped.
+The whole batch is then upserted by UPSERT_SCRIPT in a single request: one constant script, so the server compiles it
+once, with the vertices and edges of the batch passed as bindings. The script runs in one transaction.
+
+Upserts are idempotent (get-or-create on the natural key, edges created only when missing), so a batch consumed again
+after a restart changes nothing. Offsets are committed once the batch is upserted. If the upsert fails the loader
+stops without committing the batch.
+
+The ids of table and warehouse vertices, which recur across incidents, are kept in a VertexIdCache. A cached vertex
+is fetched by id instead of being looked up through the index on its key, and if its properties did not change since
+they were written it is not fetched at all: the ids of all such vertices of a batch are only checked to still exist,
+with a single multi-get. A cached vertex that no longer exists is upserted like an uncached one. When an upsert fails,
+the cached ids it used are invalidated.
+
+Get-or-create is not atomic across transactions: running loaders against the same tables from different consumer
+groups needs a unique index on the natural keys to avoid duplicate vertices.
+'''
+
+UPSERT_SCRIPT = """
+def ids = [:]
+def found = unchanged ? g.V(unchanged.collect { it.id }).id().toList().collect { it.toString() } as Set : [] as Set
+for (v in unchanged) {
+    if (found.contains(v.id.toString())) { ids[v.ref] = v.id } else { vertices << v }
+}
+for (v in vertices) {
+    def vertex = v.id == null ? null : g.V(v.id).tryNext().orElse(null)
+    if (vertex == null) {
+        vertex = g.V().has(v.label, v.key, v.value).fold().coalesce(__.unfold(), __.addV(v.label).property(v.key, v.value)).next()
+    }
+    v.properties.each { name, value -> vertex.property(name, value) }
+    ids[v.ref] = vertex.id()
+}
+for (e in edges) {
+    g.V(ids[e.out]).as('out').V(ids[e.in]).coalesce(__.inE(e.label).where(__.outV().as('out')), __.addE(e.label).from('out')).iterate()
+}
+[ids]
+"""
+
+INCIDENT_PROPERTIES = ("title", "priority", "status", "incident_type", "created_time")
+# vertex property -> field of warehouse_info, "id" is reserved for the vertex id
+WAREHOUSE_PROPERTIES = {"dw_id": "id", "name": "name", "connection_type": "connection_type"}
+# Labels of the vertices whose ids are cached, incidents rarely come up twice
+CACHED_LABELS = ("table", "warehouse")
+
+
+class MonteCarloLineageLoaderException(Exception):
+    pass
+
+
+class LineageBatch:
+    '''
+    Coalesces the vertices and edges of a micro-batch of incidents.
+    '''
+
+    def __init__(self):
+        # ref -> {"ref", "label", "key", "value", "properties"}
+        self.vertices = {}
+        # (out ref, label, in ref) -> None, in the order they were found
+        self.edges = {}
+        self.incidents = 0
+        self.coalesced = 0
+
+    def add(self, doc):
+        payload = doc.get("payload", {})
+        node = payload.get("node", {})
+        if not node.get("uuid"):
+            return
+        self.incidents += 1
+        incident = self.__vertex("incident", "uuid", node["uuid"],
+                                 {name: node.get(name) for name in INCIDENT_PROPERTIES},
+                                 user_id=payload.get("user_id") or doc.get("user_id"),
+                                 mc_dw_id=payload.get("mc_dw_id"))
+        warehouse_info = payload.get("warehouse_info") or {}
+        warehouse = None
+        if warehouse_info.get("uuid"):
+            warehouse = self.__vertex("warehouse", "uuid", warehouse_info["uuid"],
+                                      {name: warehouse_info.get(field) for name, field in WAREHOUSE_PROPERTIES.items()})
+        for mcon in node.get("tables") or ():
+            table = self.__vertex("table", "mcon", mcon, {}, mc_dw_id=payload.get("mc_dw_id"))
+            self.__edge(incident, "affects", table)
+            if warehouse:
+                self.__edge(table, "stored_in", warehouse)
+
+    def to_query(self, vertex_cache=None):
+        """
+        :param vertex_cache: VertexIdCache, the vertices it holds are sent with their id
+        """
+        vertices = []
+        unchanged = []
+        for ref, vertex in self.vertices.items():
+            cached = vertex_cache.get(ref) if vertex_cache and vertex["label"] in CACHED_LABELS else None
+            if cached is None:
+                vertices.append(dict(vertex, id=None))
+            elif cached[1] == vertex["properties"]:
+                unchanged.append(dict(vertex, id=cached[0]))
+            else:
+                vertices.append(dict(vertex, id=cached[0]))
+        return {"gremlin": UPSERT_SCRIPT,
+                "bindings": {"vertices": vertices,
+                             "unchanged": unchanged,
+                             "edges": [{"out": out_ref, "label": label, "in": in_ref}
+                                       for out_ref, label, in_ref in self.edges]}}
+
+    def __vertex(self, label, key, value, properties, **extra_properties):
+        ref = f"{label}:{value}"
+        properties = {name: value for name, value in dict(properties, **extra_properties).items()
+                      if value is not None and name != key}
+        vertex = self.vertices.get(ref)
+        if vertex is None:
+            self.vertices[ref] = {"ref": ref, "label": label, "key": key, "value": value, "properties": properties}
+        else:
+            # Later incidents carry the latest properties
+            vertex["properties"].update(properties)
+            self.coalesced += 1
+        return ref
+
+    def __edge(self, out_ref, label, in_ref):
+        edge = (out_ref, label, in_ref)
+        if edge in self.edges:
+            self.coalesced += 1
+        self.edges[edge] = None
+
+
+class MonteCarloLineageLoader:
+
+    def __init__(self, jg_ctx, consumer_ctx, doc_type="mc_incident", batch_size=500, flush_interval=5,
+                 report_interval=30, vertex_cache=None):
+        self.__jg_ctx = jg_ctx
+        self.__vertex_cache = vertex_cache or VertexIdCache()
+        self.__consumer_ctx = consumer_ctx
+        self.__doc_type = doc_type
+        self.__batch_size = batch_size
+        self.__flush_interval = flush_interval
+        self.__report_interval = report_interval
+
+        self.__tracker = OffsetTracker()
+        self.__batch = LineageBatch()
+        self.__messages = []
+        self.__last_flush = time.time()
+        self.__stopped = False
+        self.__failure = None
+        self.__closed = False
+        self.__started_at = None
+        self.__metrics = {"incidents": 0, "vertices": 0, "edges": 0, "coalesced": 0, "requests": 0,
+                          "upsert_seconds": 0.0}
+
+        consumer_ctx.set_rebalance_callbacks(on_revoke=self.__on_revoke)
+
+    def execute(self):
+        self.__started_at = time.time()
+        last_report = time.time()
+        try:
+            while not self.__stopped:
+                for message in self.__consumer_ctx.consume_filtered({"doc_type": self.__doc_type}, raw=True,
+                                                                    on_skip=self.__on_skipped):
+                    self.__tracker.track(message.topic(), message.partition(), message.offset())
+                    self.__batch.add(decode_message(message))
+                    self.__messages.append(message)
+                    if len(self.__messages) >= self.__batch_size:
+                        self.__flush()
+                if time.time() - self.__last_flush >= self.__flush_interval:
+                    self.__flush()
+                if time.time() - last_report >= self.__report_interval:
+                    logging.info(f"Lineage loader stats: {self.stats()}")
+                    last_report = time.time()
+        except Exception as e:
+            self.__failure = e
+            raise
+        finally:
+            self.close()
+
+    def stop(self):
+        '''
+        Makes execute() return after the current consume. Safe to call from a signal handler or another thread.
+        '''
+        self.__stopped = True
+
+    def close(self):
+        '''
+        Upserts the pending batch (unless the loader failed) and commits it.
+        '''
+        if self.__closed:
+            return
+        self.__closed = True
+        if self.__failure is None:
+            self.__flush(is_asynchronous_commit=False)
+        logging.info(f"Lineage loader stats: {self.stats()}")
+
+    def stats(self):
+        stats = dict(self.__metrics)
+        stats["upsert_seconds"] = round(stats["upsert_seconds"], 3)
+        elapsed = time.time() - self.__started_at if self.__started_at else 0
+        stats["incidents_per_s"] = round(stats["incidents"] / elapsed, 1) if elapsed else 0.0
+        stats["vertex_cache"] = self.__vertex_cache.stats()
+        return stats
+
+    def __flush(self, is_asynchronous_commit=True):
+        batch, messages = self.__batch, self.__messages
+        self.__batch, self.__messages = LineageBatch(), []
+        self.__last_flush = time.time()
+        if batch.vertices:
+            start = time.perf_counter()
+            try:
+                response = self.__jg_ctx.execute(batch.to_query(self.__vertex_cache))
+                ids = from_graphson(response.json()["result"]["data"])[0]
+                if len(ids) != len(batch.vertices):
+                    raise MonteCarloLineageLoaderException(f"Upserted {len(ids)} of {len(batch.vertices)} vertices")
+            except Exception:
+                # A cached id that no longer resolves may be what failed the upsert
+                self.__vertex_cache.invalidate(*batch.vertices)
+                raise
+            for ref, vertex in batch.vertices.items():
+                if vertex["label"] in CACHED_LABELS:
+                    self.__vertex_cache.put(ref, ids[ref], vertex["properties"])
+            self.__metrics["upsert_seconds"] += time.perf_counter() - start
+            self.__metrics["requests"] += 1
+            self.__metrics["vertices"] += len(batch.vertices)
+            self.__metrics["edges"] += len(batch.edges)
+            self.__metrics["coalesced"] += batch.coalesced
+        self.__metrics["incidents"] += batch.incidents
+        for message in messages:
+            self.__tracker.ack(message.topic(), message.partition(), message.offset())
+        self.__consumer_ctx.commit_offsets(self.__tracker.committable(), is_asynchronous_commit=is_asynchronous_commit)
+
+    def __on_skipped(self, message):
+        self.__tracker.track(message.topic(), message.partition(), message.offset())
+        self.__tracker.ack(message.topic(), message.partition(), message.offset())
+
+    def __on_revoke(self, partitions):
+        # Upsert and commit what was consumed from the revoked partitions while they are still assigned
+        if self.__failure is None:
+            self.__flush(is_asynchronous_commit=False)
+        self.__tracker.forget(partitions)
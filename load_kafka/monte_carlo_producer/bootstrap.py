@@ -4,10 +4,11 @@ import argparse
 import traceback
 
 from core.connection_wrappers.cassandra_wrapper import CassandraContext
-from core.connection_wrappers.kafka_wrapper import KafkaProducerContext
+from core.connection_wrappers.kafka_wrapper import KafkaProducerContext, PRODUCER_PROFILES
 
 from plugins.fetch_from_monte_carlo import MonteCarloConnector
 from core.utils.constants import CASSANDRA_SEEDS, KAFKA_SEEDS, CONNECTOR_CONFIG_TABLE, AUTH_VARIABLES
+from core.utils.constants import CONNECTOR_CHECKPOINT_TABLE, CONNECTOR_DIGEST_TABLE
 
 
 '''
@@ -15,21 +16,37 @@ CLI Params:
 --user_id 
 --connector_id
 --topic
-
+--workers
+--rate_limit
+--burst
+--lookback_hours
+--full_refresh
+--dedup_cache_size
+--codec
+--producer_profile
 '''
 
-def bootstrap(user_id, connector_id, topic):
+def bootstrap(user_id, connector_id, topic, workers=8, rate_limit=10, burst=None, lookback_hours=24,
+              full_refresh=False, dedup_cache_size=100000, codec="json", producer_profile="default"):
     cassandra_auth = {"username": os.environ.get(AUTH_VARIABLES["username"]),
                       "password": os.environ.get(AUTH_VARIABLES["password"])}
     cassandra_ctx = CassandraContext(CASSANDRA_SEEDS, **{"auth": cassandra_auth})
-    producer_ctx = KafkaProducerContext(KAFKA_SEEDS)
+    producer_ctx = KafkaProducerContext(KAFKA_SEEDS, doc_type_codecs={"mc_incident": codec}, profile=producer_profile)
     try:
         plugin_obj = MonteCarloConnector(user_id=user_id,
                                          connector_id=connector_id,
                                          cassandra_ctx=cassandra_ctx,
                                          producer_ctx=producer_ctx,
                                          config_table=CONNECTOR_CONFIG_TABLE,
-                                         topic=topic)
+                                         topic=topic,
+                                         workers=workers,
+                                         rate_limit=rate_limit,
+                                         burst=burst,
+                                         checkpoint_table=CONNECTOR_CHECKPOINT_TABLE,
+                                         lookback_hours=lookback_hours,
+                                         full_refresh=full_refresh,
+                                         digest_table=CONNECTOR_DIGEST_TABLE,
+                                         dedup_cache_size=dedup_cache_size)
         plugin_obj.execute()
     except Exception as e:
         logging.error(e)
@@ -48,8 +65,33 @@ if __name__ == "__main__":
     parser.add_argument('--user_id', help="The user_id that triggered the connector", required=True)
     parser.add_argument('--connector_id', help="The unique identifier for the service", required=True)
     parser.add_argument("--topic", help="The topic to which the crawled records are written", required=True)
+    parser.add_argument("--workers", help="Number of warehouses crawled concurrently", type=int, default=8,
+                        required=False)
+    parser.add_argument("--rate_limit", help="Maximum Monte Carlo API requests per second", type=float, default=10,
+                        required=False)
+    parser.add_argument("--burst", help="Maximum burst of API requests above the rate limit. Defaults to the rate "
+                                        "limit", type=int, required=False)
+    parser.add_argument("--lookback_hours", help="Incidents created this long before the last crawl's latest incident "
+                                                 "are crawled again, to pick up changes", type=float, default=24,
+                        required=False)
+    parser.add_argument("--full_refresh", "--full-refresh", help="Ignore the crawl checkpoints and crawl every "
+                                                                 "incident", action="store_true")
+    parser.add_argument("--dedup_cache_size", help="Incident fingerprints kept in memory to suppress unchanged incidents",
+                        type=int, default=100000, required=False)
+    parser.add_argument("--codec", help="Codec of the produced incidents. Consumers pick it up from the message header",
+                        choices=["json", "msgpack", "mc_incident"], default="json", required=False)
+    parser.add_argument("--producer_profile", help="Kafka producer settings, see PRODUCER_PROFILES",
+                        choices=sorted(PRODUCER_PROFILES), default="default", required=False)
 
     args = parser.parse_args()
     bootstrap(user_id=args.user_id,
               connector_id=args.connector_id,
-              topic=args.topic)
+              topic=args.topic,
+              workers=args.workers,
+              rate_limit=args.rate_limit,
+              burst=args.burst,
+              lookback_hours=args.lookback_hours,
+              full_refresh=args.full_refresh,
+              dedup_cache_size=args.dedup_cache_size,
+              codec=args.codec,
+              producer_profile=args.producer_profile)
@@ -0,0 +1,53 @@
+from datetime import datetime, timezone
+
+
+class CrawlCheckpointStore:
+    '''
+    Per-source crawl checkpoints of a connector, stored in the connector_checkpoint table (one row per
+    (user_id, connector_id, source_id), a source being e.g. a Monte Carlo warehouse).
+
+    * high_water_mark: latest createdTime of the last completed crawl. The next crawl starts from there
+    * run_start_time, run_high_water_mark, cursor: progress of a crawl that has not completed yet. cursor is the end
+      cursor of the last page whose records were delivered, so a crawl that crashed resumes after it, with the same
+      start time the cursor was issued for
+    '''
+
+    def __init__(self, cassandra_ctx, checkpoint_table, user_id, connector_id):
+        self.__cassandra_ctx = cassandra_ctx
+        self.__checkpoint_table = checkpoint_table
+        self.__user_id = user_id
+        self.__connector_id = connector_id
+
+    def load(self):
+        '''
+        :return: dict {source_id: {"high_water_mark", "run_start_time", "run_high_water_mark", "cursor"}}
+        '''
+        query = f"SELECT source_id, high_water_mark, run_start_time, run_high_water_mark, cursor " \
+                f"FROM {self.__checkpoint_table} WHERE user_id=? AND connector_id=?"
+        rows = self.__cassandra_ctx.exec_read(query, (self.__user_id, self.__connector_id), prepared=True)
+        return {row[0]: {"high_water_mark": as_utc(row[1]),
+                         "run_start_time": as_utc(row[2]),
+                         "run_high_water_mark": as_utc(row[3]),
+                         "cursor": row[4]} for row in rows}
+
+    def save_progress(self, source_id, high_water_mark, run_start_time, run_high_water_mark, cursor):
+        self.__save(source_id, high_water_mark, run_start_time, run_high_water_mark, cursor)
+
+    def save_complete(self, source_id, high_water_mark):
+        self.__save(source_id, high_water_mark, None, None, None)
+
+    def __save(self, source_id, high_water_mark, run_start_time, run_high_water_mark, cursor):
+        query = f"INSERT INTO {self.__checkpoint_table} (user_id, connector_id, source_id, high_water_mark, " \
+                f"run_start_time, run_high_water_mark, cursor, lupdt) VALUES (?, ?, ?, ?, ?, ?, ?, ?)"
+        self.__cassandra_ctx.exec_write(query, (self.__user_id, self.__connector_id, source_id, high_water_mark,
+                                                run_start_time, run_high_water_mark, cursor,
+                                                datetime.now(timezone.utc)), prepared=True)
+
+
+def as_utc(value):
+    '''
+    The driver returns timestamp columns as naive UTC datetimes.
+    '''
+    if value is not None and value.tzinfo is None:
+        return value.replace(tzinfo=timezone.utc)
+    return value
@@ -0,0 +1,148 @@
+import json
+import logging
+import hashlib
+import threading
+
+from datetime import datetime, timezone
+from collections import OrderedDict
+
+# Fields stamped at crawl time, that change on every crawl without the record changing
+VOLATILE_FIELDS = ("timestamp",)
+# Record ids per digest read, a single IN query over the clustering key of one partition
+READ_BATCH_SIZE = 100
+# Seconds a stored digest is kept after it was last written. An expired digest only means the record is produced again
+DIGEST_TTL = 30 * 24 * 3600
+
+
+def fingerprint(payload, volatile_fields=VOLATILE_FIELDS):
+    stable = {key: value for key, value in payload.items() if key not in volatile_fields}
+    serialized = json.dumps(stable, sort_keys=True, separators=(",", ":"), default=str)
+    return hashlib.blake2b(serialized.encode("utf-8"), digest_size=16).hexdigest()
+
+
+class DigestStore:
+    '''
+    Persistent digests of the records last produced by a connector, in the connector_record_digest table (one row per
+    (user_id, connector_id, source_id, record_id)). Digests are written with a TTL of ttl seconds, so the rows of
+    records that are no longer crawled expire instead of growing the table forever.
+    '''
+
+    def __init__(self, cassandra_ctx, digest_table, user_id, connector_id, ttl=DIGEST_TTL):
+        self.__cassandra_ctx = cassandra_ctx
+        self.__digest_table = digest_table
+        self.__user_id = user_id
+        self.__connector_id = connector_id
+        self.__ttl = ttl
+
+    def get(self, source_id, record_id):
+        return self.get_many(source_id, [record_id]).get(record_id)
+
+    def get_many(self, source_id, record_ids):
+        '''
+        :return: dict {record_id: digest} of the records that have a digest
+        '''
+        query = f"SELECT record_id, digest FROM {self.__digest_table} " \
+                f"WHERE user_id=? AND connector_id=? AND source_id=? AND record_id IN ?"
+        digests = {}
+        for start in range(0, len(record_ids), READ_BATCH_SIZE):
+            rows = self.__cassandra_ctx.exec_read(query, (self.__user_id, self.__connector_id, source_id,
+                                                          list(record_ids[start:start + READ_BATCH_SIZE])),
+                                                  prepared=True)
+            digests.update((row[0], row[1]) for row in rows)
+        return digests
+
+    def save_many(self, source_id, digests):
+        '''
+        :param digests: list of (record_id, digest)
+        '''
+        query = f"INSERT INTO {self.__digest_table} (user_id, connector_id, source_id, record_id, digest, lupdt) " \
+                f"VALUES (?, ?, ?, ?, ?, ?) USING TTL ?"
+        now = datetime.now(timezone.utc)
+        failures = self.__cassandra_ctx.exec_write_many(
+            query, [(self.__user_id, self.__connector_id, source_id, record_id, digest, now, self.__ttl)
+                    for record_id, digest in digests])
+        if failures:
+            # A lost digest only means the record is produced again on the next crawl
+            logging.warning(f"Failed to save {len(failures)} of {len(digests)} digests of source {source_id}: "
+                            f"{failures[0][1]}")
+
+
+class RecordDeduplicator:
+    '''
+    Suppresses records whose content has not changed since they were last produced. A record is identified by
+    (source_id, record_id) and its content by the blake2b fingerprint of its payload without the VOLATILE_FIELDS.
+
+    Known fingerprints are kept in a bounded LRU and, optionally, in a DigestStore so that they survive between crawls.
+    prefetch() reads the stored fingerprints of a page of records in bulk, so that checking them costs one read per
+    page rather than one per record that is not in the LRU. New fingerprints are only written to the store by
+    commit(), which the caller invokes once the records are delivered, so a record that was never delivered is never
+    suppressed.
+    '''
+
+    def __init__(self, max_entries=100000, digest_store=None):
+        self.__max_entries = max_entries
+        self.__digest_store = digest_store
+        self.__lock = threading.Lock()
+        self.__digests = OrderedDict()
+        # (source_id, record_id) -> stored digest or None, read by prefetch() and not checked yet
+        self.__prefetched = {}
+        # source_id -> [(record_id, digest)] not yet written to the digest store
+        self.__uncommitted = {}
+        self.__metrics = {"checked": 0, "suppressed": 0}
+
+    def prefetch(self, source_id, record_ids):
+        '''
+        Reads the stored fingerprints of the records that are not in the LRU, in bulk.
+        '''
+        if not self.__digest_store:
+            return
+        with self.__lock:
+            missing = list(dict.fromkeys(record_id for record_id in record_ids
+                                         if (source_id, record_id) not in self.__digests))
+        if not missing:
+            return
+        stored = self.__digest_store.get_many(source_id, missing)
+        with self.__lock:
+            for record_id in missing:
+                self.__prefetched[(source_id, record_id)] = stored.get(record_id)
+
+    def is_unchanged(self, source_id, record_id, payload):
+        digest = fingerprint(payload)
+        key = (source_id, record_id)
+        with self.__lock:
+            known = self.__digests.get(key)
+            if known is not None:
+                self.__digests.move_to_end(key)
+            prefetched = key in self.__prefetched
+            stored = self.__prefetched.pop(key, None)
+        if known is None:
+            if prefetched:
+                known = stored
+            elif self.__digest_store:
+                known = self.__digest_store.get(source_id, record_id)
+
+        with self.__lock:
+            self.__metrics["checked"] += 1
+            if known == digest:
+                self.__metrics["suppressed"] += 1
+                self.__remember(key, digest)
+                return True
+            self.__remember(key, digest)
+            self.__uncommitted.setdefault(source_id, []).append((record_id, digest))
+            return False
+
+    def commit(self, source_id):
+        with self.__lock:
+            digests = self.__uncommitted.pop(source_id, [])
+        if digests and self.__digest_store:
+            self.__digest_store.save_many(source_id, digests)
+
+    def stats(self):
+        with self.__lock:
+            return dict(self.__metrics)
+
+    def __remember(self, key, digest):
+        self.__digests[key] = digest
+        self.__digests.move_to_end(key)
+        if len(self.__digests) > self.__max_entries:
+            self.__digests.popitem(last=False)
@@ -1,12 +1,76 @@
-import json
 import time
+import logging
+import threading
 
-from datetime import datetime
+from datetime import datetime, timedelta
+from functools import partial
+from concurrent.futures import ThreadPoolExecutor, as_completed
 from pycarlo.core import Client, Query, Session
 
+from core.utils.config_cache import ConfigCache
+from plugins.rate_limiter import TokenBucket
+from plugins.checkpoints import CrawlCheckpointStore, as_utc
+from plugins.dedup import RecordDeduplicator, DigestStore
+
+WAREHOUSES_QUERY = '''
+    query getUser {
+      getUser {
+        account {
+          warehouses {
+            uuid
+            id
+            createdOn
+            connectionType
+            name
+          }
+        }
+      }
+    }
+'''
+
+INCIDENTS_QUERY = '''
+    query getIncidents($dwId: UUID, $after: String, $startTime: DateTime) {
+      getIncidents(dwId: $dwId, after: $after, startTime: $startTime) {
+        edges {
+          node {
+            id
+            uuid
+            title
+            tables
+            createdTime
+            type
+            subTypes
+            priority
+            status
+            project
+            dataset
+            incidentType
+          }
+        },
+        pageInfo {
+            endCursor
+            hasNextPage
+        }
+      }
+    }
+'''
+
 class MonteCarloConnectorException(Exception):
     pass
 
+
+def created_time(incident):
+    value = incident.get("node", {}).get("created_time")
+    if not value:
+        return None
+    return as_utc(datetime.fromisoformat(value.replace("Z", "+00:00")))
+
+
+def latest(first, second):
+    if first is None or second is None:
+        return first or second
+    return max(first, second)
+
 class MonteCarloConnector:
     '''
     Plugin to pull data from Monte Carlo and dump to a kafka topic.
@@ -24,9 +88,24 @@ class MonteCarloConnector:
             "include_statuses": <In case only selected incidents are to be fetched>,
             "exclude_statuses": <In case a subset of incidents are not to be fetched>
     }
+
+    Warehouses are crawled concurrently by up to `workers` threads. All requests to the API go through a shared token
+    bucket (`rate_limit` requests per second, bursts of up to `burst`). mc_client can be any callable taking
+    (query, variables=None) like pycarlo's Client, e.g. a RecordedMonteCarloClient to crawl offline.
+
+    Crawls are incremental when a checkpoint_table is given (see CrawlCheckpointStore). A warehouse is crawled from the
+    latest createdTime of its last completed crawl, minus `lookback_hours`: startTime filters on creation time, so the
+    lookback is what picks up recent incidents that changed since the last crawl. A crawl that did not complete resumes
+    from its last checkpointed cursor. full_refresh ignores the checkpoints and crawls every incident again.
+
+    Incidents whose content did not change since they were last produced are suppressed (see RecordDeduplicator), from
+    an LRU of `dedup_cache_size` fingerprints and, when a digest_table is given, from the digests persisted by earlier
+    crawls. full_refresh produces every incident regardless.
     '''
 
-    def __init__(self, user_id, connector_id, cassandra_ctx, producer_ctx, config_table, topic):
+    def __init__(self, user_id, connector_id, cassandra_ctx, producer_ctx, config_table, topic, workers=8,
+                 rate_limit=10, burst=None, mc_client=None, checkpoint_table=None, lookback_hours=24,
+                 full_refresh=False, digest_table=None, dedup_cache_size=100000, config_cache=None):
         self.__connector_type = "monte_carlo_crawler"
         self.__connector_id = connector_id
         self.__user_id = user_id
@@ -34,121 +113,158 @@ class MonteCarloConnector:
         self.__producer_ctx = producer_ctx
         self.__topic = topic
         self.__config = self.__get_config_from_cassandra(
-            config_table=config_table
+            config_cache=config_cache or ConfigCache(cassandra_ctx, tables={"connector": config_table})
         )
-        self.__mc_client = self.__get_client()
+        self.__mc_client = mc_client or self.__get_client()
+        self.__workers = workers
+        self.__rate_limiter = TokenBucket(rate=rate_limit, capacity=burst)
+        self.__checkpoint_store = None
+        if checkpoint_table:
+            self.__checkpoint_store = CrawlCheckpointStore(cassandra_ctx=cassandra_ctx,
+                                                           checkpoint_table=checkpoint_table,
+                                                           user_id=user_id,
+                                                           connector_id=connector_id)
+        self.__lookback = timedelta(hours=lookback_hours)
+        self.__full_refresh = full_refresh
+        digest_store = None
+        if digest_table:
+            digest_store = DigestStore(cassandra_ctx=cassandra_ctx,
+                                       digest_table=digest_table,
+                                       user_id=user_id,
+                                       connector_id=connector_id)
+        self.__deduplicator = RecordDeduplicator(max_entries=dedup_cache_size, digest_store=digest_store)
+        self.__delivery_lock = threading.Lock()
+        # warehouse uuid -> errors of the deliveries of its incidents that failed since its last flush
+        self.__delivery_failures = {}
 
 
-    def __get_config_from_cassandra(self, config_table):
-        query = f"SELECT JSON blobAsText(auth_conf), blobAsText(service_conf) from {config_table} where connector_id='{self.__connector_id}' and user_id='{self.__user_id} LIMIT 1"
-        conf_row = self.__cassandra_ctx.exec_read(query)
-        if conf_row:
-            config = json.loads(conf_row[0][0])
+    def __get_config_from_cassandra(self, config_cache):
+        config = config_cache.get("connector", self.__connector_id, self.__user_id)
+        if config:
             return config
         else:
             raise MonteCarloConnectorException("Configuration not found for the service. Please recheck input parameters")
 
     def execute(self):
         # Get a list of all warehouses associated with a user
-        warehouses_query = '''
-            query getUser {
-              getUser {
-                account {
-                  warehouses {
-                    uuid
-                    id
-                    createdOn
-                    connectionType
-                    name
-                  }
-                }
-              }
-            }
-        '''
-        warehouse_response = self.__mc_client(warehouses_query)
+        warehouse_response = self.__query(WAREHOUSES_QUERY)
         warehouses = warehouse_response['get_user']['account']['warehouses']
+        checkpoints = {}
+        if self.__checkpoint_store and not self.__full_refresh:
+            checkpoints = self.__checkpoint_store.load()
+
+        # Warehouses are crawled concurrently. Page fetches run on their own pool, so a warehouse worker waiting on
+        # its next page never holds the slot the fetch needs
+        failed_warehouses = []
+        with ThreadPoolExecutor(max_workers=self.__workers, thread_name_prefix="mc-warehouse") as warehouse_pool, \
+                ThreadPoolExecutor(max_workers=self.__workers, thread_name_prefix="mc-page") as page_pool:
+            crawls = {warehouse_pool.submit(self.__crawl_warehouse, warehouse, checkpoints.get(warehouse["uuid"]),
+                                            page_pool): warehouse
+                      for warehouse in warehouses}
+            for crawl in as_completed(crawls):
+                warehouse = crawls[crawl]
+                try:
+                    n_incidents = crawl.result()
+                    logging.info(f"Crawled {n_incidents} incidents from warehouse {warehouse['uuid']}")
+                except Exception as e:
+                    logging.error(f"Crawl of warehouse {warehouse['uuid']} failed: {e}")
+                    failed_warehouses.append(warehouse["uuid"])
+        dedup_stats = self.__deduplicator.stats()
+        logging.info(f"Suppressed {dedup_stats['suppressed']} of {dedup_stats['checked']} incidents as unchanged")
+        if failed_warehouses:
+            raise MonteCarloConnectorException(f"Crawl failed for warehouses: {', '.join(failed_warehouses)}")
 
-        dw_incident_query = '''
-            query getIncidents{
-              getIncidents(
-                dwId: {}
-              ) {
-                edges {
-                  node {
-                    id
-                    uuid
-                    title
-                    tables
-                    createdTime
-                    type
-                    subTypes
-                    priority
-                    status
-                    project
-                    dataset
-                    incidentType
-                  }
-                },
-                pageInfo {
-                    endCursor
-                    hasNextPage
-                }
-              }
-            }
-        '''
 
-        dw_incident_pagination_query = '''
-            query getIncidents{
-              getIncidents(
-                dwId: {}
-                after: {}
-              ) {
-                edges {
-                  node {
-                    id
-                    uuid
-                    title
-                    tables
-                    createdTime
-                    type
-                    subTypes
-                    priority
-                    status
-                    project
-                    dataset
-                    incidentType
-                  }
-                },
-                pageInfo {
-                    endCursor
-                    hasNextPage
-                }
-              }
-            }
+    def __crawl_warehouse(self, warehouse, checkpoint, page_pool):
         '''
+        Pushes the incidents of a page to kafka while the next page is in flight.
+        :return: number of incidents pushed, not counting the ones suppressed as unchanged
+        '''
+        warehouse_uuid = warehouse["uuid"]
+        checkpoint = checkpoint or {}
+        high_water_mark = checkpoint.get("high_water_mark")
+        if checkpoint.get("cursor"):
+            start_time = checkpoint["run_start_time"]
+            run_high_water_mark = checkpoint["run_high_water_mark"]
+            after = checkpoint["cursor"]
+            logging.info(f"Resuming crawl of warehouse {warehouse_uuid} after cursor {after}")
+        else:
+            start_time = high_water_mark - self.__lookback if high_water_mark else None
+            run_high_water_mark = None
+            after = None
 
-        # Get incidents
-        for warehouse in warehouses:
-            warehouse_id = warehouse["id"]
-            warehouse_uuid = warehouse["uuid"]
-            # Need to check if
-            incident_response = self.__mc_client(dw_incident_query.format(warehouse_uuid))
+        n_incidents = 0
+        page = page_pool.submit(self.__fetch_incidents, warehouse_uuid, start_time, after)
+        while page is not None:
+            incident_response = page.result()
             pages = incident_response['get_incidents']['page_info']
             incidents = incident_response['get_incidents']['edges']
-            while True:
-                for incident in incidents:
-                    incident["mc_dw_id"] = warehouse_id
-                    incident["user_id"] = self.__user_id
-                    incident["warehouse_info"] = warehouse
-                    incident["timestamp"] = datetime.isoformat(datetime.now())
-                    self.__push_to_kafka(payload = incident, doc_type="mc_incident")
-                if not pages["has_next_page"]:
-                    break
-                incident_response = self.__mc_client(dw_incident_pagination_query.format(warehouse_uuid,
-                                                                                         pages["end_cursor"]))
-                pages = incident_response['get_incidents']['page_info']
-                incidents = incident_response['get_incidents']['edges']
+            page = None
+            if pages["has_next_page"]:
+                page = page_pool.submit(self.__fetch_incidents, warehouse_uuid, start_time, pages["end_cursor"])
+            if not self.__full_refresh:
+                # One digest read for the page instead of one per incident
+                self.__deduplicator.prefetch(warehouse_uuid, [incident["node"]["uuid"] for incident in incidents
+                                                              if incident.get("node", {}).get("uuid")])
+            for incident in incidents:
+                incident["mc_dw_id"] = warehouse["id"]
+                incident["user_id"] = self.__user_id
+                incident["warehouse_info"] = warehouse
+                incident["timestamp"] = datetime.isoformat(datetime.now())
+                run_high_water_mark = latest(run_high_water_mark, created_time(incident))
+                if self.__is_unchanged(warehouse_uuid, incident):
+                    continue
+                self.__push_to_kafka(payload=incident, doc_type="mc_incident", source_id=warehouse_uuid)
+                n_incidents += 1
+            if self.__checkpoint_store and pages["has_next_page"]:
+                # The cursor (and the digests) are only checkpointed once the incidents before it are delivered
+                self.__flush(warehouse_uuid)
+                self.__deduplicator.commit(warehouse_uuid)
+                self.__checkpoint_store.save_progress(warehouse_uuid, high_water_mark, start_time,
+                                                      run_high_water_mark, pages["end_cursor"])
+
+        self.__flush(warehouse_uuid)
+        self.__deduplicator.commit(warehouse_uuid)
+        if self.__checkpoint_store:
+            self.__checkpoint_store.save_complete(warehouse_uuid, latest(high_water_mark, run_high_water_mark))
+        return n_incidents
+
+
+    def __flush(self, warehouse_uuid):
+        '''
+        Waits for the produced incidents to be delivered. Raises if the delivery of any incident of the warehouse
+        failed, so that no checkpoint or digest of the warehouse is saved past an incident that was lost. Failures of
+        the other warehouses, crawled concurrently, are left to their own flush.
+        '''
+        self.__producer_ctx.flush()
+        with self.__delivery_lock:
+            errors = self.__delivery_failures.pop(warehouse_uuid, [])
+        if errors:
+            raise MonteCarloConnectorException(f"{len(errors)} incidents of warehouse {warehouse_uuid} could not be "
+                                               f"delivered to kafka: {errors[-1]}")
+
+    def __on_delivery(self, warehouse_uuid, err, msg):
+        if err is not None:
+            with self.__delivery_lock:
+                self.__delivery_failures.setdefault(warehouse_uuid, []).append(str(err))
+
+
+    def __is_unchanged(self, warehouse_uuid, incident):
+        record_id = incident.get("node", {}).get("uuid")
+        if self.__full_refresh or not record_id:
+            return False
+        return self.__deduplicator.is_unchanged(warehouse_uuid, record_id, incident)
+
+
+    def __fetch_incidents(self, warehouse_uuid, start_time, after):
+        variables = {"dwId": warehouse_uuid, "after": after,
+                     "startTime": start_time.isoformat() if start_time else None}
+        return self.__query(INCIDENTS_QUERY, variables=variables)
+
 
+    def __query(self, query, variables=None):
+        self.__rate_limiter.acquire()
+        return self.__mc_client(query, variables=variables)
 
     def __get_client(self):
         auth_conf = self.__config["auth_conf"]
@@ -159,7 +275,7 @@ class MonteCarloConnector:
         client = Client(session=Session(mcd_id=mcd_id, mcd_token=mcd_token))
         return client
 
-    def __push_to_kafka(self, payload, doc_type):
+    def __push_to_kafka(self, payload, doc_type, source_id):
         message = {
             "doc_type": doc_type,
             "user_id": self.__user_id,
@@ -173,4 +289,5 @@ class MonteCarloConnector:
         }
         self.__producer_ctx.produce(topic=self.__topic,
                                     msg_payload=message,
-                                    msg_key=message["__key"])
+                                    msg_key=message["__key"],
+                                    on_delivery=partial(self.__on_delivery, source_id))
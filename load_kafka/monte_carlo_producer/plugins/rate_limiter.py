@@ -0,0 +1,31 @@
+import time
+import threading
+
+
+class TokenBucket:
+    '''
+    Thread-safe token bucket. Tokens refill continuously at `rate` per second up to `capacity`, and every acquire()
+    takes one token, blocking until one is available. Shared by all crawler workers so that their combined request
+    rate stays within the API quota, while still allowing short bursts of up to `capacity` requests.
+    '''
+
+    def __init__(self, rate, capacity=None):
+        if rate <= 0:
+            raise ValueError("rate must be positive")
+        self.__rate = float(rate)
+        self.__capacity = float(capacity or rate)
+        self.__tokens = self.__capacity
+        self.__last_refill = time.monotonic()
+        self.__lock = threading.Lock()
+
+    def acquire(self):
+        while True:
+            with self.__lock:
+                now = time.monotonic()
+                self.__tokens = min(self.__capacity, self.__tokens + (now - self.__last_refill) * self.__rate)
+                self.__last_refill = now
+                if self.__tokens >= 1:
+                    self.__tokens -= 1
+                    return
+                wait = (1 - self.__tokens) / self.__rate
+            time.sleep(wait)
@@ -0,0 +1,64 @@
+import re
+import json
+import time
+import threading
+
+
+def request_key(query, variables=None):
+    '''
+    Identifies a GraphQL request by its operation name and variables, e.g. 'getIncidents {"after": null, "dwId": "..."}'
+    '''
+    match = re.search(r"(?:query|mutation)\s+(\w+)", query)
+    operation = match.group(1) if match else query.strip()
+    return f"{operation} {json.dumps(variables or {}, sort_keys=True)}"
+
+
+class RecordingMonteCarloClient:
+    '''
+    Wraps a live pycarlo Client and records every response, so a crawl can later be replayed offline with
+    RecordedMonteCarloClient.
+    '''
+
+    def __init__(self, client):
+        self.__client = client
+        self.__responses = {}
+        self.__lock = threading.Lock()
+
+    def __call__(self, query, variables=None):
+        response = self.__client(query, variables=variables)
+        recorded = response.to_dict() if hasattr(response, "to_dict") else response
+        with self.__lock:
+            self.__responses[request_key(query, variables)] = recorded
+        return response
+
+    def save(self, path):
+        with self.__lock:
+            with open(path, "w") as f:
+                json.dump(self.__responses, f)
+
+
+class RecordedMonteCarloClient:
+    '''
+    Drop-in replacement of the pycarlo Client (as used by MonteCarloConnector) that replays recorded responses.
+    :param responses: dict {request_key: response}, or the path of a file saved by RecordingMonteCarloClient
+    :param latency: seconds slept per request, to simulate the round trip to the API
+    '''
+
+    def __init__(self, responses, latency=0.0):
+        if isinstance(responses, str):
+            with open(responses) as f:
+                responses = json.load(f)
+        self.__responses = responses
+        self.__latency = latency
+        self.__lock = threading.Lock()
+        self.calls = 0
+
+    def __call__(self, query, variables=None):
+        key = request_key(query, variables)
+        if key not in self.__responses:
+            raise KeyError(f"No recorded response for {key}")
+        with self.__lock:
+            self.calls += 1
+        if self.__latency:
+            time.sleep(self.__latency)
+        return self.__responses[key]
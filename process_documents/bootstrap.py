@@ -0,0 +1,95 @@
+import os
+import logging
+import argparse
+import traceback
+
+from core.connection_wrappers.kafka_wrapper import KafkaConsumerContext, KafkaProducerContext
+from core.connection_wrappers.cassandra_wrapper import CassandraContext
+
+from core.utils.constants import KAFKA_SEEDS, CASSANDRA_SEEDS, AUTH_VARIABLES
+from document_processor import DocumentProcessor
+
+'''
+Run with core/processors on the PYTHONPATH, e.g. from the repository root:
+    PYTHONPATH=.:core/processors python process_documents/bootstrap.py ...
+
+CLI Params:
+--topic
+--group_id
+--output_topic
+--dead_letter_topic
+--workers
+--mode
+--batch_size
+--chunk_size
+--flush_interval_ms
+--producer_profile
+'''
+
+def bootstrap(topic, group_id, output_topic, dead_letter_topic, workers=4, mode="thread", batch_size=1000,
+              chunk_size=200, flush_interval_ms=1000, producer_profile="bulk"):
+    cassandra_auth = {"username": os.environ.get(AUTH_VARIABLES["username"]),
+                      "password": os.environ.get(AUTH_VARIABLES["password"])}
+    cassandra_ctx = CassandraContext(CASSANDRA_SEEDS, **{"auth": cassandra_auth})
+
+    consumer_ctx = KafkaConsumerContext(seeds=KAFKA_SEEDS,
+                                        topic=topic,
+                                        group_id=group_id,
+                                        num_messages=batch_size)
+    producer_ctx = KafkaProducerContext(seeds=KAFKA_SEEDS, profile=producer_profile)
+    try:
+        plugin_obj = DocumentProcessor(consumer_ctx=consumer_ctx,
+                                       producer_ctx=producer_ctx,
+                                       cassandra_ctx=cassandra_ctx,
+                                       output_topic=output_topic,
+                                       dead_letter_topic=dead_letter_topic,
+                                       workers=workers,
+                                       mode=mode,
+                                       batch_size=batch_size,
+                                       chunk_size=chunk_size,
+                                       flush_interval=flush_interval_ms / 1000)
+        # Offsets are committed by the processor itself, once the documents of a batch are delivered
+        plugin_obj.execute()
+    except Exception as e:
+        logging.error(e)
+        logging.error(traceback.format_exc())
+    finally:
+        producer_ctx.flush()
+        producer_ctx.close()
+        consumer_ctx.close()
+        cassandra_ctx.close()
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(
+        prog='Document Processor',
+        description='Apply the document processing configs to the crawled documents',
+    )
+    parser.add_argument("--topic", help="The topic to which the crawled records are written", required=True)
+    parser.add_argument("--group_id", help="The consumer group id for the service", required=True)
+    parser.add_argument("--output_topic", help="The topic to which the processed records are written", required=True)
+    parser.add_argument("--dead_letter_topic", help="The topic to which the records failing validation are written",
+                        required=True)
+    parser.add_argument("--workers", help="Number of processing workers", type=int, default=4, required=False)
+    parser.add_argument("--mode", help="Worker type. Accepted Values: thread/process", default="thread",
+                        required=False)
+    parser.add_argument("--batch_size", help="Maximum number of documents per micro-batch", type=int, default=1000,
+                        required=False)
+    parser.add_argument("--chunk_size", help="Maximum number of documents handed to a worker at once", type=int,
+                        default=200, required=False)
+    parser.add_argument("--flush_interval_ms", help="Maximum time a document waits for its micro-batch to fill",
+                        type=int, default=1000, required=False)
+    parser.add_argument("--producer_profile", help="Producer profile: default/low_latency/bulk", default="bulk",
+                        required=False)
+
+    args = parser.parse_args()
+    bootstrap(topic=args.topic,
+              group_id=args.group_id,
+              output_topic=args.output_topic,
+              dead_letter_topic=args.dead_letter_topic,
+              workers=args.workers,
+              mode=args.mode,
+              batch_size=args.batch_size,
+              chunk_size=args.chunk_size,
+              flush_interval_ms=args.flush_interval_ms,
+              producer_profile=args.producer_profile)
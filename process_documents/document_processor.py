@@ -0,0 +1,248 @@
+import time
+import logging
+import multiprocessing
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor, ProcessPoolExecutor
+
+from core.connection_wrappers.kafka_wrapper import OffsetTracker
+from core.connection_wrappers.kafka_codecs import decode_message
+from core.utils.config_cache import ConfigCache
+from mappers import GenericFieldMapper
+
+# Stages of a document processing config, as stored in document_processing_user_config
+CONFIG_STAGES = ("transformations", "derivations", "validations", "annotations")
+
+_MAPPER = GenericFieldMapper()
+
+
+class DocumentProcessorException(Exception):
+    pass
+
+
+class DocumentProcessor:
+    '''
+    Applies the document processing config of every (user_id, connector_id) to the payload of the documents crawled by
+    its connector, between the raw topic and the processed topic the loaders consume.
+
+    Documents are consumed in micro-batches of up to batch_size messages (or whatever arrived within flush_interval).
+    The documents of a batch are grouped by (user_id, connector_id), whose config is read through a ConfigCache, and
+    every group is split in chunks of chunk_size that are processed concurrently by the worker pool with the columnar
+    GenericFieldMapper plan (see ExecutionPlan.execute_batch). Documents without a config are passed through.
+
+    * mode="thread": the workers are threads
+    * mode="process": the workers are processes, spawned rather than forked (see PartitionWorkerRuntime). The documents
+      are pickled to and from the workers, which pays off once the configs are expensive enough
+
+    Documents that fail a validation are produced to dead_letter_topic with the failed rules. A chunk in which a rule
+    raises is processed again document by document, from freshly decoded copies, and only the documents that raise
+    again are dead-lettered. The others are produced to output_topic in the order they were consumed. Offsets are
+    committed once every document of the batch is delivered to one of the two topics. A config that does not compile
+    is not a document failure: the processor raises DocumentProcessorException without committing the batch.
+
+    stats() reports docs/s and the time spent in every rule, also logged every report_interval seconds.
+    '''
+
+    def __init__(self, consumer_ctx, producer_ctx, cassandra_ctx, output_topic, dead_letter_topic, workers=4,
+                 mode="thread", batch_size=1000, chunk_size=200, flush_interval=1, report_interval=30,
+                 config_cache=None):
+        if mode not in {"thread", "process"}:
+            raise DocumentProcessorException(f"Unknown worker mode: {mode}")
+        self.__consumer_ctx = consumer_ctx
+        self.__producer_ctx = producer_ctx
+        self.__output_topic = output_topic
+        self.__dead_letter_topic = dead_letter_topic
+        self.__batch_size = batch_size
+        self.__chunk_size = chunk_size
+        self.__flush_interval = flush_interval
+        self.__report_interval = report_interval
+        self.__config_cache = config_cache or ConfigCache(cassandra_ctx)
+        if mode == "process":
+            self.__pool = ProcessPoolExecutor(max_workers=workers, mp_context=multiprocessing.get_context("spawn"))
+        else:
+            self.__pool = ThreadPoolExecutor(max_workers=workers, thread_name_prefix="document-processor")
+
+        self.__tracker = OffsetTracker()
+        self.__pending = []
+        self.__last_flush = time.time()
+        self.__stopped = False
+        self.__failure = None
+        self.__closed = False
+        self.__started_at = None
+        # processed: produced to output_topic, passed_through documents (without a config) included
+        self.__metrics = {"documents": 0, "processed": 0, "passed_through": 0, "dead_lettered": 0, "batches": 0,
+                          "isolated_chunks": 0}
+        # CompiledRule.key -> seconds
+        self.__rule_timings = {}
+
+        consumer_ctx.set_rebalance_callbacks(on_revoke=self.__on_revoke)
+
+    def execute(self):
+        self.__started_at = time.time()
+        last_report = time.time()
+        try:
+            while not self.__stopped:
+                for message in self.__consumer_ctx.consume_messages():
+                    self.__tracker.track(message.topic(), message.partition(), message.offset())
+                    self.__pending.append(message)
+                    if len(self.__pending) >= self.__batch_size:
+                        self.__flush()
+                if time.time() - self.__last_flush >= self.__flush_interval:
+                    self.__flush()
+                if time.time() - last_report >= self.__report_interval:
+                    logging.info(f"Document processor stats: {self.stats()}")
+                    last_report = time.time()
+        except Exception as e:
+            self.__failure = e
+            raise
+        finally:
+            self.close()
+
+    def stop(self):
+        '''
+        Makes execute() return after the current consume. Safe to call from a signal handler or another thread.
+        '''
+        self.__stopped = True
+
+    def close(self):
+        '''
+        Processes the pending documents (unless the processor failed), commits them and stops the workers.
+        '''
+        if self.__closed:
+            return
+        self.__closed = True
+        try:
+            if self.__failure is None:
+                self.__flush(is_asynchronous_commit=False)
+        finally:
+            self.__pool.shutdown()
+            logging.info(f"Document processor stats: {self.stats()}")
+
+    def stats(self):
+        stats = dict(self.__metrics)
+        elapsed = time.time() - self.__started_at if self.__started_at else 0
+        stats["docs_per_s"] = round(stats["documents"] / elapsed, 1) if elapsed else 0.0
+        stats["rule_seconds"] = {key: round(seconds, 3) for key, seconds in
+                                 sorted(self.__rule_timings.items(), key=lambda item: -item[1])}
+        return stats
+
+    def __flush(self, is_asynchronous_commit=True):
+        messages, self.__pending = self.__pending, []
+        self.__last_flush = time.time()
+        if messages:
+            outcomes = self.__process(messages)
+            for message, (doc, errors) in zip(messages, outcomes):
+                if errors:
+                    self.__dead_letter(doc, errors)
+                else:
+                    self.__producer_ctx.produce(topic=self.__output_topic, msg_payload=doc, msg_key=doc.get("__key"))
+                    self.__metrics["processed"] += 1
+            self.__wait_for_delivery()
+            for message in messages:
+                self.__tracker.ack(message.topic(), message.partition(), message.offset())
+            self.__metrics["documents"] += len(messages)
+            self.__metrics["batches"] += 1
+        self.__consumer_ctx.commit_offsets(self.__tracker.committable(), is_asynchronous_commit=is_asynchronous_commit)
+
+    def __process(self, messages):
+        '''
+        :return: list with a (document, errors) outcome per message, errors is empty for documents to produce
+        '''
+        outcomes = [None] * len(messages)
+        groups = OrderedDict()
+        for position, message in enumerate(messages):
+            doc = decode_message(message)
+            key = (doc.get("user_id"), doc.get("meta", {}).get("producer_process_id"))
+            groups.setdefault(key, []).append((position, doc))
+
+        chunks = []
+        for (user_id, connector_id), items in groups.items():
+            conf = self.__get_conf(user_id, connector_id)
+            if conf is None:
+                for position, doc in items:
+                    outcomes[position] = (doc, [])
+                self.__metrics["passed_through"] += len(items)
+                continue
+            for start in range(0, len(items), self.__chunk_size):
+                chunk = items[start:start + self.__chunk_size]
+                chunks.append((conf, [position for position, _ in chunk],
+                               self.__pool.submit(_process_chunk, conf, [doc for _, doc in chunk])))
+
+        for conf, positions, future in chunks:
+            try:
+                docs, error_dcts, timings = future.result()
+            except Exception as e:
+                logging.warning(f"Processing a chunk of {len(positions)} documents failed, isolating the failing "
+                                f"documents: {type(e).__name__}: {e}")
+                self.__metrics["isolated_chunks"] += 1
+                self.__isolate(conf, positions, messages, outcomes)
+                continue
+            self.__add_timings(timings)
+            for position, doc, error_dct in zip(positions, docs, error_dcts):
+                outcomes[position] = (doc, error_dct["validations"])
+        return outcomes
+
+    def __isolate(self, conf, positions, messages, outcomes):
+        # The documents of the failed chunk may be half processed, they are decoded again from their messages
+        futures = [(position, self.__pool.submit(_process_chunk, conf, [decode_message(messages[position])]))
+                   for position in positions]
+        for position, future in futures:
+            try:
+                docs, error_dcts, timings = future.result()
+                self.__add_timings(timings)
+                outcomes[position] = (docs[0], error_dcts[0]["validations"])
+            except Exception as e:
+                outcomes[position] = (decode_message(messages[position]), [f"{type(e).__name__}: {e}"])
+
+    def __get_conf(self, user_id, connector_id):
+        config = self.__config_cache.get("document_processing", user_id, connector_id)
+        if not config:
+            return None
+        conf = {stage: config.get(stage) or [] for stage in CONFIG_STAGES}
+        # Compiled here rather than only in the workers: a config that does not compile fails every document of its
+        # connector, the processor stops instead of dead-lettering them all
+        try:
+            _MAPPER.compile(conf)
+        except Exception as e:
+            raise DocumentProcessorException(f"Invalid document processing config of user {user_id}, connector "
+                                             f"{connector_id}: {type(e).__name__}: {e}")
+        return conf
+
+    def __add_timings(self, timings):
+        for key, seconds in timings.items():
+            self.__rule_timings[key] = self.__rule_timings.get(key, 0.0) + seconds
+
+    def __dead_letter(self, doc, errors):
+        self.__producer_ctx.produce(topic=self.__dead_letter_topic,
+                                    msg_payload={"doc_type": doc.get("doc_type"),
+                                                 "user_id": doc.get("user_id"),
+                                                 "errors": errors,
+                                                 "document": doc},
+                                    msg_key=doc.get("__key"))
+        self.__metrics["dead_lettered"] += 1
+
+    def __wait_for_delivery(self):
+        '''
+        Raises if any document of the batch could not be delivered, so that its offset is not committed.
+        '''
+        self.__producer_ctx.flush()
+        errors = self.__producer_ctx.delivery_errors()
+        if errors:
+            raise DocumentProcessorException(f"{len(errors)} documents could not be delivered to kafka: "
+                                             f"{errors[-1]['error']}")
+
+    def __on_revoke(self, partitions):
+        # Process and commit what was consumed from the revoked partitions while they are still assigned
+        if self.__failure is None:
+            self.__flush(is_asynchronous_commit=False)
+        self.__tracker.forget(partitions)
+
+
+def _process_chunk(conf, docs):
+    '''
+    Runs in the worker pool. Applies the plan of conf to the payloads of docs, in place.
+    :return: tuple (docs, error_dcts, rule timings)
+    '''
+    timings = {}
+    payloads = [doc.setdefault("payload", {}) for doc in docs]
+    _, error_dcts = _MAPPER.compile(conf).execute_batch(payloads, timings=timings)
+    return docs, error_dcts, timings
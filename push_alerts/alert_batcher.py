@@ -0,0 +1,70 @@
+import json
+
+
+class AlertBatcher:
+    '''
+    Coalesces alerts for the same webhook into one delivery. Batching is opt-in per alert through its alert_conf:
+    {
+        "batch_max_items": <maximum number of alerts in one request, batching is off if unset or <= 1>,
+        "batch_max_wait_ms": <maximum time the first alert of a batch is held waiting for more, default 1000>
+    }
+
+    Alerts are grouped on (webhook_endpoint, headers), so a batch is always sent with the headers every alert in it
+    asked for. A group is released once it holds batch_max_items alerts, or once its first alert has waited
+    batch_max_wait_ms. Alerts with batching off are released immediately, as a group of one.
+    '''
+
+    def __init__(self):
+        # (webhook_endpoint, headers) -> {"items": [...], "max_items": int, "deadline": float}
+        self.__groups = {}
+
+    @staticmethod
+    def is_batched(config):
+        return (config.get("batch_max_items") or 1) > 1
+
+    def add(self, dct, item, now):
+        '''
+        :param dct: the alert
+        :param item: what is handed back for the alert in the released group
+        :return: list of the groups (lists of items) released by this alert
+        '''
+        config = dct["alert_conf"]
+        if not self.is_batched(config):
+            return [[item]]
+        key = (config["webhook_endpoint"], json.dumps(config.get("headers", {}), sort_keys=True))
+        group = self.__groups.get(key)
+        if group is None:
+            group = self.__groups[key] = {
+                "items": [],
+                "max_items": config["batch_max_items"],
+                "deadline": now + config.get("batch_max_wait_ms", 1000) / 1000
+            }
+        group["items"].append(item)
+        if len(group["items"]) >= group["max_items"]:
+            return [self.__groups.pop(key)["items"]]
+        return []
+
+    def pop_expired(self, now):
+        '''
+        :return: list of the groups whose first alert has waited batch_max_wait_ms
+        '''
+        expired = [key for key, group in self.__groups.items() if group["deadline"] <= now]
+        return [self.__groups.pop(key)["items"] for key in expired]
+
+    def discard(self, predicate):
+        '''
+        Drops the held items for which predicate(item) is true, and the groups left empty.
+        :return: number of dropped items
+        '''
+        dropped = 0
+        for key, group in list(self.__groups.items()):
+            kept = [item for item in group["items"] if not predicate(item)]
+            dropped += len(group["items"]) - len(kept)
+            if kept:
+                group["items"] = kept
+            else:
+                del self.__groups[key]
+        return dropped
+
+    def __len__(self):
+        return sum(len(group["items"]) for group in self.__groups.values())
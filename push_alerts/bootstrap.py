@@ -7,6 +7,7 @@ from core.connection_wrappers.kafka_wrapper import KafkaConsumerContext, KafkaPr
 
 from core.utils.constants import KAFKA_SEEDS
 from notification_service import AlertsService
+from webhook_dispatcher import WebhookDispatcher
 
 '''
 CLI Params:
@@ -16,27 +17,44 @@ CLI Params:
 --mode
 --group_id
 --retry_topic
+--max_concurrency
+--per_endpoint_concurrency
+--timeout
+--max_pending_retries
+--delay_topic_prefix
+--max_inflight
 '''
 
-def bootstrap(user_id, connector_id, topic, mode, group_id, retry_topic=None):
+def bootstrap(user_id, connector_id, topic, mode, group_id, retry_topic=None, max_concurrency=64,
+              per_endpoint_concurrency=8, timeout=10, max_pending_retries=10000, delay_topic_prefix=None,
+              max_inflight=1000):
     consumer_ctx = KafkaConsumerContext(seeds=KAFKA_SEEDS,
                                         topic=topic,
                                         group_id=group_id)
     if mode.upper() == "RETRY":
         retry_topic = topic
 
+    # In RETRY mode the producer is only used to spill to the delay topics when the retry scheduler is full
     if not retry_topic:
         producer_ctx = None
     else:
         producer_ctx = KafkaProducerContext(seeds=KAFKA_SEEDS)
 
+    dispatcher = WebhookDispatcher(max_concurrency=max_concurrency,
+                                   per_endpoint_concurrency=per_endpoint_concurrency,
+                                   read_timeout=timeout)
     try:
         plugin_obj = AlertsService(user_id=user_id,
                                    connector_id=connector_id,
                                    consumer_ctx=consumer_ctx,
                                    producer_ctx=producer_ctx,
                                    mode=mode,
-                                   topic=topic)
+                                   topic=topic,
+                                   retry_topic=retry_topic,
+                                   dispatcher=dispatcher,
+                                   max_pending_retries=max_pending_retries,
+                                   delay_topic_prefix=delay_topic_prefix,
+                                   max_inflight=max_inflight)
         plugin_obj.execute()
     except Exception as e:
         logging.error(e)
@@ -45,7 +63,8 @@ def bootstrap(user_id, connector_id, topic, mode, group_id, retry_topic=None):
         if producer_ctx:
             producer_ctx.flush()
             producer_ctx.close()
-        consumer_ctx.commit()
+        # Offsets are committed by the service as alerts settle. A plain commit here would also cover alerts still
+        # held in a batch or in the retry scheduler
         consumer_ctx.close()
 
 
@@ -62,6 +81,19 @@ if __name__ == "__main__":
                         required=True)
     parser.add_argument("--retry_topic", help="The topic to which the records to be retried are to be written",
                         required=False)
+    parser.add_argument("--max_concurrency", help="Maximum number of webhook deliveries in flight", type=int,
+                        default=64, required=False)
+    parser.add_argument("--per_endpoint_concurrency", help="Maximum number of deliveries in flight per endpoint",
+                        type=int, default=8, required=False)
+    parser.add_argument("--timeout", help="Read timeout of a webhook delivery in seconds", type=float, default=10,
+                        required=False)
+    parser.add_argument("--max_pending_retries", help="RETRY mode: retries held in memory before spilling to the "
+                                                      "delay topics", type=int, default=10000, required=False)
+    parser.add_argument("--delay_topic_prefix", help="RETRY mode: prefix of the <prefix>.delay.<10s|1m|5m> topics. "
+                                                     "Defaults to the consumed topic, without its .delay.<tier> "
+                                                     "suffix", required=False)
+    parser.add_argument("--max_inflight", help="Alerts of a partition in flight before the partition is paused",
+                        type=int, default=1000, required=False)
 
     args = parser.parse_args()
     bootstrap(user_id=args.user_id,
@@ -69,4 +101,10 @@ if __name__ == "__main__":
               topic=args.topic,
               mode=args.mode,
               group_id=args.group_id,
-              retry_topic=args.retry_topic)
+              retry_topic=args.retry_topic,
+              max_concurrency=args.max_concurrency,
+              per_endpoint_concurrency=args.per_endpoint_concurrency,
+              timeout=args.timeout,
+              max_pending_retries=args.max_pending_retries,
+              delay_topic_prefix=args.delay_topic_prefix,
+              max_inflight=args.max_inflight)
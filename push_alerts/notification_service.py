@@ -1,9 +1,35 @@
-import json
-import requests
+import time
+import queue
+import logging
+from functools import partial
 
 from dateutil.parser import parse
 from datetime import datetime, timedelta
 
+from core.connection_wrappers.kafka_wrapper import OffsetTracker
+from core.connection_wrappers.kafka_codecs import decode_message
+from webhook_dispatcher import WebhookDispatcher
+from retry_scheduler import RetryScheduler
+from alert_batcher import AlertBatcher
+
+# (delay in seconds, topic suffix) of the delay topics used when the in-memory retry scheduler is full
+DELAY_TIERS = ((10, "10s"), (60, "1m"), (300, "5m"))
+
+
+def base_retry_topic(topic):
+    '''
+    :return: the retry topic a delay topic belongs to, e.g. alerts.retry for alerts.retry.delay.1m, else topic
+    '''
+    for _, suffix in DELAY_TIERS:
+        if topic.endswith(f".delay.{suffix}"):
+            return topic[:-len(f".delay.{suffix}")]
+    return topic
+
+
+class AlertsServiceException(Exception):
+    pass
+
+
 class AlertsService:
     '''
     Config Structure for alerts (embedded in the document from Alerts Processor Service):
@@ -13,16 +39,46 @@ class AlertsService:
         "retry_conf": {
             "n_retries": <number of retries after a failed delivery>,
             "max_backoff": <the maximum back-off time in seconds>
-        }
+        },
+        "batch_max_items": <(optional) coalesce up to this many alerts for the same endpoint and headers into one
+                            request with a JSON array of their payloads>,
+        "batch_max_wait_ms": <(optional) how long the first alert of a batch waits for more, default 1000>
     }
 
     Alert Structure
 
 
+    Deliveries are dispatched concurrently through a WebhookDispatcher and the consumer keeps polling while they are in
+    flight: the outcome of every delivery is queued by its done-callback and handled on the next poll, so a slow
+    endpoint only holds back its own alerts. A partition with max_inflight alerts in flight is paused until half of
+    them have settled. Offsets are committed once every alert up to them has settled (delivered, or handed to the
+    retry topic). Alerts produced to a retry or delay topic must be
+    delivered to it before the offsets covering them are committed: if any of them fails, the service stops without
+    committing, so the alerts are consumed again after a restart. Alerts of a batched request settle one by one: the
+    endpoint can report per-alert statuses (see WebhookDispatcher.submit_batch), and only the alerts that failed go
+    through the retry_meta flow. Held batches are released on the next poll after batch_max_wait_ms, so the wait is
+    only as precise as the consumer timeout.
+
+    In RETRY mode, alerts that are not due yet are held in an in-memory RetryScheduler instead of being re-produced,
+    and so are alerts whose retry failed again. Their offsets are committed only once they are finally delivered or
+    dropped. When the scheduler is full:
+    * the consumer pauses its partitions until the scheduler drains, instead of fetching more work
+    * alerts that still need a place are spilled to the delay topic <delay_topic_prefix>.delay.<tier> (see DELAY_TIERS)
+      whose delay best fits their remaining backoff. Each delay topic is consumed by its own RETRY mode instance,
+      which spills to the delay topics of the same retry topic (delay_topic_prefix defaults to the consumed topic
+      without its .delay.<tier> suffix)
+    * an alert fetched before the pause that is due sooner than the shortest tier is not spilled. Its partition is
+      rewound to it and paused, so it is fetched again once there is room
+
+    When partitions are revoked, their in-flight deliveries are waited for (up to drain_timeout) and committed. Their
+    alerts still held in a batch or in the retry scheduler are dropped without being committed: the consumer that
+    takes the partitions over delivers them, instead of both consumers delivering them.
     '''
 
 
-    def __init__(self, user_id, connector_id, consumer_ctx, producer_ctx, mode, topic, retry_topic=None):
+    def __init__(self, user_id, connector_id, consumer_ctx, producer_ctx, mode, topic, retry_topic=None,
+                 dispatcher=None, max_pending_retries=10000, delay_topic_prefix=None, max_inflight=1000,
+                 drain_timeout=30):
         self.__user_id = user_id
         self.__connector_id = connector_id
         self.__consumer_ctx = consumer_ctx
@@ -31,7 +87,8 @@ class AlertsService:
         self.__read_topic = topic
         self.__retry_flag = None
         self.__success_codes = [200, 201, 203, 204, 205, 206, 207, 208, 226]
-        if mode.upper == "RETRY":
+        self.__dispatcher = dispatcher or WebhookDispatcher()
+        if mode.upper() == "RETRY":
             self.__write_topic = topic
             self.__retry_flag = True
         elif retry_topic:
@@ -40,67 +97,280 @@ class AlertsService:
         else:
             self.__retry_flag = False
             self.__write_topic = None
+        self.__delay_topic_prefix = delay_topic_prefix or (base_retry_topic(self.__write_topic)
+                                                           if self.__write_topic else None)
+        self.__scheduler = RetryScheduler(max_pending=max_pending_retries)
+        self.__tracker = OffsetTracker()
+        self.__batcher = AlertBatcher()
+        self.__paused = set()
+        self.__max_inflight = max_inflight
+        self.__drain_timeout = drain_timeout
+        # (topic, partition) -> alerts dispatched whose delivery has not been handled yet
+        self.__inflight = {}
+        # Partitions paused because of their in-flight alerts, in RETRY mode they may also be in __paused
+        self.__backlogged = set()
+        # (group, batched, future) of the deliveries that completed, queued by their done-callback
+        self.__settled = queue.Queue()
+        # Alerts were produced to a retry or delay topic since the last commit
+        self.__produced = False
+
+        consumer_ctx.set_rebalance_callbacks(on_revoke=self.__on_revoke)
 
 
     def execute(self):
+        try:
+            if self.__mode.upper() == "RETRY":
+                self.__execute_retry()
+            else:
+                self.__execute_normal()
+        finally:
+            self.__dispatcher.close()
+
+
+    def __execute_normal(self):
+        while True:
+            groups = []
+            for message in self.__consumer_ctx.consume_messages():
+                self.__tracker.track(message.topic(), message.partition(), message.offset())
+                dct = decode_message(message)
+                groups.extend(self.__batcher.add(dct, (dct, message), time.time()))
+            groups.extend(self.__batcher.pop_expired(time.time()))
+            self.__dispatch(groups)
+            self.__handle_settled(self.__settle())
+            self.__commit()
+
+
+    def __execute_retry(self):
+        while True:
+            self.__deliver(self.__batch(self.__scheduler.pop_due(time.time())))
+            self.__update_paused_partitions()
+
+            rewound = set()
+            due_now = []
+            for message in self.__consumer_ctx.consume_messages():
+                partition = (message.topic(), message.partition())
+                if partition in rewound:
+                    continue
+                dct = decode_message(message)
+                due_time = parse(dct["retry_meta"]["next_retry_time"]).timestamp()
+                if self.__scheduler.is_full() and time.time() < due_time < time.time() + DELAY_TIERS[0][0]:
+                    self.__consumer_ctx.seek(partition[0], partition[1], message.offset())
+                    self.__consumer_ctx.pause([partition])
+                    self.__paused.add(partition)
+                    rewound.add(partition)
+                    continue
+                self.__tracker.track(partition[0], partition[1], message.offset())
+                if due_time <= time.time():
+                    due_now.append((dct, message))
+                else:
+                    self.__reschedule(dct, message, due_time)
+
+            self.__deliver(self.__batch(due_now + self.__scheduler.pop_due(time.time())))
+            self.__handle_settled(self.__settle())
+            self.__commit()
+
+
+    def __batch(self, items):
+        '''
+        :return: the groups released by adding the (dct, message) items to the batcher, and the expired ones
+        '''
+        groups = []
+        for dct, message in items:
+            groups.extend(self.__batcher.add(dct, (dct, message), time.time()))
+        return groups + self.__batcher.pop_expired(time.time())
+
+
+    def __deliver(self, groups):
+        self.__dispatch(groups)
+
+
+    def __handle_settled(self, results):
+        '''
+        Acknowledges the settled alerts. Failed ones are handed to the retry topic, or in RETRY mode held for their next
+        retry, which acknowledges them once they are delivered or dropped.
+        '''
+        for dct, message, status_code in results:
+            retry_dct = self.__handle_response(dct, status_code)
+            if retry_dct and self.__mode.upper() == "RETRY":
+                self.__reschedule(retry_dct, message, parse(retry_dct["retry_meta"]["next_retry_time"]).timestamp())
+                continue
+            if retry_dct:
+                self.__send_to_retry_topic(payload=retry_dct)
+            self.__tracker.ack(message.topic(), message.partition(), message.offset())
+
+
+    def __reschedule(self, dct, message, due_time):
+        '''
+        Holds the alert in memory until it is due. Spills it to a delay topic if the scheduler is full.
+        '''
+        if self.__scheduler.schedule(due_time, (dct, message)):
+            return
+        remaining = due_time - time.time()
+        suffix = DELAY_TIERS[0][1]
+        for delay, tier_suffix in DELAY_TIERS:
+            if delay <= remaining:
+                suffix = tier_suffix
+        self.__producer_ctx.produce(topic=f"{self.__delay_topic_prefix}.delay.{suffix}", msg_payload=dct)
+        self.__produced = True
+        self.__tracker.ack(message.topic(), message.partition(), message.offset())
+
+
+    def __update_paused_partitions(self):
+        if self.__scheduler.is_full():
+            to_pause = [partition for partition in self.__consumer_ctx.assignment() if partition not in self.__paused]
+            if to_pause:
+                self.__consumer_ctx.pause(to_pause)
+                self.__paused.update(to_pause)
+        elif self.__paused and self.__scheduler.has_room():
+            assigned = set(self.__consumer_ctx.assignment())
+            self.__consumer_ctx.resume([partition for partition in self.__paused
+                                        if partition in assigned and partition not in self.__backlogged])
+            self.__paused = set()
+
+
+    def __commit(self, is_asynchronous_commit=True):
+        if self.__produced:
+            # Retried and spilled alerts must be on their topic before their source offsets are committed
+            self.__producer_ctx.flush()
+            errors = self.__producer_ctx.delivery_errors()
+            if errors:
+                raise AlertsServiceException(f"{len(errors)} alerts could not be produced for a retry, stopping "
+                                             f"without committing them: {errors[-1]['error']}")
+            self.__produced = False
+        self.__consumer_ctx.commit_offsets(self.__tracker.committable(), is_asynchronous_commit=is_asynchronous_commit)
+
+
+    def __on_revoke(self, partitions):
+        revoked = set(partitions)
+        # Not to be resumed once drained, they are no longer assigned
+        self.__backlogged.difference_update(revoked)
+        self.__paused.difference_update(revoked)
+        deadline = time.time() + self.__drain_timeout
+        while any(self.__inflight.get(partition, 0) for partition in revoked) and time.time() < deadline:
+            self.__handle_settled(self.__settle(timeout=min(1, max(0, deadline - time.time()))))
+        self.__commit(is_asynchronous_commit=False)
+
+        def is_revoked(item):
+            dct, message = item
+            return (message.topic(), message.partition()) in revoked
+        dropped = self.__batcher.discard(is_revoked) + self.__scheduler.discard(is_revoked)
+        if dropped:
+            logging.info(f"Dropped {dropped} held alerts of the revoked partitions {partitions}")
+        self.__tracker.forget(partitions)
+        for partition in partitions:
+            self.__inflight.pop(partition, None)
+
+
+    def __dispatch(self, groups):
+        '''
+        Sends one request per group of (dct, message) without waiting for them, see __settle. Pauses the partitions
+        with max_inflight alerts in flight.
+        '''
+        to_pause = []
+        for group in groups:
+            for dct, message in group:
+                partition = (message.topic(), message.partition())
+                self.__inflight[partition] = self.__inflight.get(partition, 0) + 1
+                if self.__inflight[partition] >= self.__max_inflight and partition not in self.__backlogged:
+                    self.__backlogged.add(partition)
+                    to_pause.append(partition)
+            delivery, batched = self.__send_to_webhook([dct for dct, message in group])
+            delivery.add_done_callback(partial(self.__on_delivered, group, batched))
+        if to_pause:
+            self.__consumer_ctx.pause(to_pause)
+
+
+    def __on_delivered(self, group, batched, delivery):
+        # Runs on a dispatcher thread: the outcome is handled on the consuming thread
+        self.__settled.put((group, batched, delivery))
+
+
+    def __settle(self, timeout=0):
+        '''
+        Collects the deliveries that completed since the last call, waiting up to timeout for the first one but not for
+        the others, and resumes the partitions whose in-flight alerts fell to half of max_inflight.
+        :return: list of (dct, message, status_code), one per alert
+        '''
+        results = []
         while True:
-            dcts = self.__consumer_ctx.consume()
-            if len(dcts) > 0:
-                for dct in dcts:
-                    self.__send_to_webhook(dct)
+            try:
+                group, batched, delivery = self.__settled.get(block=timeout > 0, timeout=timeout or None)
+            except queue.Empty:
+                break
+            timeout = 0
+            if delivery.exception() is not None:
+                # Could not be dispatched, handled as a delivery without a response
+                status_codes = [None] * len(group)
+            else:
+                status_codes = delivery.result() if batched else [delivery.result()]
+            for (dct, message), status_code in zip(group, status_codes):
+                partition = (message.topic(), message.partition())
+                if partition not in self.__inflight:
+                    # Revoked before the delivery settled, the consumer that took the partition over delivers it
+                    continue
+                self.__inflight[partition] -= 1
+                results.append((dct, message, status_code))
+
+        drained = [partition for partition in self.__backlogged
+                   if self.__inflight.get(partition, 0) <= self.__max_inflight // 2]
+        if drained:
+            self.__backlogged.difference_update(drained)
+            self.__consumer_ctx.resume([partition for partition in drained if partition not in self.__paused])
+        return results
+
 
+    def __send_to_webhook(self, dcts):
+        '''
+        Dispatches the delivery of alerts sharing an endpoint and headers, as one JSON array if batching is on.
+        :return: tuple (Future of the status code, or of the list of per-alert status codes if batched, batched)
+        '''
+        config = dcts[0]["alert_conf"]
+        headers = config["headers"]
+        headers["Content-Type"] = "application/json"
+        url = config["webhook_endpoint"]
+        if AlertBatcher.is_batched(config):
+            return self.__dispatcher.submit_batch(url, headers, [dct["payload"] for dct in dcts]), True
+        return self.__dispatcher.submit(url, headers, dcts[0]["payload"]), False
 
 
-    def __send_to_webhook(self, dct):
-        if self.__mode != "RETRY":
+    def __handle_response(self, dct, status_code):
+        '''
+        :return: the alert with updated retry_meta if it has to be retried, otherwise None
+        '''
+        if status_code in self.__success_codes:
+            return None
+        if self.__mode.upper() != "RETRY":
             config = dct["alert_conf"]
-            payload = dct["payload"]
-            headers = config["headers"]
-            headers["Content-Type"] = "application/json"
-            url = config["webhook_endpoint"]
-            resp = requests.post(url, headers=headers, json=payload)
-            if resp.status_code not in self.__success_codes:
-                retry_conf = config.get("retry_conf", {})
-                if retry_conf and self.__retry_flag:
-                    n_retries = retry_conf.get("n_retries", 3)
-                    max_backoff = retry_conf.get("max_backoff", 300)
-                    exponential_backoff_factor = int(max_backoff ** (1/n_retries))
-                    dct["retry_meta"] = {
-                        "n_retries": n_retries,
-                        "remaining_retries": n_retries,
-                        "backoff_factor": exponential_backoff_factor,
-                        "next_retry_time": datetime.isoformat(
-                            datetime.now() + timedelta(seconds=exponential_backoff_factor))
-                    }
-                    self.__send_to_retry_topic(payload=dct)
+            retry_conf = config.get("retry_conf", {})
+            if retry_conf and self.__retry_flag:
+                n_retries = retry_conf.get("n_retries", 3)
+                max_backoff = retry_conf.get("max_backoff", 300)
+                exponential_backoff_factor = int(max_backoff ** (1/n_retries))
+                dct["retry_meta"] = {
+                    "n_retries": n_retries,
+                    "remaining_retries": n_retries,
+                    "backoff_factor": exponential_backoff_factor,
+                    "next_retry_time": datetime.isoformat(
+                        datetime.now() + timedelta(seconds=exponential_backoff_factor))
+                }
+                return dct
         else:
-            config = dct["alert_conf"]
-            payload = dct["payload"]
             retry_meta = dct["retry_meta"]
-            next_retry_time = retry_meta["next_retry_time"]
-            if parse(next_retry_time) > datetime.now():
-                self.__send_to_retry_topic(payload=dct)
-                return
-            else:
-                headers = config["headers"]
-                headers["Content-Type"] = "application/json"
-                url = config["webhook_endpoint"]
-                resp = requests.post(url, headers=headers, json=payload)
-                if resp.status_code not in self.__success_codes:
-                    remaining_retries = retry_meta["remaining_retries"] - 1
-                    if remaining_retries >= 0:
-                        backoff_time = retry_meta["backoff_factor"] ** ((retry_meta["n_retries"] + 1) - remaining_retries)
-                        next_retry_time = datetime.isoformat(datetime.now() + timedelta(seconds=backoff_time))
-                        dct["retry_meta"] = {
-                            "n_retries": retry_meta["n_retries"],
-                            "remaining_retries": remaining_retries,
-                            "backoff_factor": retry_meta["backoff_factor"],
-                            "next_retry_time": next_retry_time
-                        }
-                        self.__send_to_retry_topic(payload=dct)
+            remaining_retries = retry_meta["remaining_retries"] - 1
+            if remaining_retries >= 0:
+                backoff_time = retry_meta["backoff_factor"] ** ((retry_meta["n_retries"] + 1) - remaining_retries)
+                next_retry_time = datetime.isoformat(datetime.now() + timedelta(seconds=backoff_time))
+                dct["retry_meta"] = {
+                    "n_retries": retry_meta["n_retries"],
+                    "remaining_retries": remaining_retries,
+                    "backoff_factor": retry_meta["backoff_factor"],
+                    "next_retry_time": next_retry_time
+                }
+                return dct
+        return None
 
 
     def __send_to_retry_topic(self, payload):
         self.__producer_ctx.produce(topic=self.__write_topic, msg_payload=payload)
-
+        self.__produced = True
 
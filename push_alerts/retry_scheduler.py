@@ -0,0 +1,61 @@
+import heapq
+import itertools
+
+
+class RetryScheduler:
+    '''
+    In-process delay queue for alerts waiting out their retry backoff. Pending retries are kept in a heap keyed on
+    their due time (epoch seconds), up to max_pending entries. Callers decide what to do when the scheduler is full
+    (spill to a delay topic, or pause consumption).
+    '''
+
+    def __init__(self, max_pending=10000, resume_ratio=0.9):
+        self.__max_pending = max_pending
+        self.__resume_threshold = max(1, int(max_pending * resume_ratio))
+        self.__heap = []
+        self.__sequence = itertools.count()
+
+    def schedule(self, due_time, item):
+        '''
+        :return: bool, False if the scheduler is full and the item was not accepted
+        '''
+        if len(self.__heap) >= self.__max_pending:
+            return False
+        heapq.heappush(self.__heap, (due_time, next(self.__sequence), item))
+        return True
+
+    def pop_due(self, now):
+        '''
+        :return: list of the items whose due time is <= now, earliest first
+        '''
+        due = []
+        while self.__heap and self.__heap[0][0] <= now:
+            due.append(heapq.heappop(self.__heap)[2])
+        return due
+
+    def discard(self, predicate):
+        '''
+        Drops the pending items for which predicate(item) is true.
+        :return: number of dropped items
+        '''
+        kept = [entry for entry in self.__heap if not predicate(entry[2])]
+        dropped = len(self.__heap) - len(kept)
+        if dropped:
+            heapq.heapify(kept)
+            self.__heap = kept
+        return dropped
+
+    def next_due_time(self):
+        return self.__heap[0][0] if self.__heap else None
+
+    def is_full(self):
+        return len(self.__heap) >= self.__max_pending
+
+    def has_room(self):
+        '''
+        True once the scheduler has drained below the resume threshold, to avoid flapping between pause and resume.
+        '''
+        return len(self.__heap) < self.__resume_threshold
+
+    def __len__(self):
+        return len(self.__heap)
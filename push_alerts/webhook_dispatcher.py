@@ -0,0 +1,145 @@
+import logging
+import threading
+import requests
+
+from collections import deque
+from urllib.parse import urlsplit
+from requests.adapters import HTTPAdapter
+from concurrent.futures import Future, ThreadPoolExecutor
+
+
+class WebhookDispatcher:
+    '''
+    Bounded thread-pool dispatcher for webhook deliveries.
+
+    * One requests.Session per host, so connections (and TLS sessions) are kept alive and reused across deliveries.
+    * A global concurrency limit (the size of the pool) and a per-endpoint limit, so a slow endpoint can hold at most
+      per_endpoint_concurrency workers and cannot stall deliveries to the other endpoints. The per-endpoint limit is
+      applied before a delivery reaches the pool: deliveries beyond it wait in a queue of their endpoint, without
+      holding a worker, and the next one is handed to the pool when one of the endpoint's deliveries completes.
+    * Connect and read timeouts on every request.
+
+    submit() returns a Future that resolves to the HTTP status code of the delivery, or None if the request failed
+    without a response (timeout, connection error).
+
+    submit_batch() posts several payloads as one JSON array and returns a Future that resolves to one status code per
+    payload. The status of the request applies to every payload, except when the endpoint answers 207 Multi-Status
+    with a JSON array of per-item statuses (integers, or objects with a "status" key) of the same length as the batch.
+    '''
+
+    def __init__(self, max_concurrency=64, per_endpoint_concurrency=8, connect_timeout=3.05, read_timeout=10):
+        self.__executor = ThreadPoolExecutor(max_workers=max_concurrency, thread_name_prefix="webhook")
+        self.__max_concurrency = max_concurrency
+        self.__per_endpoint_concurrency = per_endpoint_concurrency
+        self.__timeout = (connect_timeout, read_timeout)
+        self.__lock = threading.Lock()
+        self.__idle = threading.Condition(self.__lock)
+        self.__sessions = {}
+        # url -> {"active": deliveries in the pool, "queued": deque of (function, args, future)}
+        self.__endpoints = {}
+
+    def submit(self, url, headers, payload):
+        return self.__submit(url, self.__deliver, (url, headers, payload))
+
+    def submit_batch(self, url, headers, payloads):
+        return self.__submit(url, self.__deliver_batch, (url, headers, payloads))
+
+    def close(self):
+        with self.__idle:
+            # Queued deliveries are handed to the pool as the active ones complete
+            self.__idle.wait_for(lambda: not self.__endpoints)
+        self.__executor.shutdown(wait=True)
+        with self.__lock:
+            for session in self.__sessions.values():
+                session.close()
+            self.__sessions = {}
+
+    def __submit(self, url, function, args):
+        future = Future()
+        with self.__lock:
+            endpoint = self.__endpoints.setdefault(url, {"active": 0, "queued": deque()})
+            if endpoint["active"] >= self.__per_endpoint_concurrency:
+                endpoint["queued"].append((function, args, future))
+                return future
+            endpoint["active"] += 1
+        self.__start(url, function, args, future)
+        return future
+
+    def __start(self, url, function, args, future):
+        try:
+            self.__executor.submit(function, *args).add_done_callback(
+                lambda delivery: self.__on_done(url, delivery, future))
+        except Exception as e:
+            self.__release(url)
+            future.set_exception(e)
+
+    def __on_done(self, url, delivery, future):
+        if delivery.exception() is not None:
+            future.set_exception(delivery.exception())
+        else:
+            future.set_result(delivery.result())
+        self.__release(url)
+
+    def __release(self, url):
+        # Hands the next queued delivery of the endpoint to the pool, in the slot just freed
+        with self.__lock:
+            endpoint = self.__endpoints[url]
+            if endpoint["queued"]:
+                function, args, future = endpoint["queued"].popleft()
+            else:
+                endpoint["active"] -= 1
+                if not endpoint["active"]:
+                    del self.__endpoints[url]
+                    self.__idle.notify_all()
+                return
+        self.__start(url, function, args, future)
+
+    def __deliver(self, url, headers, payload):
+        session = self.__get_session(url)
+        try:
+            resp = session.post(url, headers=headers, json=payload, timeout=self.__timeout)
+            return resp.status_code
+        except requests.exceptions.RequestException as e:
+            logging.warning(f"Webhook delivery to {url} failed: {e}")
+            return None
+
+    def __deliver_batch(self, url, headers, payloads):
+        session = self.__get_session(url)
+        try:
+            resp = session.post(url, headers=headers, json=payloads, timeout=self.__timeout)
+        except requests.exceptions.RequestException as e:
+            logging.warning(f"Webhook delivery of {len(payloads)} alerts to {url} failed: {e}")
+            return [None] * len(payloads)
+        if resp.status_code == 207:
+            item_statuses = self.__item_statuses(resp, len(payloads))
+            if item_statuses:
+                return item_statuses
+        return [resp.status_code] * len(payloads)
+
+    @staticmethod
+    def __item_statuses(resp, n_items):
+        try:
+            body = resp.json()
+        except ValueError:
+            return None
+        if not isinstance(body, list) or len(body) != n_items:
+            return None
+        statuses = []
+        for entry in body:
+            status = entry.get("status") if isinstance(entry, dict) else entry
+            if not isinstance(status, int):
+                return None
+            statuses.append(status)
+        return statuses
+
+    def __get_session(self, url):
+        parts = urlsplit(url)
+        host = f"{parts.scheme}://{parts.netloc}"
+        with self.__lock:
+            session = self.__sessions.get(host)
+            if session is None:
+                session = requests.Session()
+                adapter = HTTPAdapter(pool_connections=1, pool_maxsize=self.__max_concurrency)
+                session.mount(host, adapter)
+                self.__sessions[host] = session
+        return session